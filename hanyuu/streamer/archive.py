@@ -0,0 +1,322 @@
+"""
+An archive of everything that was streamed.
+
+The :class:`Archive` tap writes the encoded stream to segment files in a
+directory, one segment per `archive_segment_seconds` aligned to the clock
+(hourly by default). Each segment is made of three files:
+
+    - <start>.mp3: The frames of the stream, unchanged.
+    - <start>.idx: A binary index of (time, byte offset) records, one for
+      every `archive_index_seconds` of audio, see :const:`INDEX_RECORD`.
+    - <start>.tracks: The track boundaries, a JSON object per line with the
+      time, byte offset and metadata of each track that started.
+
+Any range of time can be cut out of the archive with :func:`extract`, which
+looks the start up in the index and seeks straight to it.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+import logging
+import struct
+import bisect
+import json
+import time
+import os
+
+import chan
+
+from .tap import Tap
+from . import mp3
+
+
+logger = logging.getLogger("streamer.archive")
+
+#: An index record, the time in seconds since the epoch and the offset of
+#: the frame starting at that time.
+INDEX_RECORD = struct.Struct(b"<dQ")
+
+#: The amount of seconds the audio clock is allowed to run behind the wall
+#: clock before it's moved forward, this happens when the stream stalls.
+RESYNC_SECONDS = 5.0
+
+
+def segment_names(directory):
+    """Returns the sorted start times of the segments in `directory`."""
+    starts = []
+    for name in os.listdir(directory):
+        base, extension = os.path.splitext(name)
+        if extension == ".mp3" and base.isdigit():
+            starts.append(int(base))
+    return sorted(starts)
+
+
+def read_index(filename):
+    """Returns the lists of times and offsets in the index `filename`."""
+    with open(filename, "rb") as f:
+        data = f.read()
+    data = data[:len(data) - len(data) % INDEX_RECORD.size]
+    times, offsets = [], []
+    for offset in range(0, len(data), INDEX_RECORD.size):
+        time, position = INDEX_RECORD.unpack_from(data, offset)
+        times.append(time)
+        offsets.append(position)
+    return times, offsets
+
+
+def read_tracks(filename):
+    """Returns the track boundaries in `filename` as a list of dicts."""
+    tracks = []
+    try:
+        with open(filename, "rb") as f:
+            for line in f:
+                if line.strip():
+                    tracks.append(json.loads(line.decode("utf8")))
+    except IOError:
+        pass
+    return tracks
+
+
+def extract(directory, start, end, out, chunk_size=65536):
+    """
+    Writes the archived stream between `start` and `end`, in seconds since
+    the epoch, to the file object `out`. The range is widened to the index
+    records around it.
+
+    :returns: The amount of bytes written.
+    """
+    written = 0
+    starts = segment_names(directory)
+    for index, segment in enumerate(starts):
+        following = starts[index + 1] if index + 1 < len(starts) else None
+        if segment >= end or (following is not None and following <= start):
+            continue
+
+        base = os.path.join(directory, "{:d}".format(segment))
+        try:
+            times, offsets = read_index(base + ".idx")
+        except IOError:
+            logger.warning("Segment %d has no index, skipping.", segment)
+            continue
+        if not times:
+            continue
+
+        begin = bisect.bisect_right(times, start) - 1
+        begin = offsets[max(begin, 0)]
+        stop = bisect.bisect_left(times, end)
+        stop = offsets[stop] if stop < len(offsets) else None
+
+        with open(base + ".mp3", "rb") as f:
+            f.seek(begin)
+            remaining = None if stop is None else stop - begin
+            while remaining is None or remaining > 0:
+                size = (chunk_size if remaining is None
+                        else min(chunk_size, remaining))
+                data = f.read(size)
+                if not data:
+                    break
+                out.write(data)
+                written += len(data)
+                if remaining is not None:
+                    remaining -= len(data)
+    return written
+
+
+def tracks_between(directory, start, end):
+    """Returns the track boundaries between `start` and `end`."""
+    tracks = []
+    for segment in segment_names(directory):
+        if segment >= end:
+            break
+        base = os.path.join(directory, "{:d}".format(segment))
+        tracks.extend(track for track in read_tracks(base + ".tracks")
+                      if start <= track["time"] < end)
+    return tracks
+
+
+class Archive(Tap):
+    """
+    ======
+    Source
+    ======
+
+    The source should return an MPEG audio stream, such as the
+    :class:`~hanyuu.streamer.encoder.Encoder`.
+
+    =======
+    Options
+    =======
+
+    Next to the options of :class:`~hanyuu.streamer.tap.Tap`:
+
+        - archive_directory:
+            The directory to write the segments to, it's created if it
+            doesn't exist.
+        - archive_segment_seconds:
+            The length of a segment, segments start on multiples of this.
+            (defaults to 3600)
+        - archive_index_seconds:
+            The amount of seconds of audio between two index records.
+            (defaults to 1.0)
+        - archive_keep_seconds:
+            Segments older than this are removed, 0 keeps everything.
+            (defaults to 0)
+        - archive_write_buffer:
+            The size of the write buffer of the segment file in bytes.
+            (defaults to 1048576)
+    """
+    options = {
+        "tap_queue_size": 512,
+        "archive_directory": "archive",
+        "archive_segment_seconds": 3600,
+        "archive_index_seconds": 1.0,
+        "archive_keep_seconds": 0,
+        "archive_write_buffer": 1048576,
+    }
+    frames = True
+
+    def __init__(self, manager, pipe, options):
+        super(Archive, self).__init__(manager, pipe, options)
+        self.directory = options["archive_directory"]
+        self.segment_seconds = int(options["archive_segment_seconds"])
+        self.index_seconds = float(options["archive_index_seconds"])
+        self.keep_seconds = float(options["archive_keep_seconds"])
+        self.write_buffer = int(options["archive_write_buffer"])
+
+        self.metadata_channel = manager.register("metadata")
+        #: (time, metadata) of the tracks that started and aren't written
+        #: yet. Filled from the reading path, so a writer stuck on the disk
+        #: doesn't leave the channel full and block the emitter.
+        self.track_starts = []
+        self.lock = threading.Lock()
+
+        #: The start time of the current segment, or None.
+        self.segment = None
+        self.stream = self.index = self.tracks = None
+        #: The time of the audio at the end of the last frame written.
+        self.clock = None
+        self.offset = 0
+        self.next_index = 0.0
+
+        registry = manager.metrics
+        self.written = registry.counter(
+            "streamer_archive_bytes_total",
+            "Bytes written to the archive.")
+        self.rotations = registry.counter(
+            "streamer_archive_segments_total",
+            "Archive segments started.")
+
+    def write_frame(self, header, frame, timestamp):
+        if self.clock is None or timestamp - self.clock > RESYNC_SECONDS:
+            self.clock = timestamp - mp3.duration(header)
+
+        if (self.segment is None or
+                self.clock >= self.segment + self.segment_seconds):
+            self.rotate()
+
+        if self.clock >= self.next_index:
+            self.index.write(INDEX_RECORD.pack(self.clock, self.offset))
+            self.next_index = self.clock + self.index_seconds
+
+        self.check_metadata(timestamp)
+
+        self.stream.write(frame)
+        self.offset += len(frame)
+        self.clock += mp3.duration(header)
+        self.written.inc(len(frame))
+
+    def put(self, data):
+        self.take_metadata()
+        super(Archive, self).put(data)
+
+    def take_metadata(self):
+        """Internal method
+
+        Moves the metadata events received to :attr:`track_starts`, called
+        from the reading path.
+        """
+        while True:
+            try:
+                metadata = self.metadata_channel.get(0)
+            except (chan.ChanClosed, chan.Timeout):
+                return
+            with self.lock:
+                self.track_starts.append((time.time(), metadata))
+
+    def check_metadata(self, timestamp):
+        """Internal method
+
+        Records a track boundary for each track that started before the
+        read at `timestamp`.
+        """
+        with self.lock:
+            count = 0
+            while (count < len(self.track_starts) and
+                    self.track_starts[count][0] <= timestamp):
+                count += 1
+            started = self.track_starts[:count]
+            del self.track_starts[:count]
+
+        for _, metadata in started:
+            line = json.dumps({"time": self.clock, "offset": self.offset,
+                               "metadata": metadata})
+            self.tracks.write(line.encode("utf8") + b"\n")
+        if started:
+            self.tracks.flush()
+
+    def rotate(self):
+        """Internal method
+
+        Closes the current segment and starts a new one at the clock.
+        """
+        self.flush()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.segment = int(self.clock // self.segment_seconds *
+                           self.segment_seconds)
+        base = os.path.join(self.directory, "{:d}".format(self.segment))
+        # Appending continues a segment after a restart, the index is still
+        # correct as offsets are taken from the end of the file.
+        self.stream = open(base + ".mp3", "ab", self.write_buffer)
+        self.stream.seek(0, os.SEEK_END)
+        self.offset = self.stream.tell()
+        self.index = open(base + ".idx", "ab")
+        self.tracks = open(base + ".tracks", "ab")
+        self.next_index = self.clock
+        self.rotations.inc()
+        logger.info("Started archive segment %s", base)
+
+        self.cleanup()
+
+    def cleanup(self):
+        """Internal method
+
+        Removes segments older than `archive_keep_seconds`.
+        """
+        if not self.keep_seconds:
+            return
+        for segment in segment_names(self.directory):
+            if segment + self.segment_seconds >= self.clock - self.keep_seconds:
+                break
+            for extension in (".mp3", ".idx", ".tracks"):
+                filename = os.path.join(self.directory,
+                                        "{:d}{}".format(segment, extension))
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            logger.info("Removed archive segment %d", segment)
+
+    def close(self):
+        super(Archive, self).close()
+        self.metadata_channel.close()
+
+    def flush(self):
+        for f in (self.stream, self.index, self.tracks):
+            if f is not None:
+                f.close()
+        self.stream = self.index = self.tracks = None
+        self.segment = None
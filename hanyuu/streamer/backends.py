@@ -0,0 +1,286 @@
+"""
+Encoder backends for the :class:`~hanyuu.streamer.encoder.Encoder`.
+
+A backend turns PCM into an encoded stream, the encoder pulls PCM from its
+source and hands it to the backend picked with the `encoder_backend`
+option:
+
+    - process:
+        The LAME binary, the original encoder, see
+        :class:`~hanyuu.streamer.encoder.EncoderInstance`.
+    - library:
+        libmp3lame in our own process, see :class:`LameLibrary`.
+    - opus:
+        Opus in Ogg, encoded by the opusenc binary, see :class:`Opus`.
+
+A backend implements the interface of :class:`Backend`. New backends are
+added to :data:`BACKENDS`.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import subprocess
+import threading
+import logging
+import os
+
+from . import lame
+
+
+logger = logging.getLogger("streamer.backends")
+
+#: The libshout formats, see :class:`~hanyuu.streamer.icecast.IcecastConfig`.
+FORMAT_OGG = 0
+FORMAT_MP3 = 1
+
+
+class BackendError(Exception):
+    """Exception raised when a backend can't be started or fails."""
+    pass
+
+
+class Backend(object):
+    """
+    The interface of an encoder backend.
+
+    :param options: The options of the encoder.
+    :param sample_rate: The sample rate of the PCM.
+    :param bits_per_sample: The bits per sample of the PCM, the PCM is
+                            always interleaved stereo, signed and little
+                            endian.
+    """
+    #: The libshout format of the output.
+    format = FORMAT_MP3
+
+    def __init__(self, options, sample_rate, bits_per_sample):
+        super(Backend, self).__init__()
+        self.options = options
+        self.sample_rate = sample_rate
+        self.bits_per_sample = bits_per_sample
+
+    @classmethod
+    def bitrate(cls, options):
+        """Returns the bitrate in kbit/s of the output with `options`, an
+        estimate for variable bitrates."""
+        raise NotImplementedError()
+
+    @property
+    def frame_duration(self):
+        """The amount of seconds of audio in a frame of the output, the
+        smallest unit the stream can be cut at."""
+        raise NotImplementedError()
+
+    def start(self):
+        """Prepares the backend for :meth:`encode`.
+
+        :raises BackendError: If the backend can't be started.
+        """
+        raise NotImplementedError()
+
+    def encode(self, data, size):
+        """Encodes the first `size` bytes of `data`, a bytearray, and returns
+        the encoded data that came out. This can be empty, encoders hold on
+        to some audio.
+
+        :raises BackendError: If encoding failed.
+        """
+        raise NotImplementedError()
+
+    def flush(self):
+        """Returns the encoded data still held by the backend, after this
+        the backend has to be restarted to encode more."""
+        raise NotImplementedError()
+
+    def restart(self):
+        """Drops the current stream and starts a new one."""
+        self.close()
+        self.start()
+
+    def close(self):
+        raise NotImplementedError()
+
+
+def lame_bitrate(settings):
+    """Returns the bitrate in kbit/s of LAME `settings`, 192 when no bitrate
+    is given."""
+    bitrate = 192
+    for flag, value in zip(settings, settings[1:]):
+        if flag in ('-b', '--abr'):
+            bitrate = int(value)
+    return bitrate
+
+
+def lame_frame_duration(settings, sample_rate):
+    """Returns the duration of an MPEG-1 layer III frame encoded by LAME
+    with `settings` from audio of `sample_rate`."""
+    rate = sample_rate
+    for flag, value in zip(settings, settings[1:]):
+        if flag == '--resample':
+            rate = float(value) * 1000
+    return 1152.0 / rate
+
+
+class LameLibrary(Backend):
+    """MP3 with libmp3lame, using the `lame_settings` option, see
+    :mod:`hanyuu.streamer.lame`."""
+    format = FORMAT_MP3
+
+    @classmethod
+    def bitrate(cls, options):
+        return lame_bitrate(options['lame_settings'])
+
+    @property
+    def frame_duration(self):
+        return lame_frame_duration(self.options['lame_settings'],
+                                   self.sample_rate)
+
+    def start(self):
+        try:
+            self.lame = lame.Lame(self.options['lame_settings'],
+                                  self.sample_rate, self.bits_per_sample)
+        except lame.LameError as err:
+            raise BackendError(str(err))
+
+    def encode(self, data, size):
+        try:
+            return self.lame.encode(data, size)
+        except lame.LameError as err:
+            raise BackendError(str(err))
+
+    def flush(self):
+        return self.lame.flush()
+
+    def close(self):
+        self.lame.close()
+
+
+class Process(Backend):
+    """
+    A backend running an encoder binary, PCM is written to its stdin and the
+    output collected from its stdout by a thread. Subclasses return the
+    command line from :meth:`arguments`.
+    """
+    def arguments(self):
+        raise NotImplementedError()
+
+    def start(self):
+        try:
+            self.process = subprocess.Popen(args=self.arguments(),
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+        except OSError as err:
+            raise BackendError("Failed running {}: {}".format(
+                self.arguments()[0], err))
+        self.output = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.collect,
+                                       name="Encoder Backend Reader")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def collect(self):
+        """Internal method
+
+        Runs in its own thread, collects the output of the process.
+        """
+        fileno = self.process.stdout.fileno()
+        while True:
+            try:
+                data = os.read(fileno, 65536)
+            except OSError:
+                break
+            if not data:
+                break
+            with self.lock:
+                self.output.append(data)
+
+    def take(self):
+        """Internal method
+
+        Returns the output collected so far.
+        """
+        with self.lock:
+            output, self.output = self.output, []
+        return b''.join(output)
+
+    def encode(self, data, size):
+        try:
+            self.process.stdin.write(memoryview(data)[:size].tobytes())
+            self.process.stdin.flush()
+        except (IOError, ValueError) as err:
+            raise BackendError("Write to encoder failed: {}".format(err))
+        return self.take()
+
+    def flush(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.thread.join()
+        self.process.wait()
+        return self.take()
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        self.thread.join(1.0)
+
+
+class Opus(Process):
+    """
+    Opus in Ogg, encoded by opusenc from opus-tools. Uses the options:
+
+        - opus_settings:
+            A list of encoding options to pass to opusenc, the input and
+            output options are handled by us.
+            (defaults to ['--bitrate', '64'])
+        - opus_binary:
+            The opusenc binary to run.
+            (defaults to 'opusenc')
+
+    opusenc resamples to the 48kHz used by Opus itself.
+    """
+    format = FORMAT_OGG
+
+    @classmethod
+    def bitrate(cls, options):
+        settings = options.get('opus_settings') or ['--bitrate', '64']
+        bitrate = 64
+        for flag, value in zip(settings, settings[1:]):
+            if flag == '--bitrate':
+                bitrate = int(float(value))
+        return bitrate
+
+    @property
+    def frame_duration(self):
+        settings = self.options.get('opus_settings') or []
+        for flag, value in zip(settings, settings[1:]):
+            if flag == '--framesize':
+                return float(value) / 1000
+        return 0.02
+
+    def arguments(self):
+        if self.bits_per_sample not in (16, 24):
+            raise BackendError("opusenc can't read {:d} bits per sample"
+                               .format(self.bits_per_sample))
+        settings = self.options.get('opus_settings') or ['--bitrate', '64']
+        return [
+            self.options.get('opus_binary') or 'opusenc', '--quiet',
+            '--raw',
+            '--raw-rate', str(self.sample_rate),
+            '--raw-bits', str(self.bits_per_sample),
+            '--raw-chan', '2',
+            '--raw-endianness', '0'] + list(settings) + ['-', '-']
+
+
+#: The backends available for `encoder_backend`, next to 'process'.
+BACKENDS = {
+    'library': LameLibrary,
+    'opus': Opus,
+}
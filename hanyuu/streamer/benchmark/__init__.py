@@ -0,0 +1,89 @@
+"""
+Offline benchmarks of the audio pipeline.
+
+Nothing in here needs a music directory or an icecast server, the audio is
+generated by :mod:`.synthetic` and the icecast server is replaced by the stub
+in :mod:`.stub`. Run ``python -m hanyuu.streamer.benchmark --help`` for the
+command line interface.
+
+Results are appended as JSON lines to a results file so runs can be compared
+over time with :func:`compare`.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import subprocess
+import json
+import time
+import os
+
+
+#: The default file results are saved to.
+RESULTS_FILE = "benchmark_results.jsonl"
+
+
+def revision():
+    """Returns the git revision of the tree we are running from, if any."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "--short",
+                                          "HEAD"], cwd=directory,
+                                         stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode("ascii").strip()
+
+
+def save_result(result, filename=RESULTS_FILE):
+    """Appends `result` to the results file `filename`, adding the time and
+    git revision it was recorded at."""
+    result = dict(result, recorded=time.time(), revision=revision())
+    with open(filename, "ab") as f:
+        f.write(json.dumps(result, sort_keys=True).encode("utf8") + b"\n")
+    return result
+
+
+def load_results(filename=RESULTS_FILE, kind=None):
+    """Returns the results saved in `filename`, optionally only those of
+    the benchmark `kind`."""
+    results = []
+    if not os.path.exists(filename):
+        return results
+    with open(filename, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line.decode("utf8"))
+            if kind is None or result.get("kind") == kind:
+                results.append(result)
+    return results
+
+
+def flatten(result, prefix=""):
+    """Flattens nested dictionaries of numbers into dotted keys."""
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old, new):
+    """
+    Compares two results.
+
+    :returns: A list of (key, old value, new value, relative change) tuples
+              for every number found in both results.
+    """
+    old, new = flatten(old), flatten(new)
+    rows = []
+    for key in sorted(set(old) & set(new)):
+        if key == "recorded":
+            continue
+        before, after = old[key], new[key]
+        change = (after - before) / float(before) if before else None
+        rows.append((key, before, after, change))
+    return rows
@@ -0,0 +1,131 @@
+"""
+Command line interface of the benchmarks.
+
+    python -m hanyuu.streamer.benchmark pipeline --seconds 60 --fake-lame
+    python -m hanyuu.streamer.benchmark decode --profile decode.json ~/music
+    python -m hanyuu.streamer.benchmark compare
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import logging
+import json
+import os
+
+from . import RESULTS_FILE, save_result, load_results, compare
+
+
+def command_pipeline(arguments):
+    from . import pipeline
+
+    result = pipeline.run(seconds=arguments.seconds,
+                          corpus_directory=arguments.corpus,
+                          fake_lame=arguments.fake_lame,
+                          sink=arguments.sink)
+    result["label"] = arguments.label
+    return result
+
+
+def command_decode(arguments):
+    from . import decode, synthetic
+
+    filenames = []
+    for path in arguments.paths:
+        if os.path.isdir(path):
+            for base, _, names in os.walk(path):
+                filenames.extend(os.path.join(base, name) for name in names)
+        else:
+            filenames.append(path)
+    if not filenames:
+        import tempfile
+        directory = arguments.corpus or tempfile.mkdtemp(
+            prefix="hanyuu-benchmark-")
+        filenames = [filename for _, filename in
+                     synthetic.generate_corpus(directory)]
+
+    result = decode.run(filenames, arguments.engine, arguments.repeat)
+    result["label"] = arguments.label
+    if arguments.profile:
+        decode.save_profile(result, arguments.profile)
+    return result
+
+
+def command_compare(arguments):
+    results = load_results(arguments.results, arguments.kind)
+    if len(results) < 2:
+        print("Need at least two saved results to compare.")
+        return
+
+    old, new = results[-2], results[-1]
+    print("Comparing {} ({}) to {} ({})".format(
+        old.get("label"), old.get("revision"),
+        new.get("label"), new.get("revision")))
+    for key, before, after, change in compare(old, new):
+        change = "" if change is None else "{:+.1%}".format(change)
+        print("{:<40} {:>14.4f} {:>14.4f} {:>8}".format(key, before,
+                                                        after, change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m hanyuu.streamer.benchmark",
+        description="Offline benchmarks of the streamer pipeline.")
+    parser.add_argument("--results", default=RESULTS_FILE,
+                        help="file to save results to and compare from")
+    parser.add_argument("--no-save", action="store_true",
+                        help="don't save the result")
+    parser.add_argument("--label", default=None,
+                        help="label to save with the result")
+    parser.add_argument("--corpus", default=None,
+                        help="directory to keep the synthetic files in")
+    parser.add_argument("--verbose", action="store_true")
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser("pipeline",
+                                  help="run an end-to-end pipeline")
+    command.add_argument("--seconds", type=float, default=30.0)
+    command.add_argument("--fake-lame", action="store_true",
+                         help="use a passthrough encoder instead of LAME")
+    command.add_argument("--sink", choices=("null", "icecast"),
+                         default="null",
+                         help="discard output in-process or send it to a "
+                              "stub icecast server")
+    command.set_defaults(function=command_pipeline)
+
+    command = commands.add_parser("decode",
+                                  help="measure decode speed per format")
+    command.add_argument("paths", nargs="*",
+                         help="files or directories to decode, defaults to "
+                              "the synthetic corpus")
+    command.add_argument("--engine", action="append", default=None,
+                         help="engine to benchmark, can be given more than "
+                              "once (defaults to all available)")
+    command.add_argument("--repeat", type=int, default=1)
+    command.add_argument("--profile", default=None,
+                         help="file to write the profile for the preloader "
+                              "to")
+    command.set_defaults(function=command_decode)
+
+    command = commands.add_parser("compare",
+                                  help="compare the last two saved results")
+    command.add_argument("--kind", default=None,
+                         help="only compare results of this benchmark")
+    command.set_defaults(function=command_compare)
+
+    arguments = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if arguments.verbose else logging.WARNING)
+
+    result = arguments.function(arguments)
+    if result is None:
+        return
+
+    print(json.dumps(result, indent=4, sort_keys=True))
+    if not arguments.no_save:
+        save_result(result, arguments.results)
+
+
+if __name__ == "__main__":
+    main()
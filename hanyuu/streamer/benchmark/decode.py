@@ -0,0 +1,283 @@
+"""
+Decode speed benchmark.
+
+Runs the decode chain of :class:`~hanyuu.streamer.files.AudioFile`
+(open, to_pcm, PCMConverter and to_bytes) over a corpus of files and reports
+the real-time factor, CPU time and memory used for each file, grouped by
+format, sample rate and bit depth.
+
+The memory allocated is counted per chunk over the objects an engine
+creates for it, with :func:`sys.getsizeof`. For audiotools that is the
+decoded :class:`FrameList`, of which the samples are held outside of the
+object, and the PCM string made from it.
+
+Other conversion engines are benchmarked next to it when available, so we
+know what we would gain by switching:
+
+    - audiotools: The chain used by :class:`~hanyuu.streamer.files.AudioFile`.
+    - ffmpeg: Decoding and conversion by an ffmpeg subprocess.
+
+The summary can be saved as a profile with :func:`save_profile`, which the
+preloader reads through :class:`DecodeProfile` to estimate decode times.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import defaultdict
+import distutils.spawn
+import subprocess
+import resource
+import logging
+import struct
+import json
+import time
+import sys
+import os
+
+from ..files import SAMPLE_RATE, CHANNELS, BITS_PER_SAMPLE, BYTE_RATE
+from .pipeline import thread_cpu, process_cpu
+
+
+logger = logging.getLogger("streamer.benchmark.decode")
+
+#: The size of the reads done on the decoders, same as the pipeline uses.
+CHUNK_SIZE = 4096
+#: The size of a sample held by an audiotools FrameList, a C int.
+FRAMELIST_SAMPLE_SIZE = struct.calcsize(b"i")
+
+
+def framelist_size(framelist):
+    """Returns the bytes held by an audiotools FrameList, the object and
+    its samples."""
+    return (sys.getsizeof(framelist) +
+            framelist.frames * framelist.channels * FRAMELIST_SAMPLE_SIZE)
+
+
+def decode_audiotools(filename):
+    """Decodes `filename` with the chain of
+    :class:`~hanyuu.streamer.files.AudioFile`, yields the PCM chunks and the
+    bytes allocated for each."""
+    from ..files import AudioFile
+
+    audiofile = AudioFile(filename)
+    try:
+        while True:
+            # What AudioFile.decode does, with the FrameList in sight.
+            framelist = audiofile._reader.read(CHUNK_SIZE)
+            data = framelist.to_bytes(False, True)
+            if not data:
+                break
+            yield data, framelist_size(framelist) + sys.getsizeof(data)
+    finally:
+        audiofile.close()
+
+
+def decode_ffmpeg(filename):
+    """Decodes `filename` with an ffmpeg subprocess, yields the PCM
+    chunks and the bytes allocated for each."""
+    process = subprocess.Popen(
+        ["ffmpeg", "-v", "quiet", "-i", filename,
+         "-f", "s{:d}le".format(BITS_PER_SAMPLE),
+         "-ar", str(SAMPLE_RATE), "-ac", str(CHANNELS), "-"],
+        stdout=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data, sys.getsizeof(data)
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+#: Available engines, name -> (decode function, availability check)
+ENGINES = {
+    "audiotools": (decode_audiotools, lambda: True),
+    "ffmpeg": (decode_ffmpeg,
+               lambda: distutils.spawn.find_executable("ffmpeg") is not None),
+}
+
+
+def available_engines():
+    return sorted(name for name, (_, available) in ENGINES.items()
+                  if available())
+
+
+def describe(filename):
+    """Returns the format, sample rate, bit depth and length of
+    `filename`."""
+    import audiotools
+
+    audiofile = audiotools.open(filename.encode("utf8"))
+    return {
+        "format": audiofile.NAME,
+        "sample_rate": audiofile.sample_rate(),
+        "bits_per_sample": audiofile.bits_per_sample(),
+        "seconds": float(audiofile.total_frames()) / audiofile.sample_rate(),
+    }
+
+
+def measure(engine, filename):
+    """Decodes `filename` completely with `engine` and returns the
+    measurements."""
+    decode, _ = ENGINES[engine]
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = process_cpu(resource.RUSAGE_CHILDREN)
+    cpu, wall = thread_cpu(), time.time()
+
+    chunks = size = allocated = 0
+    for data, chunk_allocated in decode(filename):
+        chunks += 1
+        size += len(data)
+        allocated += chunk_allocated
+
+    wall = time.time() - wall
+    cpu = thread_cpu() - cpu + process_cpu(resource.RUSAGE_CHILDREN) - children
+    audio_seconds = float(size) / BYTE_RATE
+
+    return {
+        "engine": engine,
+        "wall": wall,
+        "cpu": cpu,
+        "audio_seconds": audio_seconds,
+        "realtime_factor": audio_seconds / wall if wall else None,
+        "cpu_per_audio_second": cpu / audio_seconds if audio_seconds else None,
+        "chunks": chunks,
+        "bytes": size,
+        # Allocated over the whole run, the peak RSS growth shows what
+        # was actually kept.
+        "allocated_bytes": allocated,
+        "rss_growth_kb": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                          - rss),
+    }
+
+
+def run(filenames, engines=None, repeat=1):
+    """
+    Benchmarks `filenames` with `engines` (defaults to all available ones).
+
+    :returns: A result dictionary with a row per file and engine in
+              'results' and the real-time factors in 'summary'.
+    """
+    engines = engines or available_engines()
+
+    results = []
+    for filename in filenames:
+        try:
+            description = describe(filename)
+        except Exception:
+            logger.exception("Skipping unreadable file %s", filename)
+            continue
+
+        for engine in engines:
+            for _ in range(repeat):
+                try:
+                    row = measure(engine, filename)
+                except Exception:
+                    logger.exception("Engine %s failed on %s", engine,
+                                     filename)
+                    continue
+                row.update(description, filename=os.path.basename(filename))
+                results.append(row)
+
+    return {
+        "kind": "decode",
+        "config": {"engines": engines, "repeat": repeat},
+        "results": results,
+        "summary": summarize(results),
+    }
+
+
+def pcm_key(sample_rate, bits_per_sample):
+    """Returns the key of a sample rate and bit depth in a summary."""
+    return "{:d}/{:d}".format(sample_rate, bits_per_sample)
+
+
+def summarize(results):
+    """
+    Groups `results` by engine, format, sample rate and bit depth.
+
+    :returns: {engine: {format: {"sample_rate/bits_per_sample":
+                                 {"realtime_factor": ...,
+                                  "cpu_per_audio_second": ...}}}}, the
+              values are the medians of the group.
+    """
+    groups = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+    for row in results:
+        key = pcm_key(row["sample_rate"], row["bits_per_sample"])
+        groups[row["engine"]][row["format"]][key].append(row)
+
+    summary = {}
+    for engine, formats in groups.items():
+        summary[engine] = {}
+        for name, pcm_groups in formats.items():
+            summary[engine][name] = {}
+            for key, rows in pcm_groups.items():
+                summary[engine][name][key] = dict(
+                    (field, median([row[field] for row in rows
+                                    if row[field] is not None]))
+                    for field in ("realtime_factor",
+                                  "cpu_per_audio_second"))
+    return summary
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def save_profile(result, filename):
+    """Writes the summary of a :func:`run` result to `filename` in the
+    format read by :class:`DecodeProfile`."""
+    with open(filename, "wb") as f:
+        f.write(json.dumps({"summary": result["summary"]}, indent=4,
+                           sort_keys=True).encode("utf8"))
+
+
+class DecodeProfile(object):
+    """
+    Decode speeds measured by this benchmark, used to estimate how long
+    decoding a file will take.
+
+    :param filename: A profile written by :func:`save_profile`.
+    :param engine: The engine the estimates are for.
+    """
+    #: Real-time factor assumed for formats missing from the profile.
+    default_realtime_factor = 50.0
+
+    def __init__(self, filename, engine="audiotools"):
+        super(DecodeProfile, self).__init__()
+        with open(filename, "rb") as f:
+            summary = json.loads(f.read().decode("utf8"))["summary"]
+        self.formats = summary.get(engine, {})
+
+    def realtime_factor(self, format, sample_rate=None,
+                        bits_per_sample=None):
+        """Returns the real-time factor of decoding `format` at
+        `sample_rate` and `bits_per_sample`. The median of the format is
+        used when those weren't measured."""
+        groups = self.formats.get(format, {})
+        factor = None
+        if sample_rate is not None and bits_per_sample is not None:
+            group = groups.get(pcm_key(sample_rate, bits_per_sample), {})
+            factor = group.get("realtime_factor")
+        if not factor:
+            factor = median([group.get("realtime_factor")
+                             for group in groups.values()
+                             if group.get("realtime_factor")])
+        return factor or self.default_realtime_factor
+
+    def estimate(self, format, seconds, sample_rate=None,
+                 bits_per_sample=None):
+        """Returns the estimated seconds it takes to decode `seconds` of
+        audio in `format`."""
+        return seconds / self.realtime_factor(format, sample_rate,
+                                              bits_per_sample)
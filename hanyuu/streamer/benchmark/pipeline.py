@@ -0,0 +1,249 @@
+"""
+End-to-end benchmark of a :class:`~hanyuu.streamer.manager.Manager` pipeline.
+
+The pipeline is built from the real pipes with synthetic audio as source.
+The encoder can be the real LAME binary or a passthrough fake, and the sink
+either the real :class:`~hanyuu.streamer.icecast.Icecast` pipe connected to
+a :class:`~.stub.StubIcecast` or an in-process :class:`NullSink`.
+
+A :class:`Probe` is placed after every stage to measure the CPU time spent
+by the thread reading from it. Note that the real icecast sink is paced to
+real time by libshout, use the null sink to measure raw throughput.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+import resource
+import tempfile
+import logging
+import time
+import stat
+import sys
+import os
+
+from ..files import BYTE_RATE
+from .. import pool
+from . import synthetic
+
+
+logger = logging.getLogger("streamer.benchmark.pipeline")
+
+#: getrusage target for the calling thread, not exposed by python 2.
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", 1)
+
+FAKE_LAME = """#!{executable}
+# Passthrough stand-in for LAME used by the benchmarks, ignores all
+# arguments and copies stdin to stdout.
+import os
+while True:
+    data = os.read(0, 65536)
+    if not data:
+        break
+    os.write(1, data)
+"""
+
+
+def thread_cpu():
+    """Returns the CPU seconds used by the calling thread."""
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+def process_cpu(who=resource.RUSAGE_SELF):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def make_fake_lame(directory):
+    """Writes the passthrough encoder script into `directory` and returns
+    its filename."""
+    filename = os.path.join(directory, "fake-lame")
+    with open(filename, "w") as f:
+        f.write(FAKE_LAME.format(executable=sys.executable))
+    os.chmod(filename, os.stat(filename).st_mode | stat.S_IEXEC)
+    return filename
+
+
+class Probe(object):
+    """
+    A passthrough pipe that measures reads done on the pipe before it.
+
+    Use :func:`probe` to create one for a named stage.
+    """
+    stage = None
+
+    def __init__(self, manager, pipe, options):
+        super(Probe, self).__init__()
+        self.manager = manager
+        self.source = pipe
+
+        self.reads = 0
+        self.bytes = 0
+        self.cpu = 0.0
+        self.wall = 0.0
+        #: Durations of reads during which the source switched tracks.
+        self.gaps = []
+
+    def read(self, size=4096, timeout=10.0):
+        return self.measure(self.source.read, size, timeout)
+
+    def readinto(self, buffer, timeout=10.0):
+        return self.measure(pool.readinto, self.source, buffer, timeout)
+
+    def measure(self, function, *args):
+        """Calls `function` with `args` and records it as a read, returns
+        the result of `function`."""
+        before = self.source.__dict__.get("audiofile")
+        cpu, wall = thread_cpu(), time.time()
+        result = function(*args)
+        wall = time.time() - wall
+        self.cpu += thread_cpu() - cpu
+        self.wall += wall
+
+        self.reads += 1
+        self.bytes += result if isinstance(result, int) else len(result)
+        if before is not self.source.__dict__.get("audiofile", before):
+            self.gaps.append(wall)
+        return result
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def report(self):
+        return {"reads": self.reads, "bytes": self.bytes,
+                "cpu": self.cpu, "wall": self.wall}
+
+    def __getattr__(self, key):
+        if key == 'source':
+            raise AttributeError("No attribute named 'source'")
+        return getattr(self.source, key)
+
+
+def probe(stage):
+    """Returns a :class:`Probe` subclass for the stage named `stage`."""
+    return type(str("Probe_" + stage), (Probe,), {"stage": stage})
+
+
+class NullSink(object):
+    """A sink that reads from its source as fast as it can and throws the
+    data away."""
+    def __init__(self, manager, pipe, options):
+        super(NullSink, self).__init__()
+        self.manager = manager
+        self.source = pipe
+        self.running = threading.Event()
+
+        self.received = 0
+        self.first_byte = None
+
+    def run(self):
+        buffer = self.manager.buffers.acquire()
+        while self.running.is_set():
+            size = pool.readinto(self.source, buffer)
+            if size and self.first_byte is None:
+                self.first_byte = time.time()
+            self.received += size
+        self.manager.buffers.release(buffer)
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name="Null Sink")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.running.clear()
+
+
+def run(seconds=30.0, corpus_directory=None, fake_lame=False,
+        sink="null", options=None):
+    """
+    Runs a pipeline for `seconds` seconds and returns a result dictionary.
+
+    :param corpus_directory: Directory to keep the synthetic files in,
+                             defaults to a temporary directory.
+    :param fake_lame: Use a passthrough encoder instead of LAME.
+    :param sink: 'null' for :class:`NullSink` or 'icecast' for the icecast
+                 pipe connected to a stub server.
+    :param options: Extra manager options.
+    """
+    from ..manager import Manager
+    from ..preloader import PreloadedFileSource
+    from ..files import FileSource
+    from ..encoder import Encoder
+
+    workdir = tempfile.mkdtemp(prefix="hanyuu-benchmark-")
+    files = synthetic.generate_corpus(corpus_directory or workdir)
+    if not files:
+        raise RuntimeError("No synthetic files could be generated.")
+    queue = synthetic.SyntheticQueue(filename for _, filename in files)
+
+    options = dict(options or {})
+    if fake_lame:
+        options["lame_binary"] = make_fake_lame(workdir)
+
+    server = None
+    if sink == "icecast":
+        from .stub import StubIcecast
+        from ..icecast import Icecast
+
+        server = StubIcecast()
+        server.start()
+        options["icecast_config"] = server.config()
+        sink_pipe = Icecast
+    else:
+        sink_pipe = NullSink
+
+    pipes = [PreloadedFileSource,
+             FileSource, probe("file_source"),
+             Encoder, probe("encoder"),
+             sink_pipe]
+
+    manager = Manager(queue, pipes, options)
+    probes = dict((instance.stage, instance)
+                  for instance in manager.pipe_instances
+                  if isinstance(instance, Probe))
+
+    started_cpu = process_cpu()
+    started = time.time()
+    manager.start()
+    time.sleep(seconds)
+    elapsed = time.time() - started
+    used_cpu = process_cpu() - started_cpu
+    manager.close()
+
+    if server is not None:
+        server.close()
+        received, first_byte = server.received, server.first_byte
+    else:
+        sink_instance = manager.pipe_instances[-1]
+        received = sink_instance.received
+        first_byte = sink_instance.first_byte
+
+    source = probes["file_source"]
+    audio_seconds = float(source.bytes) / BYTE_RATE
+    gaps = source.gaps
+
+    return {
+        "kind": "pipeline",
+        "config": {"sink": sink, "fake_lame": fake_lame,
+                   "files": [os.path.basename(f) for _, f in files]},
+        "seconds": elapsed,
+        "audio_seconds": audio_seconds,
+        "realtime_factor": audio_seconds / elapsed,
+        "sink_bytes_per_second": received / elapsed,
+        "time_to_first_byte": (first_byte - started) if first_byte else None,
+        "cpu": dict((stage, p.report()["cpu"])
+                    for stage, p in probes.items()),
+        "cpu_process": used_cpu,
+        "cpu_children": process_cpu(resource.RUSAGE_CHILDREN),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "track_changes": len(gaps),
+        "track_gap_max": max(gaps) if gaps else None,
+        "track_gap_mean": sum(gaps) / len(gaps) if gaps else None,
+    }
@@ -0,0 +1,133 @@
+"""
+A stub icecast server.
+
+It accepts source connections the way icecast does, reads everything sent
+and records when and how much arrived. Metadata updates are accepted and
+recorded as well. Nothing is relayed to listeners.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+import logging
+import socket
+import time
+
+
+logger = logging.getLogger("streamer.benchmark.stub")
+
+
+class StubIcecast(object):
+    """
+    A stub icecast server listening on `host` and `port`. A `port` of 0
+    picks a free port, see :attr:`port` after :meth:`start`.
+    """
+    def __init__(self, host="127.0.0.1", port=0):
+        super(StubIcecast, self).__init__()
+        self.host = host
+        self.port = port
+
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.reset()
+
+    def reset(self):
+        """Clears the recorded statistics."""
+        with self.lock:
+            #: Total bytes received on source connections.
+            self.received = 0
+            #: Time the first byte of audio arrived.
+            self.first_byte = None
+            #: Time the last byte of audio arrived.
+            self.last_byte = None
+            #: Source connections accepted.
+            self.connections = 0
+            #: List of (time, request line) of metadata updates.
+            self.metadata = []
+
+    def config(self, mount="/benchmark.mp3"):
+        """Returns an icecast_config for the
+        :class:`~hanyuu.streamer.icecast.Icecast` pipe pointing at us."""
+        return {'host': self.host,
+                'port': self.port,
+                'password': 'benchmark',
+                'format': 1,
+                'protocol': 0,
+                'mount': mount}
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(5)
+        self.port = self.socket.getsockname()[1]
+        self.running.set()
+
+        self.thread = threading.Thread(target=self.run, name="Stub Icecast")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.running.clear()
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+
+    def run(self):
+        while self.running.is_set():
+            try:
+                connection, _ = self.socket.accept()
+            except socket.error:
+                break
+            thread = threading.Thread(target=self.handle,
+                                      args=(connection,),
+                                      name="Stub Icecast Client")
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, connection):
+        try:
+            header = b""
+            while b"\r\n\r\n" not in header:
+                data = connection.recv(4096)
+                if not data:
+                    return
+                header += data
+            header, rest = header.split(b"\r\n\r\n", 1)
+            request = header.split(b"\r\n", 1)[0].decode("latin1")
+
+            if request.startswith("GET"):
+                # A metadata update on the admin interface.
+                with self.lock:
+                    self.metadata.append((time.time(), request))
+                connection.sendall(b"HTTP/1.0 200 OK\r\n"
+                                   b"Content-Type: text/xml\r\n\r\n"
+                                   b"<iceresponse><return>1</return>"
+                                   b"</iceresponse>")
+                return
+
+            with self.lock:
+                self.connections += 1
+            connection.sendall(b"HTTP/1.0 200 OK\r\n\r\n")
+            self.count(rest)
+            while self.running.is_set():
+                data = connection.recv(65536)
+                if not data:
+                    break
+                self.count(data)
+        except socket.error:
+            logger.debug("Stub client connection error.", exc_info=True)
+        finally:
+            connection.close()
+
+    def count(self, data):
+        if not data:
+            return
+        now = time.time()
+        with self.lock:
+            if self.first_byte is None:
+                self.first_byte = now
+            self.last_byte = now
+            self.received += len(data)
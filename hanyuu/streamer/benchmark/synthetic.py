@@ -0,0 +1,151 @@
+"""
+Synthetic audio for the benchmarks.
+
+Generates tone and noise files in any format supported by the installed
+:mod:`audiotools`, and a queue of :class:`~hanyuu.streamer.library.Song`
+that cycles through them.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import namedtuple
+import itertools
+import logging
+import struct
+import math
+import io
+import os
+
+from ..library import Song
+
+
+logger = logging.getLogger("streamer.benchmark.synthetic")
+
+#: Description of a file to generate.
+Spec = namedtuple("Spec", ("format", "signal", "sample_rate",
+                           "bits_per_sample", "seconds"))
+
+#: The amount of samples in a period of the generated tone, the frequency is
+#: the sample rate divided by this.
+TONE_PERIOD = 100
+
+#: A corpus covering the common formats and the conversion paths the
+#: pipeline has to do (resampling and bit depth changes).
+DEFAULT_CORPUS = (
+    Spec("wav", "tone", 44100, 16, 20.0),
+    Spec("wav", "noise", 48000, 24, 20.0),
+    Spec("flac", "tone", 44100, 16, 20.0),
+    Spec("flac", "noise", 48000, 24, 20.0),
+    Spec("mp3", "tone", 44100, 16, 20.0),
+    Spec("ogg", "noise", 44100, 16, 20.0),
+    Spec("opus", "tone", 48000, 16, 20.0),
+)
+
+
+def generate_pcm(signal, sample_rate, bits_per_sample, seconds, channels=2):
+    """
+    Returns signed little-endian PCM.
+
+    :param signal: Either 'tone' for a sine wave or 'noise' for white noise.
+    """
+    width = bits_per_sample // 8
+    frames = int(sample_rate * seconds)
+
+    if signal == "noise":
+        return os.urandom(frames * channels * width)
+    elif signal != "tone":
+        raise ValueError("Unknown signal {!r}".format(signal))
+
+    # A single period is packed and then repeated, so this is cheap
+    # regardless of the length asked for.
+    peak = (1 << (bits_per_sample - 1)) // 2
+    period = []
+    for index in range(TONE_PERIOD):
+        value = int(peak * math.sin(2 * math.pi * index / TONE_PERIOD))
+        sample = struct.pack(b"<i", value)[:width]
+        period.append(sample * channels)
+    period = b"".join(period)
+
+    repeats, remainder = divmod(frames, TONE_PERIOD)
+    return period * repeats + period[:remainder * channels * width]
+
+
+def write_file(spec, filename):
+    """Generates the audio described by `spec` into `filename`. Returns
+    False if the format is not supported by the installed audiotools."""
+    import audiotools
+
+    cls = audiotools.TYPE_MAP.get(spec.format)
+    if cls is None:
+        return False
+
+    pcm = generate_pcm(spec.signal, spec.sample_rate,
+                       spec.bits_per_sample, spec.seconds)
+    reader = audiotools.PCMReader(
+        io.BytesIO(pcm), sample_rate=spec.sample_rate, channels=2,
+        channel_mask=int(audiotools.ChannelMask(0x1 | 0x2)),
+        bits_per_sample=spec.bits_per_sample,
+    )
+    try:
+        cls.from_pcm(filename.encode("utf8"), reader)
+    except Exception:
+        logger.exception("Failed generating %s", filename)
+        return False
+    return True
+
+
+def spec_filename(spec):
+    return "{0.signal}-{0.sample_rate}-{0.bits_per_sample}-{0.seconds:g}s" \
+           ".{0.format}".format(spec)
+
+
+def generate_corpus(directory, corpus=DEFAULT_CORPUS):
+    """
+    Makes sure a file exists in `directory` for each spec in `corpus`. Files
+    that already exist are reused.
+
+    :returns: A list of (spec, filename) tuples of the available files.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    files = []
+    for spec in corpus:
+        filename = os.path.join(directory, spec_filename(spec))
+        if os.path.exists(filename) or write_file(spec, filename):
+            files.append((spec, filename))
+        else:
+            logger.info("Skipping unsupported format %s", spec.format)
+    return files
+
+
+class SyntheticQueue(object):
+    """A never ending queue of songs that cycles through `filenames`. Has
+    the same interface as the queue used by the preloader."""
+    def __init__(self, filenames):
+        super(SyntheticQueue, self).__init__()
+        self.filenames = list(filenames)
+        self.cycle = itertools.cycle(self.filenames)
+        self.queue = []
+        self.count = 0
+
+    def song(self):
+        self.count += 1
+        filename = next(self.cycle)
+        return Song(filename, "Synthetic #{:d} {:s}".format(
+            self.count, os.path.basename(filename)))
+
+    def peek(self, index=0):
+        while len(self.queue) <= index:
+            self.queue.append(self.song())
+        return self.queue[index]
+
+    def pop(self):
+        song = self.peek(0)
+        del self.queue[0]
+        return song
+
+    def __call__(self):
+        """Returns the next filename, for pipelines without a preloader."""
+        return self.pop().filename
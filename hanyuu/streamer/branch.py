@@ -0,0 +1,175 @@
+"""
+A second chain of pipes fed from the middle of the pipeline.
+
+The pipeline is a single chain, to stream the same audio to a second mount
+in another format a :class:`Branch` is placed after the stage producing the
+PCM. It passes the PCM through unchanged, and feeds a copy of it to its own
+chain of pipes, run by a second manager:
+
+    Manager(queue, [FileSource, Branch, Encoder, Icecast], {
+        "branch_pipes": [Encoder, Icecast],
+        "branch_options": {
+            "encoder_backend": "opus",
+            "icecast_config": {"mount": "low.ogg", ...},
+        },
+        ...
+    })
+
+The branch gets the options of the main manager, with the ones in
+`branch_options` overriding them, so the pipes of the branch can be
+configured differently from the same pipes in the main chain.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+import logging
+import Queue
+
+import chan
+
+from .tap import Tap
+
+
+logger = logging.getLogger("streamer.branch")
+
+
+class BranchSource(object):
+    """
+    The first pipe of a branch, returns the PCM copied by the
+    :class:`Branch` in the `branch_source` option. Other attributes, such as
+    the sample rate, are those of the source of the branch.
+    """
+    def __init__(self, manager, pipe, options):
+        super(BranchSource, self).__init__()
+        self.manager = manager
+        self.branch = options["branch_source"]
+        self.pending = b''
+        # The amount of bytes of `pending` returned already.
+        self.offset = 0
+
+    def read(self, size=4096, timeout=10.0):
+        buffer = bytearray(size)
+        size = self.readinto(buffer, timeout)
+        return bytes(buffer[:size])
+
+    def readinto(self, buffer, timeout=10.0):
+        if self.offset >= len(self.pending):
+            try:
+                timestamp, self.pending = self.branch.queue.get(
+                    timeout=timeout)
+            except Queue.Empty:
+                return 0
+            self.offset = 0
+        size = min(len(buffer), len(self.pending) - self.offset)
+        buffer[:size] = memoryview(self.pending)[self.offset:
+                                                 self.offset + size]
+        self.offset += size
+        return size
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __getattr__(self, key):
+        if key == 'branch':
+            raise AttributeError("No attribute named 'branch'")
+        return getattr(self.branch.source, key)
+
+
+class Branch(Tap):
+    """
+    ======
+    Source
+    ======
+
+    Any pipe, usually one returning PCM such as the
+    :class:`~hanyuu.streamer.files.FileSource`.
+
+    =======
+    Options
+    =======
+
+    Next to the options of :class:`~hanyuu.streamer.tap.Tap`, which bound
+    how far the branch can fall behind before PCM is dropped for it:
+
+        - branch_pipes:
+            The pipes of the branch, a :class:`BranchSource` is put in
+            front of them.
+        - branch_options:
+            Options overriding those of the main manager for the branch.
+            (defaults to {})
+        - branch_name:
+            The value of the 'branch' label on the metrics of the branch.
+            (defaults to "branch")
+        - branch_events:
+            The events of the main manager that are passed on to the
+            branch.
+            (defaults to ("metadata",))
+    """
+    options = {
+        "tap_queue_size": 512,
+        "branch_pipes": [],
+        "branch_options": {},
+        "branch_name": "branch",
+        "branch_events": ("metadata",),
+    }
+
+    def __init__(self, manager, pipe, options):
+        super(Branch, self).__init__(manager, pipe, options)
+        from .manager import Manager
+
+        name = options["branch_name"]
+        branch_options = dict(manager.options)
+        # Only the main manager exports, the metrics are shared.
+        for key in ("metrics_file", "metrics_port", "branch_pipes"):
+            branch_options.pop(key, None)
+        branch_options.update(options["branch_options"])
+        branch_options["metrics_registry"] = manager.metrics.labelled(
+            {"branch": name})
+        branch_options["branch_source"] = self
+
+        pipes = [BranchSource] + list(options["branch_pipes"])
+        #: The :class:`~hanyuu.streamer.manager.Manager` of the branch.
+        self.branch = Manager(manager.source, pipes, branch_options)
+
+        self.channels = [manager.register(event)
+                         for event in options["branch_events"]]
+        self.events = dict(zip(self.channels, options["branch_events"]))
+
+    def forward(self):
+        """Internal method
+
+        Runs in its own thread, passes events on to the branch.
+        """
+        while self.running.is_set():
+            try:
+                channel, value = chan.chanselect(self.channels, [], 1.0)
+            except chan.Timeout:
+                continue
+            except chan.ChanClosed:
+                break
+            # The branch only takes in events while it's connected, an
+            # outage of it shouldn't hold up the events of the main chain.
+            self.branch.emit(self.events[channel], value, timeout=0)
+
+    def start(self):
+        if self.running.is_set():
+            return
+        self.running.set()
+        self.branch.start()
+        if self.channels:
+            self.thread = threading.Thread(target=self.forward,
+                                           name="Branch Events")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def close(self):
+        self.running.clear()
+        # The main manager drops closed channels.
+        for channel in self.channels:
+            channel.close()
+        self.branch.close()
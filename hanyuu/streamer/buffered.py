@@ -0,0 +1,206 @@
+"""
+A pipe that decouples the stage before it from the stage after it.
+
+The pipeline is pull based, a slow read anywhere upstream shows up as a
+delay on the wire. The :class:`BufferedSource` runs ahead of its consumer in
+its own thread and keeps the data read in a bounded queue. The size of the
+queue is expressed in milliseconds of audio, so the same setting can be used
+for PCM and for encoded data.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import deque
+import threading
+import logging
+import time
+
+
+logger = logging.getLogger("streamer.buffered")
+
+
+class BufferedSource(object):
+    """
+    ======
+    Source
+    ======
+
+    The source should have the following attributes:
+
+        :func:`read`:
+            :param size: An :const:`int` signifying the amount of
+                         bytes to return.
+            :returns: :const:`bytes` of audio data, an empty string is
+                      treated as no data being available yet.
+
+        :attr:`byte_rate`:
+            The amount of bytes the source returns for a second of audio.
+
+    Any other attribute lookups are passed through to the source, so this
+    pipe can be placed between any two pipes without the consumer noticing.
+
+    =======
+    Options
+    =======
+
+        - buffer_ms:
+            The maximum amount of audio, in milliseconds, to keep buffered.
+            (defaults to 2000)
+        - buffer_chunk_size:
+            The size of the reads done on the source.
+            (defaults to 4096)
+
+    The :class:`~hanyuu.streamer.manager.Manager` inserts this pipe after
+    every pipe that has a true `decouple` attribute when the manager option
+    `decouple` is set.
+    """
+    options = {
+        "buffer_ms": 2000,
+        "buffer_chunk_size": 4096,
+    }
+    #: The amount of seconds to wait before retrying a source that
+    #: returned no data.
+    retry_timeout = 0.05
+
+    def __init__(self, manager, pipe, options):
+        super(BufferedSource, self).__init__()
+        self.manager = manager
+        self.source = pipe
+
+        self.byte_rate = pipe.byte_rate
+        self.buffer_ms = float(options["buffer_ms"])
+        self.chunk_size = int(options["buffer_chunk_size"])
+        #: The maximum amount of bytes we keep queued.
+        self.capacity = max(int(self.byte_rate * self.buffer_ms / 1000),
+                            self.chunk_size)
+
+        self.chunks = deque()
+        #: The amount of bytes currently in :attr:`chunks`.
+        self.size = 0
+        self.condition = threading.Condition()
+        self.running = threading.Event()
+
+        stage = "buffer_" + type(pipe).__name__.lower()
+        registry = manager.metrics
+        self.metrics = registry.stage(stage)
+        registry.gauge(
+            "streamer_buffer_fill_seconds",
+            "Seconds of audio held in the buffer of a decoupled stage.",
+            {"stage": stage}, function=self.fill)
+        self.underruns = registry.counter(
+            "streamer_buffer_underruns_total",
+            "Reads on a decoupled stage that found the buffer empty.",
+            {"stage": stage})
+
+    def fill(self):
+        """Returns the amount of seconds of audio currently buffered."""
+        return float(self.size) / self.byte_rate
+
+    def run(self):
+        while self.running.is_set():
+            data = self.source.read(self.chunk_size)
+            if not data:
+                time.sleep(self.retry_timeout)
+                continue
+
+            with self.condition:
+                while self.size >= self.capacity and self.running.is_set():
+                    self.condition.wait(0.5)
+                self.chunks.append(data)
+                self.size += len(data)
+                self.condition.notify_all()
+
+    def read(self, size=4096, timeout=10.0):
+        start = self.metrics.begin()
+        with self.condition:
+            self.wait(start + timeout)
+            data = self.take(size)
+            self.condition.notify_all()
+        self.metrics.observe(len(data), time.time() - start)
+        return data
+
+    def readinto(self, buffer, timeout=10.0):
+        start = self.metrics.begin()
+        with self.condition:
+            self.wait(start + timeout)
+            size = self.take_into(buffer)
+            self.condition.notify_all()
+        self.metrics.observe(size, time.time() - start)
+        return size
+
+    def wait(self, deadline):
+        """Internal method
+
+        Waits until there is data queued or `deadline` passes. The caller
+        should hold :attr:`condition`.
+        """
+        if self.chunks:
+            return
+        self.underruns.inc()
+        while not self.chunks and self.running.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.condition.wait(remaining)
+
+    def take_into(self, buffer, size=None):
+        """Internal method
+
+        Like :meth:`take` but copies into `buffer` and returns the amount of
+        bytes copied.
+        """
+        size = len(buffer) if size is None else size
+        offset = 0
+        while offset < size and self.chunks:
+            chunk = self.chunks[0]
+            length = min(len(chunk), size - offset)
+            buffer[offset:offset + length] = memoryview(chunk)[:length]
+            if length == len(chunk):
+                self.chunks.popleft()
+            else:
+                self.chunks[0] = chunk[length:]
+            offset += length
+            self.size -= length
+        return offset
+
+    def take(self, size):
+        """Internal method
+
+        Removes at most `size` bytes from the queue and returns them. The
+        caller should hold :attr:`condition`.
+        """
+        parts = []
+        while size > 0 and self.chunks:
+            chunk = self.chunks[0]
+            if len(chunk) <= size:
+                self.chunks.popleft()
+            else:
+                self.chunks[0] = chunk[size:]
+                chunk = chunk[:size]
+            parts.append(chunk)
+            size -= len(chunk)
+            self.size -= len(chunk)
+        return b''.join(parts)
+
+    def start(self):
+        if self.running.is_set():
+            return
+        self.running.set()
+        name = "Buffer " + type(self.source).__name__
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.running.clear()
+        with self.condition:
+            self.chunks.clear()
+            self.size = 0
+            self.condition.notify_all()
+
+    def __getattr__(self, key):
+        # Make sure we don't recurse when `source` isn't set yet.
+        if key == 'source':
+            raise AttributeError("No attribute named 'source'")
+        return getattr(self.source, key)
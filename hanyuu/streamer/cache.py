@@ -0,0 +1,242 @@
+"""
+A cache of decoded audio shared by the preloaders of several stations.
+
+Stations playing from overlapping libraries end up decoding the same files,
+the :class:`DecodeCache` keeps the PCM of recently decoded files around so
+the next preloader asking for the same file gets it without decoding.
+
+Entries are keyed by the identity of the file (its real path, size and
+modification time) and the parameters of the conversion, a changed file or
+output format never returns stale audio.
+
+The :class:`BufferStore` uses the same keys for the preload buffers in use,
+a song queued twice is decoded once and both entries read from the same
+buffer.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import OrderedDict, defaultdict
+import threading
+import logging
+import os
+
+from .pcm import SAMPLE_RATE, CHANNELS, BITS_PER_SAMPLE
+from .packed import held_bytes
+
+
+logger = logging.getLogger("streamer.cache")
+
+
+def key(filename):
+    """Returns the cache key of `filename`, or None if the file can't be
+    looked at."""
+    try:
+        stat = os.stat(filename)
+    except (OSError, IOError):
+        return None
+    return (os.path.realpath(filename), stat.st_size, stat.st_mtime,
+            SAMPLE_RATE, CHANNELS, BITS_PER_SAMPLE)
+
+
+class DecodeCache(object):
+    """
+    A least recently used cache of decoded audio, bounded in bytes.
+
+    :param max_bytes: The maximum amount of bytes of audio to keep.
+    """
+    def __init__(self, max_bytes):
+        super(DecodeCache, self).__init__()
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> (data, size, owner), least recently used first
+        self.entries = OrderedDict()
+        #: The amount of bytes currently cached.
+        self.size = 0
+        # owner -> bytes cached on behalf of the owner
+        self.owned = defaultdict(int)
+        # owner -> maximum bytes cached on behalf of the owner
+        self.limits = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def station(self, name, max_bytes=None):
+        """Returns a :class:`StationCache` for the station named `name`,
+        the station can have at most `max_bytes` cached on its behalf."""
+        with self.lock:
+            self.limits[name] = max_bytes
+        return StationCache(self, name)
+
+    def get(self, key):
+        """Returns the audio cached under `key`, or None."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            # Reinsert to mark it as most recently used.
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, data, owner=None, size=None):
+        """Caches `data` under `key` on behalf of `owner`. Data that doesn't
+        fit in the cache or the quota of `owner` is not cached.
+
+        :param size: The amount of bytes `data` holds, defaults to its
+                     length.
+        """
+        size = len(data) if size is None else size
+        limit = self.limits.get(owner)
+        if size > self.max_bytes or (limit is not None and size > limit):
+            return
+
+        with self.lock:
+            self.remove(key)
+            if limit is not None:
+                # Make room in the quota from the entries of the owner.
+                for old in list(self.entries):
+                    if self.owned[owner] + size <= limit:
+                        break
+                    if self.entries[old][2] == owner:
+                        self.remove(old)
+            while self.size + size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+            self.entries[key] = (data, size, owner)
+            self.size += size
+            self.owned[owner] += size
+
+    def remove(self, key):
+        """Internal method
+
+        Removes `key` from the cache if it's there, the caller should hold
+        :attr:`lock`.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        data, size, owner = entry
+        self.size -= size
+        self.owned[owner] -= size
+
+    def clear(self, owner=None):
+        """Removes everything cached on behalf of `owner`, or everything if
+        `owner` is None."""
+        with self.lock:
+            for old, (_, _, entry_owner) in list(self.entries.items()):
+                if owner is None or entry_owner == owner:
+                    self.remove(old)
+
+
+class StationCache(object):
+    """The view of a single station on a :class:`DecodeCache`, this is what
+    the preloader gets as its `preload_cache` option."""
+    key = staticmethod(key)
+
+    def __init__(self, cache, name):
+        super(StationCache, self).__init__()
+        self.cache = cache
+        self.name = name
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def put(self, key, data, size=None):
+        self.cache.put(key, data, self.name, size)
+
+
+class SharedBuffer(object):
+    """A preload buffer in a :class:`BufferStore` and the amount of preloaded
+    files using it."""
+    def __init__(self, key):
+        super(SharedBuffer, self).__init__()
+        self.key = key
+        self.data = None
+        self.analysis = None
+        self.users = 0
+        #: True while one of the users is decoding the data.
+        self.decoding = True
+
+
+class BufferStore(object):
+    """
+    The preload buffers in use, shared by the preloaded files of the same
+    song. Each buffer counts its users and is dropped from the store when
+    the last one releases it, the buffer itself goes away with the last
+    file holding on to it.
+
+    The first user of a key decodes the buffer, later users wait for it. If
+    the decoder gives up, one of the waiting users takes over.
+    """
+    def __init__(self):
+        super(BufferStore, self).__init__()
+        self.condition = threading.Condition()
+        # key -> SharedBuffer
+        self.buffers = {}
+
+        #: The amount of times a user got a buffer decoded by another.
+        self.shared = 0
+
+    def acquire(self, key):
+        """Returns the :class:`SharedBuffer` of `key` and True if the caller
+        has to decode it. Every acquire has to be matched by a
+        :meth:`release`."""
+        with self.condition:
+            entry = self.buffers.get(key)
+            if entry is None:
+                entry = self.buffers[key] = SharedBuffer(key)
+                entry.users = 1
+                return entry, True
+            entry.users += 1
+            return entry, False
+
+    def wait(self, entry, cancelled):
+        """Waits until the data of `entry` is decoded by another user, or
+        `cancelled`, an Event, is set. Returns True if the data is there,
+        False if the caller has to decode it after all, and None if it was
+        cancelled first. Only a caller getting False decodes, and calls
+        :meth:`abandon` if it stops before the end."""
+        with self.condition:
+            while (entry.data is None and entry.decoding and
+                   not cancelled.is_set()):
+                self.condition.wait(0.5)
+            if entry.data is not None:
+                self.shared += 1
+                return True
+            if entry.decoding:
+                # Cancelled, the other user is still decoding.
+                return None
+            entry.decoding = True
+            return False
+
+    def publish(self, entry, data, analysis=None):
+        """Sets the decoded data of `entry`, the users waiting get it."""
+        with self.condition:
+            entry.data, entry.analysis = data, analysis
+            entry.decoding = False
+            self.condition.notify_all()
+
+    def abandon(self, entry):
+        """Called by the decoder of `entry` when it stopped before the end,
+        one of the users waiting takes over."""
+        with self.condition:
+            if entry.data is None:
+                entry.decoding = False
+                self.condition.notify_all()
+
+    def release(self, entry):
+        """Stops using `entry`, it's dropped after its last user."""
+        with self.condition:
+            entry.users -= 1
+            if entry.users <= 0 and self.buffers.get(entry.key) is entry:
+                del self.buffers[entry.key]
+
+    def size(self):
+        """Returns the amount of bytes held by the buffers in the store."""
+        with self.condition:
+            return sum(held_bytes(entry.data)
+                       for entry in self.buffers.values()
+                       if entry.data is not None)
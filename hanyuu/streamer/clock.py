@@ -0,0 +1,127 @@
+"""
+The playout clock, where in a track the stream is as it goes out.
+
+The 'metadata' event is sent when a file starts decoding, which is well
+before the audio of it reaches the listeners. The :class:`PlayoutClock` of
+the :class:`~hanyuu.streamer.manager.Manager` follows the audio instead:
+
+    - The :class:`~hanyuu.streamer.files.FileSource` marks the position in
+      its output where each track starts, see :meth:`PlayoutClock.mark`.
+    - The :class:`~hanyuu.streamer.underrun.UnderrunGuard` reports the fill
+      audio it inserts after those positions, see
+      :meth:`PlayoutClock.insert`.
+    - The :class:`~hanyuu.streamer.icecast.Icecast` pipe counts the audio in
+      the frames it hands to libshout, see :meth:`PlayoutClock.advance`.
+
+Once the audio sent passes a mark the track is on air, the 'track_start'
+event is emitted with its :class:`Track`. :meth:`PlayoutClock.now` returns
+the track on air and the position in it, without waiting on the pipeline.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import namedtuple, deque
+import threading
+import logging
+import time
+
+
+logger = logging.getLogger("streamer.clock")
+
+#: A track as it goes on air. `start` is the position in the stream the
+#: track starts at, `started` the wall clock time it went on air, None
+#: until then. `duration` is in seconds, None if it isn't known.
+Track = namedtuple("Track", ["filename", "metadata", "duration", "start",
+                             "started"])
+
+#: The state returned by :meth:`PlayoutClock.now`. `position` is the amount
+#: of seconds of `track` that went on air.
+Status = namedtuple("Status", ["track", "position", "duration", "started"])
+
+
+class PlayoutClock(object):
+    """
+    A clock counting the seconds of audio sent out by the sink of
+    `manager`, and the tracks starting in them.
+
+    The positions given to :meth:`mark` are in seconds of output of the
+    source, those given to :meth:`advance` are in seconds of output of the
+    sink. Both count from the start of the pipeline, the difference between
+    the two is the audio inserted in between, as told by :meth:`insert`.
+    """
+    #: The amount of seconds :meth:`now` runs ahead of the last
+    #: :meth:`advance`, the sink sends in chunks of a fraction of this.
+    max_interpolation = 1.0
+
+    def __init__(self, manager):
+        super(PlayoutClock, self).__init__()
+        self.manager = manager
+        self.lock = threading.Lock()
+        #: Tracks marked but not yet on air, in order.
+        self.pending = deque()
+        #: The seconds of audio inserted after the source, added to marks.
+        self.inserted = 0.0
+        #: The seconds of audio sent by the sink.
+        self.position = 0.0
+        #: The wall clock time :attr:`position` was reached.
+        self.updated = None
+        #: The :class:`Track` on air, or None.
+        self.track = None
+
+    def mark(self, position, filename, metadata=None, duration=None):
+        """Called by the source when a track starts at `position` seconds
+        of its output."""
+        with self.lock:
+            self.pending.append(Track(filename, metadata, duration,
+                                      position + self.inserted, None))
+
+    def insert(self, position, seconds):
+        """Called when `seconds` of audio are inserted at `position` seconds
+        of the output of the source, tracks marked after it air later."""
+        with self.lock:
+            # Where the insert goes in the output of the sink.
+            position += self.inserted
+            self.inserted += seconds
+            self.pending = deque(
+                track._replace(start=track.start + seconds)
+                if track.start >= position else track
+                for track in self.pending)
+
+    def advance(self, seconds, now=None):
+        """Called by the sink after `seconds` of audio went out. Emits the
+        'track_start' event for the tracks that started in them."""
+        now = time.time() if now is None else now
+        started = []
+        with self.lock:
+            self.position += seconds
+            self.updated = now
+            while self.pending and self.pending[0].start <= self.position:
+                track = self.pending.popleft()
+                track = track._replace(
+                    started=now - (self.position - track.start))
+                self.track = track
+                started.append(track)
+
+        for track in started:
+            logger.debug("Track on air: %s", track.metadata or
+                         track.filename)
+            self.manager.emit("track_start", track)
+
+    def now(self, now=None):
+        """Returns the :class:`Status` of the track on air, or None if no
+        track is."""
+        now = time.time() if now is None else now
+        with self.lock:
+            track = self.track
+            if track is None:
+                return None
+            # The sink sends ahead of the listeners by a chunk at most,
+            # between sends the position moves along with the wall clock.
+            ahead = min(max(now - self.updated, 0.0), self.max_interpolation)
+            if self.pending:
+                ahead = min(ahead, self.pending[0].start - self.position)
+            position = self.position + ahead - track.start
+        if track.duration is not None:
+            position = min(position, track.duration)
+        return Status(track, position, track.duration, track.started)
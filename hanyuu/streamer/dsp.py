@@ -0,0 +1,184 @@
+"""
+Signal processing on the PCM produced by :mod:`hanyuu.streamer.files`.
+
+The work is done with vectorized numpy operations on whole chunks of audio.
+numpy is an optional dependency, use :func:`available` to check for it; the
+features built on this module are disabled without it.
+
+The preloader runs an :class:`Analyzer` over the audio while decoding it,
+the resulting :class:`Analysis` is kept next to the preload buffer. It holds
+where the audio starts and ends after trimming digital silence, and an RMS
+envelope used to decide on crossfades without looking at the audio again.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import namedtuple
+import logging
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .pcm import SAMPLE_RATE, CHANNELS, BITS_PER_SAMPLE, BLOCK_ALIGN
+
+
+logger = logging.getLogger("streamer.dsp")
+
+#: The largest sample value.
+FULL_SCALE = 2 ** (BITS_PER_SAMPLE - 1)
+
+#: The result of an :class:`Analyzer`.
+#:
+#: `start` and `end` are the byte offsets of the first frame and the frame
+#: after the last one that aren't silent. `envelope` holds the RMS level in
+#: dBFS of each block of `block_size` bytes.
+Analysis = namedtuple("Analysis", ("start", "end", "envelope", "block_size"))
+
+
+def available():
+    """Returns True if numpy is installed."""
+    return numpy is not None
+
+
+def to_samples(data):
+    """Returns the PCM in `data` as an int32 array of (frames, channels)."""
+    raw = numpy.frombuffer(data, dtype=numpy.uint8)
+    raw = raw[:len(raw) - len(raw) % BLOCK_ALIGN].reshape(-1, 3)
+    raw = raw.astype(numpy.int32)
+    samples = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+    # Sign extend the 24-bit values.
+    samples = (samples << 8) >> 8
+    return samples.reshape(-1, CHANNELS)
+
+
+def from_samples(samples):
+    """Returns `samples`, an array of any shape, as PCM bytes. Values are
+    rounded and clipped to the sample range."""
+    samples = numpy.clip(numpy.round(samples), -FULL_SCALE, FULL_SCALE - 1)
+    samples = samples.astype("<i4").reshape(-1, 1)
+    return samples.view(numpy.uint8)[:, :3].tobytes()
+
+
+def to_db(value):
+    """Returns the sample value `value` in dBFS."""
+    return 20 * numpy.log10(numpy.maximum(value, 1.0) / FULL_SCALE)
+
+
+class Analyzer(object):
+    """
+    Analyzes PCM fed to it in chunks, in a single pass.
+
+    :param threshold_db: Frames of which all channels are below this level
+                         are considered silent.
+    :param block_seconds: The length of a block of the envelope.
+    """
+    def __init__(self, threshold_db=-60.0, block_seconds=0.1):
+        super(Analyzer, self).__init__()
+        self.threshold = FULL_SCALE * 10 ** (threshold_db / 20.0)
+        self.block_frames = max(int(SAMPLE_RATE * block_seconds), 1)
+
+        #: The amount of frames fed so far.
+        self.frames = 0
+        self.first = None
+        self.last = None
+        # Squared means of the frames not making up a full block yet.
+        self.pending = numpy.zeros(0)
+        self.blocks = []
+
+    def feed(self, data):
+        samples = to_samples(data)
+        if not len(samples):
+            return
+
+        loud = numpy.flatnonzero(
+            numpy.abs(samples).max(axis=1) > self.threshold)
+        if len(loud):
+            if self.first is None:
+                self.first = self.frames + loud[0]
+            self.last = self.frames + loud[-1]
+        self.frames += len(samples)
+
+        squares = (samples.astype(numpy.float64) ** 2).mean(axis=1)
+        squares = numpy.concatenate((self.pending, squares))
+        full = len(squares) - len(squares) % self.block_frames
+        if full:
+            blocks = squares[:full].reshape(-1, self.block_frames)
+            self.blocks.append(to_db(numpy.sqrt(blocks.mean(axis=1))))
+        self.pending = squares[full:]
+
+    def result(self):
+        """Returns the :class:`Analysis` of everything fed so far."""
+        blocks = list(self.blocks)
+        if len(self.pending):
+            blocks.append(to_db(numpy.sqrt(self.pending.mean(keepdims=True))))
+        envelope = (numpy.concatenate(blocks) if blocks
+                    else numpy.zeros(0, dtype=numpy.float64))
+
+        if self.first is None:
+            # Nothing but silence, don't trim it all away.
+            start, end = 0, self.frames
+        else:
+            start, end = self.first, self.last + 1
+        return Analysis(start * BLOCK_ALIGN, end * BLOCK_ALIGN,
+                        envelope.astype(numpy.float32),
+                        self.block_frames * BLOCK_ALIGN)
+
+
+def tail_level(analysis, size):
+    """Returns the highest level in dBFS of the envelope over the last
+    `size` bytes before the end of `analysis`."""
+    end = int(math.ceil(float(analysis.end) / analysis.block_size))
+    start = max(analysis.end - size, 0) // analysis.block_size
+    levels = analysis.envelope[start:max(end, start + 1)]
+    if not len(levels):
+        return -numpy.inf
+    return float(levels.max())
+
+
+def crossfade(tail, head):
+    """
+    Mixes the end of one track into the start of another, with an equal
+    power curve.
+
+    :param tail: The last bytes of the track fading out.
+    :param head: The first bytes of the track fading in, it's padded with
+                 silence if shorter than `tail`.
+    :returns: The mixed PCM, as long as `tail`.
+    """
+    length = len(tail) // BLOCK_ALIGN
+    return mix(tail, head, 0, length, length)
+
+
+def mix(tail, head, position, length, frames):
+    """
+    Mixes part of a crossfade, for crossfades done a chunk at a time.
+
+    :param tail: PCM fading out.
+    :param head: PCM fading in.
+    :param position: The frame of the crossfade the chunks start at.
+    :param length: The amount of frames of the whole crossfade, the curve
+                   stays at the end past it.
+    :param frames: The amount of frames of the result, `tail` and `head` are
+                   cut or padded with silence to it.
+    :returns: The mixed PCM.
+    """
+    tail = fit(to_samples(tail).astype(numpy.float64), frames)
+    head = fit(to_samples(head).astype(numpy.float64), frames)
+
+    position = (numpy.arange(position, position + frames) + 0.5)
+    position = numpy.minimum(position / max(length, 1), 1.0)
+    angle = (position * (numpy.pi / 2))[:, numpy.newaxis]
+    return from_samples(tail * numpy.cos(angle) + head * numpy.sin(angle))
+
+
+def fit(samples, frames):
+    """Returns `samples` cut or padded with silence to `frames` frames."""
+    samples = samples[:frames]
+    if len(samples) < frames:
+        samples = numpy.concatenate(
+            (samples, numpy.zeros((frames - len(samples), CHANNELS))))
+    return samples
@@ -3,15 +3,20 @@ A very simple encoder module.
 
 The encoders currently supported are listed below:
 
-    - LAME MP3 encoder
+    - LAME MP3 encoder, as a binary or the library
+    - Opus in Ogg, with the opusenc binary
 
-Other formats would require a rework of this module to be more generic.
+Encoders other than the LAME binary are backends, see
+:mod:`hanyuu.streamer.backends`.
 """
 from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import absolute_import
 
+from .switch import SourceSwitch
 from . import garbage
+from . import pool
+from . import backends
 
 import subprocess
 import threading
@@ -42,7 +47,14 @@ class Encoder(object):
     """
     options = {
         'lame_settings': ['--cbr', '-b', '192', '--resample', '44.1'],
+        'lame_binary': None,
+        'encoder_backend': 'process',
+        'opus_settings': ['--bitrate', '64'],
+        'opus_binary': None,
+        'switch_fade_seconds': 0.0,
     }
+    #: The output of this pipe can be decoupled with a buffer.
+    decouple = True
 
     def __init__(self, manager, pipe, options):
         """
@@ -71,7 +83,7 @@ class Encoder(object):
         Options
         =======
 
-        The options available for the :class:`Encoder` is a single one named
+        The main option available for the :class:`Encoder` is the one named
         'lame_settings'. This is a list of arguments to pass to the underlying
         LAME encoder binary.
 
@@ -86,6 +98,22 @@ class Encoder(object):
             The 'joint stereo' flag is implicitly set inside the class and
             can't be changed through the :obj:`lame_settings`.
 
+        The binary used can be changed with the 'lame_binary' option, it
+        defaults to :const:`LAME_BIN`.
+
+        The 'encoder_backend' option picks how we encode, 'process' runs the
+        LAME binary, the other backends are listed in
+        :mod:`hanyuu.streamer.backends`. When the 'library' backend can't be
+        loaded or doesn't understand the 'lame_settings' the binary is used
+        instead. It defaults to 'process'.
+
+        The 'opus' backend uses the 'opus_settings' and 'opus_binary'
+        options instead, see :class:`~hanyuu.streamer.backends.Opus`.
+
+        The source can be replaced with :meth:`switch_source` while we
+        encode, the 'switch_fade_seconds' option is the amount of seconds
+        the old source fades out over the new one by default, see
+        :mod:`hanyuu.streamer.switch`. It defaults to 0.0, a cut.
 
         ========
         Events
@@ -111,21 +139,61 @@ class Encoder(object):
                 is called **AFTER** the instance is created.
 
                 :param encoder: :class:`Encoder` instance.
+            - encoder_switch((encoder, source)):
+                Called when a source passed to :meth:`switch_source` takes
+                over.
+
+                :param encoder: :class:`Encoder` instance.
+                :param source: The new source.
         """
         super(Encoder, self).__init__()
         self.alive = threading.Event()
 
         self.manager = manager
-        self.source = pipe
+        #: Shared by all our instances, so a switch outlives restarts.
+        self.source = SourceSwitch(pipe, on_switch=self.switched)
+        self.fade_seconds = float(options.get('switch_fade_seconds') or 0.0)
 
         #: The settings for encoding to pass to lame as a list.
         self.settings = options['lame_settings']
+        #: The LAME binary to run.
+        self.binary = options.get('lame_binary') or LAME_BIN
+        #: 'process' or a key of :data:`backends.BACKENDS`.
+        self.backend = options.get('encoder_backend') or 'process'
+        self.options = options
 
         # This is an implicit 'joint stereo' setting for lame.
         self.mode = 'j'
 
         self.out_file = '-'
 
+        registry = manager.metrics
+        self.metrics = registry.stage("encoder")
+        self.write_metrics = registry.histogram(
+            "streamer_encoder_write_seconds",
+            "Latency of writes of PCM into the encoder.")
+        self.restarts = registry.counter(
+            "streamer_encoder_restarts_total",
+            "Encoder instances that were replaced by a new one.")
+
+    @property
+    def byte_rate(self):
+        """
+        The amount of encoded bytes we output for each second of audio. This
+        is calculated from the bitrate in the settings of the backend, for
+        LAME it defaults to 192kbps when no bitrate is given.
+        """
+        backend = backends.BACKENDS.get(self.backend)
+        if backend is None:
+            return backends.lame_bitrate(self.settings) * 1000 // 8
+        return backend.bitrate(self.options) * 1000 // 8
+
+    @property
+    def format(self):
+        """The libshout format of our output."""
+        backend = backends.BACKENDS.get(self.backend)
+        return backends.FORMAT_MP3 if backend is None else backend.format
+
     def start(self):
         """
         This clears our `alive` flag and starts a new :class:`EncoderInstance`
@@ -157,6 +225,32 @@ class Encoder(object):
         # calling `close` which would create a short time without encoder.
         self.report_close()
 
+    def recover(self):
+        """Called by the :class:`~hanyuu.streamer.watchdog.Watchdog` when we
+        stalled, restarts the encoder."""
+        self.restart()
+
+    def switch_source(self, new_source, fade_seconds=None):
+        """
+        Replaces our source without stopping the encoder, at the next frame
+        boundary of the PCM we read. The old source fades out over
+        `fade_seconds`, by default the 'switch_fade_seconds' option.
+
+        The new source should return PCM at the same sample rate and bits
+        per sample as the old one, the encoder isn't restarted for it.
+        """
+        if fade_seconds is None:
+            fade_seconds = self.fade_seconds
+        self.source.switch(new_source, fade_seconds)
+
+    def switched(self, old, new):
+        """Internal method
+
+        Called by our :class:`~hanyuu.streamer.switch.SourceSwitch` once
+        `new` took over.
+        """
+        self.manager.emit("encoder_switch", (self, new))
+
     def report_close(self):
         """
         This method is called by the :class:`EncoderInstance` class when it
@@ -169,8 +263,9 @@ class Encoder(object):
         """
         if not self.alive.is_set():
             self.manager.emit("encoder_restart_before", self)
+            self.restarts.inc()
 
-            GarbageInstance(self.instance)
+            self.instance.discard()
             self.start_instance()
 
             self.manager.emit("encoder_restart_after", self)
@@ -189,10 +284,28 @@ class Encoder(object):
         """
         # Don't assign it to the instance directly because that would allow
         # a different thread to accidently touch a non-started instance
-        new = EncoderInstance(self)
+        new = None
+        if self.backend != 'process':
+            try:
+                new = BackendInstance(self, backends.BACKENDS[self.backend])
+            except backends.BackendError as err:
+                if self.backend != 'library':
+                    raise
+                logger.warning("Can't encode with libmp3lame, using the "
+                               "binary instead: %s", err)
+                self.backend = 'process'
+        if new is None:
+            new = EncoderInstance(self)
         new.start()
         self.instance = new
 
+    def readinto(self, buffer, timeout=10.0):
+        """
+        Reads encoded data into `buffer` from the current
+        :class:`EncoderInstance`, see :func:`hanyuu.streamer.pool.readinto`.
+        """
+        return self.instance.readinto(buffer, timeout)
+
     def __getattr__(self, key):
         """
         We are passed along as a source through the audio pipeline. This means
@@ -226,29 +339,44 @@ class EncoderInstance(object):
         super(EncoderInstance, self).__init__()
         self.encoder_manager = encoder_manager
 
-        for key in ['source', 'settings', 'mode', 'out_file']:
+        for key in ['source', 'settings', 'binary', 'mode', 'out_file',
+                    'metrics', 'write_metrics']:
             setattr(self, key, getattr(self.encoder_manager, key))
 
         self.running = threading.Event()
 
+    @property
+    def frame_duration(self):
+        return backends.lame_frame_duration(self.settings,
+                                            self.source.sample_rate)
+
     def run(self):
+        buffers = self.encoder_manager.manager.buffers
+        buffer = buffers.acquire()
+        view = memoryview(buffer)
         while not self.running.is_set():
-            data = self.source.read()
-            if data == b'':
+            size = pool.readinto(self.source, buffer)
+            if size == 0:
                 # EOF we just sleep and wait for a new source
                 time.sleep(0.3)
-            self.write(data)
+                continue
+            self.write(view[:size])
+        del view
+        buffers.release(buffer)
         try:
             self.process.stdin.close()
             self.process.stdout.close()
             self.process.wait()
         except:
             logger.exception("Failed to cleanly shutdown encoder.")
+        # We are most likely registered as garbage by now, let the collector
+        # know it doesn't have to wait for us anymore.
+        garbage.Collector().wakeup(self)
 
     def start(self):
         self.running.clear()
         arguments = [
-            LAME_BIN, '--quiet',
+            self.binary, '--quiet',
             '--flush',
             '-r',
             '-s', str(decimal.Decimal(self.source.sample_rate) / 1000),
@@ -271,12 +399,14 @@ class EncoderInstance(object):
         self.thread.daemon = True
         self.thread.start()
 
-    def switch_source(self, new_source):
-        self.source = new_source
+    def switch_source(self, new_source, fade_seconds=None):
+        self.encoder_manager.switch_source(new_source, fade_seconds)
 
     def write(self, data):
+        start = time.time()
         try:
             self.process.stdin.write(data)
+            self.write_metrics.observe(time.time() - start)
         except (IOError, ValueError) as err:
             logger.exception("Write failed, restarting encoder.")
             self.close()
@@ -287,15 +417,151 @@ class EncoderInstance(object):
             raise err
 
     def read(self, size=4096, timeout=10.0):
+        start = self.metrics.begin()
         reader, writer, error = select.select([self.process.stdout],
                                               [], [], timeout)
-        if not reader:
-            return b''
-        return reader[0].read(size)
+        data = reader[0].read(size) if reader else b''
+        self.metrics.observe(len(data), time.time() - start)
+        return data
+
+    def readinto(self, buffer, timeout=10.0):
+        start = self.metrics.begin()
+        reader, writer, error = select.select([self.process.stdout],
+                                              [], [], timeout)
+        size = reader[0].readinto(buffer) if reader else 0
+        self.metrics.observe(size, time.time() - start)
+        return size
+
+    def close(self):
+        self.running.set()
+        self.encoder_manager.report_close()
+
+    def discard(self):
+        """Called after a restart replaced us, registers us for garbage
+        collection."""
+        GarbageInstance(self)
+
+
+class BackendInstance(object):
+    """
+    An encoder instance encoding with a backend from
+    :mod:`hanyuu.streamer.backends`.
+
+    There is no feeder thread, each read pulls PCM from the source into a
+    buffer and hands it to the backend right there. Encoded data that doesn't
+    fit in the buffer of the reader is kept for the next read. When the
+    backend fails it's restarted once, after that the encoder replaces us.
+
+    .. note::
+        This class is used internally and should never be instantiated
+        directly by the user.
+    """
+    #: The amount of PCM frames encoded per read from the source.
+    frames_per_read = 4608
+
+    def __init__(self, encoder_manager, backend):
+        super(BackendInstance, self).__init__()
+        self.encoder_manager = encoder_manager
+
+        for key in ['source', 'options', 'metrics', 'write_metrics']:
+            setattr(self, key, getattr(self.encoder_manager, key))
+
+        self.backend = backend(self.options, self.source.sample_rate,
+                               self.source.bits_per_sample)
+        self.backend.start()
+        self.pcm = bytearray(self.frames_per_read * 2 *
+                             self.source.bits_per_sample // 8)
+        self.pending = b''
+        self.offset = 0
+        # Reentrant, a failed encode closes us while holding it.
+        self.lock = threading.RLock()
+        self.running = threading.Event()
+
+    @property
+    def frame_duration(self):
+        return self.backend.frame_duration
+
+    def start(self):
+        self.running.clear()
+
+    def switch_source(self, new_source, fade_seconds=None):
+        self.encoder_manager.switch_source(new_source, fade_seconds)
+
+    def read(self, size=4096, timeout=10.0):
+        buffer = bytearray(size)
+        size = self.readinto(buffer, timeout)
+        return bytes(buffer[:size])
+
+    def readinto(self, buffer, timeout=10.0):
+        start = self.metrics.begin()
+        with self.lock:
+            if self.offset >= len(self.pending) and not self.encode(timeout):
+                self.metrics.observe(0, time.time() - start)
+                return 0
+            size = min(len(buffer), len(self.pending) - self.offset)
+            buffer[:size] = memoryview(self.pending)[self.offset:
+                                                     self.offset + size]
+            self.offset += size
+        self.metrics.observe(size, time.time() - start)
+        return size
+
+    def encode(self, timeout):
+        """Internal method
+
+        Reads and encodes PCM until there is encoded data, or `timeout`
+        passes. Returns False if there is no encoded data.
+        """
+        deadline = time.time() + timeout
+        while not self.running.is_set():
+            size = pool.readinto(self.source, self.pcm, timeout)
+            if size == 0:
+                # EOF we wait for a new source, like the binary does.
+                if time.time() + 0.3 > deadline:
+                    return False
+                time.sleep(0.3)
+                continue
+            start = time.time()
+            try:
+                self.pending = self.encode_once(size)
+            except backends.BackendError:
+                logger.exception("Encoding failed, restarting encoder.")
+                self.close()
+                return False
+            self.write_metrics.observe(time.time() - start)
+            self.offset = 0
+            if self.pending:
+                return True
+            # The encoder holds on to the first few frames.
+            if time.time() > deadline:
+                return False
+        return False
+
+    def encode_once(self, size):
+        """Internal method
+
+        Encodes `size` bytes of :attr:`pcm`, restarting the backend and
+        trying again once if it fails.
+        """
+        try:
+            return self.backend.encode(self.pcm, size)
+        except backends.BackendError:
+            logger.exception("Encoding failed, restarting backend.")
+        self.backend.restart()
+        return self.backend.encode(self.pcm, size)
 
     def close(self):
+        if self.running.is_set():
+            return
         self.running.set()
         self.encoder_manager.report_close()
+        if self.encoder_manager.alive.is_set():
+            # Closed for good, there won't be a restart to discard us.
+            self.discard()
+
+    def discard(self):
+        """Called after a restart replaced us, nothing is running."""
+        with self.lock:
+            self.backend.close()
 
 
 # TODO: Document GarbageInstance properly.
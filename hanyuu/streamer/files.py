@@ -5,10 +5,16 @@ from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import absolute_import
 
+import functools
 import threading
 import logging
+import weakref
+import time
 
 from . import garbage
+# The PCM format every AudioFile is converted to, kept here as well.
+from .pcm import SAMPLE_RATE, CHANNELS, BITS_PER_SAMPLE, BLOCK_ALIGN
+from .pcm import BYTE_RATE
 import audiotools
 
 
@@ -20,32 +26,122 @@ class AudioError(Exception):
     pass
 
 
+def close_reader(reader):
+    """Closes an audiotools reader and reaps any decoder processes that
+    have exited."""
+    try:
+        reader.close()
+    except (audiotools.DecodingError):
+        pass
+    # Hack to kill zombies below
+    import gc
+    import subprocess
+
+    try:
+        [item.poll() for item in gc.get_referrers(subprocess.Popen)
+         if isinstance(item, subprocess.Popen)]
+    except:
+        logger.warning("Exception occured in hack.")
+    # Hack to kill zombies above
+
+
+def weak_progress(audiofile):
+    """Returns a progress function calling the `progress` method of
+    `audiofile`, without keeping `audiofile` alive."""
+    reference = weakref.ref(audiofile)
+
+    def progress(current, total):
+        audiofile = reference()
+        if audiofile is not None:
+            audiofile.progress(current, total)
+    return progress
+
+
 class GarbageAudioFile(garbage.Garbage):
     """Garbage class of the AudioFile class"""
     def collect(self):
         """Tries to close the AudioFile resources when called."""
-        try:
-            self.item._reader.close()
-        except (audiotools.DecodingError):
-            pass
-        # Hack to kill zombies below
-        import gc
-        import subprocess
-
-        try:
-            [item.poll() for item in gc.get_referrers(subprocess.Popen)
-             if isinstance(item, subprocess.Popen)]
-        except:
-            logger.warning("Exception occured in hack.")
-        # Hack to kill zombies above
+        close_reader(self.item._reader)
 
         del self.item._reader
 
         return True
 
+    def held_bytes(self):
+        """Returns the size of the preload buffer, if any."""
+        from .packed import held_bytes
+        return held_bytes(self.item.__dict__.get("buffer") or b'')
+
 
 # TODO: Add handler hooks.
 class FileSource(object):
+    """
+    =======
+    Options
+    =======
+
+        - eof_on_empty:
+            If true we close ourself when there is no new file to be had,
+            otherwise we return empty reads and keep asking for a new file.
+            (defaults to True)
+        - gapless_head_seconds:
+            The amount of seconds of the next file that are decoded before
+            the current file ends. Reads are always a whole amount of PCM
+            frames, and continue into the next file within the same read.
+            (defaults to 3.0)
+        - crossfade_seconds:
+            The length of the crossfade between two files, 0 disables
+            crossfading. Only files that know how much audio they have left
+            are faded out, see
+            :class:`~hanyuu.streamer.preloader.PreloadedAudioFile`. Requires
+            numpy, see :mod:`hanyuu.streamer.dsp`.
+            (defaults to 0.0)
+        - crossfade_quiet_db:
+            Files that are already below this level in dBFS at the start of
+            the crossfade, because they fade out by themselves, aren't
+            crossfaded.
+            (defaults to -40.0)
+        - loudness_cache:
+            The filename of a :class:`~hanyuu.streamer.loudness.LoudnessCache`
+            database, songs found in it are normalized to `loudness_target`.
+            Requires numpy, see :mod:`hanyuu.streamer.loudness`.
+            (defaults to None, disabled)
+        - loudness_target:
+            The loudness in LUFS to normalize to.
+            (defaults to -18.0)
+        - loudness_max_gain:
+            The maximum gain in dB applied to quiet songs.
+            (defaults to 12.0)
+        - limiter_ceiling_db:
+            The level in dBFS the limiter after the gain keeps peaks under.
+            (defaults to -1.0)
+
+    The start of each file in our output is marked on the playout clock of
+    the manager, see :mod:`hanyuu.streamer.clock`.
+    """
+    options = {
+        "eof_on_empty": True,
+        "gapless_head_seconds": 3.0,
+        "crossfade_seconds": 0.0,
+        "crossfade_quiet_db": -40.0,
+        "loudness_cache": None,
+        "loudness_target": -18.0,
+        "loudness_max_gain": 12.0,
+        "limiter_ceiling_db": -1.0,
+    }
+    #: The amount of seconds to wait before asking an empty source again.
+    retry_timeout = 0.5
+    #: The output of this pipe can be decoupled with a buffer.
+    decouple = True
+    #: The amount of bytes of PCM we return for each second of audio.
+    byte_rate = BYTE_RATE
+    #: The size in bytes of a single PCM frame we return.
+    block_align = BLOCK_ALIGN
+    #: The format of the PCM we return, the same for every file.
+    sample_rate = SAMPLE_RATE
+    bits_per_sample = BITS_PER_SAMPLE
+    channels = CHANNELS
+
     def __init__(self, manager, pipe, options):
         super(FileSource, self).__init__()
         self.manager = manager
@@ -66,69 +162,286 @@ class FileSource(object):
             self.channel = self.manager.register("audiofile")
 
         self.options = options
+        self.eof_on_empty = options.get("eof_on_empty", True)
+        #: The amount of bytes decoded ahead of the next file.
+        head_seconds = float(options.get("gapless_head_seconds", 3.0))
+        self.head_size = int(head_seconds * SAMPLE_RATE) * BLOCK_ALIGN
+
+        self.dsp = None
+        fade_seconds = float(options.get("crossfade_seconds", 0.0))
+        #: The amount of bytes to crossfade, 0 if disabled.
+        self.crossfade_size = int(fade_seconds * SAMPLE_RATE) * BLOCK_ALIGN
+        self.crossfade_quiet_db = float(options.get("crossfade_quiet_db",
+                                                    -40.0))
+        if self.crossfade_size:
+            from . import dsp
+            if dsp.available():
+                self.dsp = dsp
+            else:
+                logger.warning("Crossfading requires numpy, disabled.")
+                self.crossfade_size = 0
+
+        self.normalizer = None
+        if options.get("loudness_cache"):
+            from . import loudness
+            if loudness.numpy is not None:
+                self.normalizer = loudness.Normalizer(
+                    loudness.LoudnessCache(options["loudness_cache"]),
+                    float(options.get("loudness_target", -18.0)),
+                    float(options.get("loudness_max_gain", 12.0)),
+                    float(options.get("limiter_ceiling_db", -1.0)))
+            else:
+                logger.warning("Loudness normalization requires numpy, "
+                               "disabled.")
+
+        # A crossfade is never longer than the head of the next file.
+        self.head_size = max(self.head_size, self.crossfade_size)
 
         self.eof = threading.Event()
+        #: Set to skip the rest of the current file, see :meth:`recover`.
+        self.skip = threading.Event()
+
+        #: The next file, a :class:`Prefetched`, or None.
+        self.upcoming = None
+        #: True if the source had no new file the last time we asked.
+        self.exhausted = False
+        #: The amount of bytes we returned so far.
+        self.delivered = 0
+        self.condition = threading.Condition()
+
+        self.metrics = manager.metrics.stage("file_source")
+        self.failures = manager.metrics.counter(
+            "streamer_file_failures_total",
+            "Files that could not be opened by the file source.")
 
     def audiofile_processor(self):
         return self.channel.get()
 
     def filename_processor(self):
-        filename = self.manager.source()
-
-        if filename is None:
-            return
-
-        try:
-            audiofile = AudioFile(filename)
-        except (AudioError):
-            logger.exception("Unsupported file.")
-            return self.filename_processor()
-        except (IOError):
-            logger.exception("Failed opening file.")
-            return self.filename_processor()
-        else:
-            return audiofile
+        # Keep asking for files until we get one we can open, or the
+        # source runs out.
+        while True:
+            filename = self.manager.source()
+
+            if filename is None:
+                return
+
+            try:
+                return AudioFile(filename)
+            except (AudioError):
+                logger.exception("Unsupported file.")
+            except (IOError):
+                logger.exception("Failed opening file.")
+            self.failures.inc()
 
     def processor(self):
         pass
 
     def read(self, size=4096, timeout=10.0):
-        if self.eof.is_set():
-            return b''
+        buffer = bytearray(max(size - size % self.block_align,
+                               self.block_align))
+        size = self.readinto(buffer, timeout)
+        return bytes(buffer[:size])
+
+    def readinto(self, buffer, timeout=10.0):
+        start = self.metrics.begin()
+        size = len(buffer) - len(buffer) % self.block_align
+        size = self.pull(memoryview(buffer), size, timeout)
+        self.metrics.observe(size, time.time() - start)
+        return size
+
+    def pull(self, view, size, timeout):
+        """Internal method
+
+        Decodes into `view` until `size` bytes are read, moving on to the
+        next file each time the current one runs out. The next file is
+        already partly decoded, so the switch happens within the same call
+        and the returned data continues at the first sample of the next
+        file.
+
+        :returns: The amount of bytes read.
+        """
+        offset = 0
+        while offset < size and not self.eof.is_set():
+            if self.skip.is_set() and self.audiofile is not None:
+                logger.warning("Skipping the rest of %s",
+                               self.audiofile.filename)
+                self.audiofile.close()
+                self.audiofile = None
+            self.skip.clear()
+            # We either don't have a file yet, or just reached the
+            # end of a file and need a new one. Only wait for it if we
+            # have nothing to return yet.
+            if self.audiofile is None:
+                self.audiofile = self.next_file(timeout if offset == 0
+                                                else 0.0)
+                if self.audiofile is None:
+                    break
+                self.audiofile.announce()
+                self.mark(offset)
+            elif self.crossfade_size and self.crossfade():
+                self.mark(offset)
+
+            try:
+                length = self.audiofile.decode_into(view[offset:size])
+            except (ValueError) as err:
+                # A ValueError means a localized frame error, we return
+                # what we have, and hope the next frame is correct.
+                break
+            except (AttributeError, IOError) as err:
+                # If either of the two exceptions happen it's an
+                # unrecoverable error and we will want to stop with the
+                # current file.
+                length = 0
+
+            if length == 0:
+                self.audiofile.close()
+                self.audiofile = None
+            offset += length
+        self.delivered += offset
+        return offset
+
+    def mark(self, offset):
+        """Internal method
+
+        Marks the start of the current file, `offset` bytes into the current
+        read, on the playout clock.
+        """
+        audiofile = self.audiofile
+        remaining = audiofile.remaining()
+        if remaining is not None:
+            duration = float(remaining) / BYTE_RATE
+        else:
+            duration = getattr(audiofile, "duration", None)
+        self.manager.clock.mark(float(self.delivered + offset) / BYTE_RATE,
+                                audiofile.filename,
+                                getattr(audiofile, "metadata", None),
+                                duration)
+
+    def crossfade(self):
+        """Internal method
+
+        Mixes the rest of the current file with the start of the next one
+        once the current file is within `crossfade_seconds` of its end, the
+        mix then continues as the next file.
+
+        :returns: True if the next file started.
+        """
+        remaining = self.audiofile.remaining()
+        if remaining is None or remaining > self.crossfade_size:
+            return False
+        analysis = getattr(self.audiofile, "analysis", None)
+        if (remaining == 0 or analysis is not None and
+                self.dsp.tail_level(analysis, remaining) <
+                self.crossfade_quiet_db):
+            return False
+
+        upcoming = self.next_file(0.0)
+        if upcoming is None:
+            return False
+
+        tail = bytearray(remaining)
+        length = 0
+        while length < remaining:
+            read = self.audiofile.decode_into(memoryview(tail)[length:])
+            if read == 0:
+                break
+            length += read
+        head = bytearray(length)
+        upcoming.decode_into(head)
+
+        mixed = self.dsp.crossfade(bytes(tail[:length]), bytes(head))
+        logger.debug("Crossfading %d bytes into the next file.", length)
+        self.audiofile.close()
+        upcoming.announce()
+        self.audiofile = Prefetched(upcoming, head=mixed)
+        return True
+
+    def recover(self):
+        """Called by the :class:`~hanyuu.streamer.watchdog.Watchdog` when we
+        stalled, skips the rest of the current file. This happens on the
+        next read, a decoder stuck in a read can't be interrupted."""
+        self.skip.set()
+
+    def starved(self):
+        """Used by the :class:`~hanyuu.streamer.watchdog.Watchdog`, returns
+        True if we have no file to play because the source has none."""
+        return self.audiofile is None and self.exhausted
+
+    def next_file(self, timeout):
+        """Internal method
+
+        Returns the prefetched next file, waiting at most `timeout` seconds
+        for it. Returns None if there is none.
+        """
+        with self.condition:
+            deadline = time.time() + timeout
+            while self.upcoming is None and not self.eof.is_set():
+                if self.exhausted:
+                    if self.eof_on_empty:
+                        self.eof.set()
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            upcoming, self.upcoming = self.upcoming, None
+            self.condition.notify_all()
+        return upcoming
+
+    def prefetch(self):
+        """Internal method
+
+        Runs in its own thread, keeps the next file and its first
+        `gapless_head_seconds` of audio ready.
+        """
+        while not self.eof.is_set():
+            with self.condition:
+                while self.upcoming is not None and not self.eof.is_set():
+                    self.condition.wait(0.5)
+            if self.eof.is_set():
+                break
 
-        # We either don't have a file yet, or just reached the
-        # end of a file and need a new one. Go fetch one.
-        if self.audiofile is None:
             new = self.processor()
             if new is None:
-                self.close()
-                return b''
-            else:
-                self.audiofile = new
-
-        try:
-            data = self.audiofile.read(size, timeout)
-        except (ValueError) as err:
-            # A ValueError means a localized frame error, we return an empty
-            # byte string, and hope the next frame is correct.
-            return b''
-        except (AttributeError, IOError) as err:
-            # If either of the two exceptions happen it's an unrecoverable
-            # error and we will want to stop with the current file.
-            data = b''
-
-        if data == b'':
-            self.audiofile.close()
-            self.audiofile = None
-            return self.read(size, timeout)
-        return data
+                with self.condition:
+                    self.exhausted = True
+                    self.condition.notify_all()
+                if self.eof_on_empty:
+                    break
+                time.sleep(self.retry_timeout)
+                continue
+
+            process = None
+            if self.normalizer is not None:
+                gain = self.normalizer.gain(new.filename)
+                if gain is not None:
+                    process = functools.partial(self.normalizer.apply,
+                                                gain=gain)
+            upcoming = Prefetched(new, self.head_size, process=process)
+            with self.condition:
+                self.exhausted = False
+                if self.eof.is_set():
+                    upcoming.close()
+                    break
+                self.upcoming = upcoming
+                self.condition.notify_all()
 
     def start(self):
         self.eof.clear()
-        self.audiofile = self.processor()
+        self.exhausted = False
+        self.thread = threading.Thread(target=self.prefetch,
+                                       name="File Source Prefetch")
+        self.thread.daemon = True
+        self.thread.start()
 
     def close(self):
-        self.eof.set()
+        with self.condition:
+            self.eof.set()
+            if self.upcoming is not None:
+                self.upcoming.close()
+                self.upcoming = None
+            self.condition.notify_all()
 
     def __getattr__(self, key):
         return getattr(self.audiofile, key)
@@ -143,18 +456,70 @@ class AudioFile(object):
         super(AudioFile, self).__init__()
         self._reader = self._open_file(filename)
         self.filename = filename
+        # Data decoded by `decode_into`, returned up to `_offset` so far.
+        self._pending = b''
+        self._offset = 0
+
+        # Make sure the reader gets closed, even if we are never closed.
+        self._finalizer = garbage.Collector().finalize(self, close_reader,
+                                                       self._reader)
 
     def read(self, size=4096, timeout=0.0):
         """Returns at most a string of size `size`.
 
         The `timeout` argument is unused. But kept in for compatibility with
         other read methods in the `audio` module."""
+        self.announce()
+        return self.decode(size)
+
+    def readinto(self, buffer, timeout=0.0):
+        """Reads into `buffer` and returns the amount of bytes read."""
+        self.announce()
+        return self.decode_into(buffer)
+
+    def remaining(self):
+        """Returns the amount of bytes left to decode, or None if that
+        isn't known."""
+        return None
+
+    def announce(self):
+        """Called when the file starts playing, before the first read.
+
+        Reading through :meth:`read` calls this for you, the
+        :class:`FileSource` decodes ahead with :meth:`decode` and calls this
+        itself when the file actually starts."""
+        pass
+
+    def decode(self, size=4096):
+        """Returns the next audio data, about `size` bytes of it. An empty
+        string signifies the end of the file."""
+        if self._offset < len(self._pending):
+            data = self._pending[self._offset:self._offset + size]
+            self._offset += len(data)
+            return data
         return self._reader.read(size).to_bytes(False, True)
 
+    def decode_into(self, buffer):
+        """Decodes into `buffer` and returns the amount of bytes decoded.
+
+        The decoder hands out new objects regardless, so this copies the
+        result of :meth:`decode`. The decoder can return more than asked
+        for, anything that doesn't fit is kept for the next call."""
+        if self._offset >= len(self._pending):
+            self._pending = self.decode(len(buffer))
+            self._offset = 0
+        data = memoryview(self._pending)[self._offset:
+                                         self._offset + len(buffer)]
+        size = len(data)
+        buffer[:size] = data
+        self._offset += size
+        return size
+
     def close(self):
         """Registers self for garbage collection. This method does not
         close anything and only registers itself for colleciton."""
         logger.debug("Closing audiofile: %s", self.filename)
+        self._finalizer.detach()
         GarbageAudioFile(self)
 
     def __getattr__(self, key):
@@ -180,19 +545,83 @@ class AudioFile(object):
 
         self.file = reader
         total_frames = reader.total_frames()
+        #: The length of the file in seconds, None if it isn't known.
+        self.duration = None
+        if total_frames and reader.sample_rate():
+            self.duration = float(total_frames) / reader.sample_rate()
 
         # Wrap in a PCMReader because we want PCM
         reader = reader.to_pcm()
 
         # Wrap in a converter
         reader = audiotools.PCMConverter(
-            reader, sample_rate=44100, channels=2,
+            reader, sample_rate=SAMPLE_RATE, channels=CHANNELS,
             channel_mask=audiotools.ChannelMask(0x1 | 0x2),
-            bits_per_sample=24,
+            bits_per_sample=BITS_PER_SAMPLE,
         )
 
-        # And for file progress!
+        # And for file progress! Through a weak reference, the finalizer
+        # holds on to the reader and would keep us alive otherwise.
         reader = audiotools.PCMReaderProgress(reader, total_frames,
-                                              self.progress)
+                                              weak_progress(self))
 
         return reader
+
+
+class Prefetched(object):
+    """
+    An audio file of which the first `size` bytes are decoded right away,
+    reads are served from those before continuing with the decoder.
+
+    :param head: Data to serve before the decoded bytes, used for a mix of
+                 the previous file and this one.
+    :param process: A function called with a writable view of everything
+                    read, to change the audio in place.
+    """
+    def __init__(self, audiofile, size=0, head=b'', process=None):
+        super(Prefetched, self).__init__()
+        self.audiofile = audiofile
+        self.offset = 0
+        self.process = process
+
+        parts = [head]
+        while size > 0:
+            try:
+                data = audiofile.decode(size)
+            except (ValueError):
+                continue
+            except (AttributeError, IOError):
+                break
+            if not data:
+                break
+            parts.append(data)
+            size -= len(data)
+        self.head = b''.join(parts)
+
+    def remaining(self):
+        remaining = self.audiofile.remaining()
+        if remaining is None:
+            return None
+        return len(self.head) - self.offset + remaining
+
+    def decode_into(self, buffer):
+        if self.offset >= len(self.head):
+            size = self.audiofile.decode_into(buffer)
+        else:
+            data = memoryview(self.head)[self.offset:
+                                         self.offset + len(buffer)]
+            size = len(data)
+            buffer[:size] = data
+            self.offset += size
+        if size and self.process is not None:
+            self.process(memoryview(buffer)[:size])
+        return size
+
+    def announce(self):
+        self.audiofile.announce()
+
+    def close(self):
+        self.audiofile.close()
+
+    def __getattr__(self, key):
+        return getattr(self.audiofile, key)
@@ -1,13 +1,22 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import absolute_import
+from collections import namedtuple
 import threading
+import itertools
 import logging
+import weakref
+import heapq
 import time
 
 
 logger = logging.getLogger('garbage')
 
+#: Information about a single piece of pending garbage as returned by
+#: :meth:`Collector.info`.
+GarbageInfo = namedtuple("GarbageInfo", ("garbage", "age", "attempts",
+                                         "held_bytes", "next_attempt"))
+
 
 class Singleton(type):
     def __init__(mcs, name, bases, dict):
@@ -18,64 +27,304 @@ class Singleton(type):
         if mcs.instance is None:
             mcs.instance = super(Singleton, mcs).__call__(*args, **kw)
         return mcs.instance
-    
-    
+
+
+class Entry(object):
+    """Bookkeeping of the collector for a single piece of garbage."""
+    def __init__(self, garbage):
+        super(Entry, self).__init__()
+        self.garbage = garbage
+        self.added = time.time()
+        self.attempts = 0
+        self.next_attempt = self.added
+        self.alarmed = False
+
+
 class Collector(object):
+    """
+    Collects :class:`Garbage` in a separate thread.
+
+    Garbage is collected as soon as it is added. If collection fails the
+    garbage is retried with an exponential backoff starting at
+    :attr:`retry_delay` and capped at :attr:`max_retry_delay`. Owners of
+    garbage can call :meth:`wakeup` when they know their garbage is ready
+    to be collected, to skip the remaining backoff.
+
+    Garbage that is still pending after :attr:`max_age` seconds is logged
+    and passed to the hooks registered with :meth:`add_alarm_hook`.
+
+    The collector thread is started when the first garbage or finalizer
+    comes in, importing this module doesn't start it.
+    """
     __metaclass__ = Singleton
     _hooks = list()
+    _alarm_hooks = list()
+    #: Seconds to wait before retrying a failed collection.
+    retry_delay = 0.5
+    #: Maximum amount of seconds between two collection attempts.
+    max_retry_delay = 30.0
+    #: Seconds after which pending garbage raises an alarm.
+    max_age = 120.0
+
     def __init__(self):
         super(Collector, self).__init__()
-        self.items = set()
-        
-        
+        # garbage -> Entry
+        self.items = {}
+        # Heap of (next attempt, sequence, entry)
+        self.schedule = []
+        self.sequence = itertools.count()
+        # Weak references registered by `finalize`, kept alive here.
+        self.finalizers = set()
+
+        self.condition = threading.Condition()
+
         self.collecting = threading.Event()
-        self.thread = threading.Thread(target=self.run,
-                                       name="Garbage Collection Thread")
-        self.thread.daemon = True
-        self.thread.start()
-        
+        self.thread = None
+
+    def start(self):
+        """Starts the collector thread if it isn't running yet."""
+        with self.condition:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run,
+                                           name="Garbage Collection Thread")
+            self.thread.daemon = True
+            self.thread.start()
+
     def add(self, garbage):
-        self.items.add(garbage)
+        with self.condition:
+            entry = Entry(garbage)
+            self.items[garbage] = entry
+            self.push(entry)
         for hook in self._hooks:
             try:
                 hook(garbage)
             except:
                 logger.exception("Hook function exception.")
-            
+
+    def wakeup(self, item=None):
+        """Tells the collector that garbage is ready to be collected.
+
+        :param item: The item that is ready, this is the `item` passed to
+                     the :class:`Garbage` constructor. If None, all pending
+                     garbage is retried.
+        """
+        with self.condition:
+            for entry in self.items.values():
+                if item is None or entry.garbage.item is item:
+                    entry.next_attempt = time.time()
+                    self.push(entry)
+
+    def finalize(self, obj, function, *args):
+        """Calls `function` with `args` from the collector thread after
+        `obj` is reclaimed by the python garbage collector.
+
+        This is intended for objects that hold resources but might never
+        have their close method called. `function` and `args` should not
+        refer to `obj` or it will never be reclaimed.
+
+        :returns: A :class:`Finalizer`, call its `detach` method to cancel.
+        """
+        finalizer = Finalizer(self, function, args)
+        finalizer.ref = weakref.ref(obj, finalizer)
+        with self.condition:
+            self.finalizers.add(finalizer)
+        self.start()
+        return finalizer
+
+    def push(self, entry):
+        """Internal method
+
+        Schedules `entry` for its next attempt, the caller should hold
+        :attr:`condition`.
+        """
+        heapq.heappush(self.schedule, (entry.next_attempt,
+                                       next(self.sequence), entry))
+        self.condition.notify()
+        self.start()
+
     def run(self):
         while not self.collecting.is_set():
-            removal = set()
-            for item in self.items.copy():
+            with self.condition:
+                due = self.due()
+                if not due:
+                    self.condition.wait(self.timeout())
+                    due = self.due()
+
+            for entry in due:
+                self.collect(entry)
+
+            self.check_age()
+
+    def due(self):
+        """Internal method
+
+        Removes and returns the entries that are due for an attempt.
+        """
+        now, due = time.time(), []
+        while self.schedule and self.schedule[0][0] <= now:
+            when, _, entry = heapq.heappop(self.schedule)
+            # Skip stale schedule entries, either from a wakeup or garbage
+            # that has since been collected.
+            if (self.items.get(entry.garbage) is entry and
+                    when == entry.next_attempt):
+                due.append(entry)
+        return due
+
+    def timeout(self):
+        """Internal method
+
+        Returns how long the collector thread can sleep.
+        """
+        now = time.time()
+        timeout = self.max_age
+        if self.schedule:
+            timeout = min(timeout, self.schedule[0][0] - now)
+        for entry in self.items.values():
+            if not entry.alarmed:
+                timeout = min(timeout, entry.added + self.max_age - now)
+        return max(timeout, 0.0)
+
+    def collect(self, entry):
+        """Internal method
+
+        Does a single collection attempt on `entry`.
+        """
+        try:
+            code = entry.garbage.collect()  # Try collecting
+        except:
+            logger.exception("Collection Failure.")
+            code = False
+
+        with self.condition:
+            if code:  # If it returned True it was successful
+                self.items.pop(entry.garbage, None)
+                return
+            entry.attempts += 1
+            delay = min(self.retry_delay * 2 ** (entry.attempts - 1),
+                        self.max_retry_delay)
+            entry.next_attempt = time.time() + delay
+            self.push(entry)
+
+    def check_age(self):
+        """Internal method
+
+        Raises an alarm for garbage that has been pending too long.
+        """
+        now = time.time()
+        with self.condition:
+            old = [entry for entry in self.items.values()
+                   if not entry.alarmed and now - entry.added >= self.max_age]
+            for entry in old:
+                entry.alarmed = True
+
+        for entry in old:
+            logger.warning("Garbage pending for %.1f seconds after %d "
+                           "attempts: %r", now - entry.added, entry.attempts,
+                           entry.garbage)
+            for hook in self._alarm_hooks:
                 try:
-                    code = item.collect() # Try collecting
+                    hook(entry.garbage)
                 except:
-                    logger.exception("Collection Failure.")
-                else:
-                    if code: # If it returned True it was successful
-                        removal.add(item)
-            self.items -= removal # We remove our set from the item one
-            time.sleep(15.0)
-            
+                    logger.exception("Alarm hook function exception.")
+
     def info(self):
         """Returns a list of GarbageInfo objects containing information
-        about current pending garbage."""
-        yield None # Not implemented
-        
+        about current pending garbage, oldest first."""
+        now = time.time()
+        with self.condition:
+            entries = sorted(self.items.values(), key=lambda e: e.added)
+
+        info = []
+        for entry in entries:
+            try:
+                held = entry.garbage.held_bytes()
+            except:
+                logger.exception("Failed getting held bytes.")
+                held = 0
+            info.append(GarbageInfo(entry.garbage, now - entry.added,
+                                    entry.attempts, held,
+                                    max(entry.next_attempt - now, 0.0)))
+        return info
+
     @classmethod
     def add_hook(cls, hook):
         cls._hooks.append(hook)
-        
+
+    @classmethod
+    def add_alarm_hook(cls, hook):
+        """Registers `hook` to be called with garbage that has been pending
+        for longer than :attr:`max_age` seconds."""
+        cls._alarm_hooks.append(hook)
+
+
+class Finalizer(object):
+    """Callback of a weak reference registered with
+    :meth:`Collector.finalize`."""
+    def __init__(self, collector, function, args):
+        super(Finalizer, self).__init__()
+        self.collector = collector
+        self.function = function
+        self.args = args
+        self.ref = None
+
+    def __call__(self, ref):
+        # This can be called from any thread, hand the work over to the
+        # collector thread.
+        if self.detach():
+            FunctionGarbage((self.function, self.args))
+
+    def detach(self):
+        """Cancels the finalizer, returns True if it was still active."""
+        with self.collector.condition:
+            try:
+                self.collector.finalizers.remove(self)
+            except KeyError:
+                return False
+            return True
+
+
 class Garbage(object):
     collector = Collector()
     def __init__(self, item=None):
         super(Garbage, self).__init__()
         self.item = item
         self.collector.add(self)
-        
+
     def collect(self):
-        """Gets called on each collection cycle. 
-        
+        """Gets called on each collection cycle.
+
         Should return True if the garbage got cleaned up properly,
         False if it requires another collect in the next cycle.
         """
-        raise NotImplementedError("collect method not overridden.")
\ No newline at end of file
+        raise NotImplementedError("collect method not overridden.")
+
+    def held_bytes(self):
+        """Returns an estimate of the amount of bytes held by the item.
+        Used for :meth:`Collector.info`."""
+        return 0
+
+    def ready(self):
+        """Tells the collector we are ready to be collected."""
+        self.collector.wakeup(self.item)
+
+    def __repr__(self):
+        return "<{} of {!r}>".format(type(self).__name__, self.item)
+
+
+class FunctionGarbage(Garbage):
+    """Garbage that calls a function, the item is a tuple of the function
+    and its arguments. Used by :meth:`Collector.finalize`."""
+    def collect(self):
+        function, args = self.item
+        return function(*args) is not False
+
+
+def reset():
+    """Replaces the collector with a fresh one and returns it. Called in a
+    forked child: the collector of the parent has no thread there, its lock
+    may have been held at the time of the fork, and its garbage belongs to
+    the parent."""
+    Collector.instance = None
+    Garbage.collector = Collector()
+    return Garbage.collector
@@ -0,0 +1,240 @@
+"""
+Segmented output of the stream for HTTP Live Streaming.
+
+The :class:`HLS` tap cuts the encoded stream on frame boundaries into
+segments of a fixed duration, and keeps a rolling playlist of the latest
+segments next to them. The directory only holds static files, it can be
+served by any web server or CDN, and is best put on a tmpfs.
+
+Both the segments and the playlist are written to a temporary file first
+and renamed into place, a client never sees a partial file.
+
+The segments are packed audio, as RFC 8216 section 3.4 calls them: each
+starts with an ID3 tag holding the timestamp of its first frame, see
+:func:`timestamp_tag`, so players can place it on the timeline.
+
+The tap is placed in the chain like the :class:`~hanyuu.streamer.archive.
+Archive`, so it runs alongside the Icecast sink from the same encode:
+
+    Manager(queue, [FileSource, Encoder, HLS, Icecast], options)
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import logging
+import struct
+import math
+import os
+
+from .tap import Tap
+from . import mp3
+
+
+logger = logging.getLogger("streamer.hls")
+
+
+#: The owner of the ID3 PRIV frame with the timestamp of a segment.
+TIMESTAMP_OWNER = b"com.apple.streaming.transportStreamTimestamp"
+#: The clock rate of MPEG-2 timestamps, which wrap around at 33 bits.
+TIMESTAMP_RATE = 90000
+
+
+def syncsafe(value):
+    """Returns `value` as a 4 byte ID3 syncsafe integer, 7 bits a byte."""
+    return struct.pack(b">I", ((value & 0xfe00000) << 3) |
+                       ((value & 0x1fc000) << 2) |
+                       ((value & 0x3f80) << 1) | (value & 0x7f))
+
+
+def timestamp_tag(seconds):
+    """Returns the ID3v2.4 tag that starts a segment of which the first
+    frame plays at `seconds`."""
+    timestamp = int(round(seconds * TIMESTAMP_RATE)) % (1 << 33)
+    payload = TIMESTAMP_OWNER + b"\x00" + struct.pack(b">Q", timestamp)
+    frame = b"PRIV" + syncsafe(len(payload)) + b"\x00\x00" + payload
+    return b"ID3\x04\x00\x00" + syncsafe(len(frame)) + frame
+
+
+def write_atomic(filename, data):
+    """Writes `data` to `filename` through a temporary file, so the file
+    is either the old or the new version."""
+    temporary = filename + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.rename(temporary, filename)
+
+
+class HLS(Tap):
+    """
+    ======
+    Source
+    ======
+
+    The source should return an MPEG audio stream, such as the
+    :class:`~hanyuu.streamer.encoder.Encoder`.
+
+    =======
+    Options
+    =======
+
+    Next to the options of :class:`~hanyuu.streamer.tap.Tap`:
+
+        - hls_directory:
+            The directory to write the playlist and segments to, it's
+            created if it doesn't exist.
+        - hls_playlist:
+            The file name of the playlist.
+            (defaults to "stream.m3u8")
+        - hls_segment_seconds:
+            The duration of a segment, segments are cut at the first frame
+            boundary after it.
+            (defaults to 6.0)
+        - hls_playlist_size:
+            The amount of segments listed in the playlist.
+            (defaults to 6)
+        - hls_keep_segments:
+            The amount of segments kept on disk after they drop off the
+            playlist, for clients that are still fetching them.
+            (defaults to 3)
+    """
+    options = {
+        "tap_queue_size": 512,
+        "hls_directory": "hls",
+        "hls_playlist": "stream.m3u8",
+        "hls_segment_seconds": 6.0,
+        "hls_playlist_size": 6,
+        "hls_keep_segments": 3,
+    }
+    frames = True
+
+    def __init__(self, manager, pipe, options):
+        super(HLS, self).__init__(manager, pipe, options)
+        self.directory = options["hls_directory"]
+        self.playlist = options["hls_playlist"]
+        self.segment_seconds = float(options["hls_segment_seconds"])
+        self.playlist_size = int(options["hls_playlist_size"])
+        self.keep_segments = int(options["hls_keep_segments"])
+
+        #: The sequence number of the segment being collected.
+        self.sequence = None
+        self.pending = []
+        self.duration = 0.0
+        #: The time on the timeline of the segments at the end of the last
+        #: frame, and at the start of the segment being collected.
+        self.position = None
+        self.segment_start = None
+        #: (sequence, duration, discontinuity) of the written segments,
+        #: oldest first.
+        self.segments = []
+        self.discontinuity = False
+        self.removed_discontinuities = 0
+        self.skipped = 0
+
+        registry = manager.metrics
+        self.written = registry.counter(
+            "streamer_hls_segments_total",
+            "HLS segments written.")
+
+    def segment_name(self, sequence):
+        return "{:d}.mp3".format(sequence)
+
+    def write_frame(self, header, frame, timestamp):
+        if self.sequence is None:
+            # Numbering from the clock keeps a restarted streamer from
+            # reusing the names of segments a CDN might still have cached.
+            self.sequence = int(timestamp // self.segment_seconds)
+            if self.segments:
+                self.sequence = max(self.sequence, self.segments[-1][0] + 1)
+                self.discontinuity = True
+        if self.position is None:
+            self.position = timestamp
+
+        if self.parser.skipped != self.skipped:
+            # The stream lost sync, most likely an encoder restart.
+            self.skipped = self.parser.skipped
+            if self.pending:
+                self.finish()
+            self.discontinuity = True
+
+        if not self.pending:
+            self.segment_start = self.position
+        self.pending.append(frame)
+        self.duration += mp3.duration(header)
+        self.position += mp3.duration(header)
+        if self.duration >= self.segment_seconds:
+            self.finish()
+
+    def finish(self):
+        """Internal method
+
+        Writes the collected frames as the next segment and updates the
+        playlist.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        name = os.path.join(self.directory, self.segment_name(self.sequence))
+        write_atomic(name, timestamp_tag(self.segment_start) +
+                     b"".join(self.pending))
+        self.segments.append((self.sequence, self.duration,
+                              self.discontinuity))
+        self.written.inc()
+
+        self.sequence += 1
+        self.pending = []
+        self.duration = 0.0
+        self.discontinuity = False
+
+        self.write_playlist()
+        self.cleanup()
+
+    def write_playlist(self):
+        """Internal method
+
+        Writes the playlist of the latest segments.
+        """
+        listed = self.segments[-self.playlist_size:]
+        dropped = self.segments[:-self.playlist_size]
+        discontinuities = self.removed_discontinuities + sum(
+            1 for _, _, discontinuity in dropped if discontinuity)
+        # Segments overshoot by less than a frame, the target has to stay
+        # the same for the whole stream.
+        target = int(math.ceil(self.segment_seconds))
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            "#EXT-X-TARGETDURATION:{:d}".format(target),
+            "#EXT-X-MEDIA-SEQUENCE:{:d}".format(listed[0][0]),
+            "#EXT-X-DISCONTINUITY-SEQUENCE:{:d}".format(discontinuities),
+        ]
+        for sequence, duration, discontinuity in listed:
+            if discontinuity:
+                lines.append("#EXT-X-DISCONTINUITY")
+            lines.append("#EXTINF:{:.3f},".format(duration))
+            lines.append(self.segment_name(sequence))
+        data = "\n".join(lines) + "\n"
+        write_atomic(os.path.join(self.directory, self.playlist),
+                     data.encode("utf8"))
+
+    def cleanup(self):
+        """Internal method
+
+        Removes segments that dropped off the playlist long enough ago.
+        """
+        keep = self.playlist_size + self.keep_segments
+        while len(self.segments) > keep:
+            sequence, _, discontinuity = self.segments.pop(0)
+            if discontinuity:
+                self.removed_discontinuities += 1
+            try:
+                os.remove(os.path.join(self.directory,
+                                       self.segment_name(sequence)))
+            except OSError:
+                logger.warning("Failed to remove HLS segment %d", sequence)
+
+    def flush(self):
+        if self.pending:
+            self.finish()
+        self.sequence = None
+        self.position = None
@@ -12,6 +12,10 @@ import logging
 import pylibshout
 import chan
 
+from .switch import SourceSwitch
+from . import pool
+from . import mp3
+
 logger = logging.getLogger("streamer.icecast")
 
 
@@ -21,8 +25,10 @@ class Icecast(object):
     Source
     ======
 
-    The :class:`Icecast` class expects a source that returns encoded MP3 audio
-    data. Use of other formats as of now is not supported.
+    The :class:`Icecast` class expects a source that returns encoded MP3 or
+    Ogg audio data. When the 'format' isn't in the configuration, the
+    `format` attribute of the source is used if it has one, such as the one
+    of the :class:`~hanyuu.streamer.encoder.Encoder`.
 
     The source requires the following attributes:
         :func:`read`:
@@ -69,6 +75,17 @@ class Icecast(object):
             :param icecast: :class:`Icecast` instance.
             :param metadata: :const:`unicode` instance containing
                              the metadata send.
+        - track_start(track):
+            Called when the first audio of a track was sent, see
+            :mod:`hanyuu.streamer.clock`.
+
+            :param track: :class:`~hanyuu.streamer.clock.Track` instance.
+        - icecast_switch((icecast, source)):
+            Called when a source passed to :meth:`Icecast.switch_source`
+            takes over.
+
+            :param icecast: :class:`Icecast` instance.
+            :param source: The new source.
     """
     options = {
         'icecast_config': {},
@@ -79,11 +96,33 @@ class Icecast(object):
     def __init__(self, manager, pipe, options):
         super(Icecast, self).__init__()
         self.config = IcecastConfig(options['icecast_config'])
+        if 'format' not in self.config:
+            try:
+                self.config['format'] = pipe.format
+            except AttributeError:
+                pass
 
         self.manager = manager
         self.metadata_channel = manager.register("metadata")
 
-        self.source = pipe
+        # MP3 sources are switched between frames, Ogg between reads.
+        self.source = SourceSwitch(pipe,
+                                   frames=self.config.get('format', 1) != 0,
+                                   on_switch=self.switched)
+        #: Counts the audio we send, for the playout clock.
+        self.counter = mp3.FrameCounter()
+        #: Set by :meth:`recover`, the sending thread then reconnects.
+        self.reconnect = threading.Event()
+
+        registry = manager.metrics
+        self.metrics = registry.stage("icecast")
+        self.reconnects = registry.counter(
+            "streamer_icecast_reconnects_total",
+            "Times the libshout object was recreated and reconnected.")
+        registry.gauge(
+            "streamer_icecast_connected",
+            "1 if currently connected to the icecast server, 0 otherwise.",
+            function=lambda: int(self.connected()))
 
         self._shout = self.setup_libshout()
 
@@ -128,19 +167,39 @@ class Icecast(object):
             pass
 
     def run(self):
+        buffers = self.manager.buffers
+        data = buffers.acquire()
+        try:
+            self.send_loop(data)
+        finally:
+            buffers.release(data)
+
+    def send_loop(self, data):
         while not self._should_run.is_set():
             while self.connected():
+                if self.reconnect.is_set():
+                    self.reconnect.clear()
+                    self.drop_connection()
+                    self.reboot_libshout()
+                    continue
                 self.check_metadata()
 
-                buff = self.source.read(4096)
+                size = pool.readinto(self.source, data)
+                # A read-only view of what we read, without copying it.
+                buff = buffer(data, 0, size)
                 if not buff:
                     # EOF
                     self.close()
                     logger.exception("Source EOF, closing ourself.")
                     break
+                start = self.metrics.begin()
                 try:
                     self._shout.send(buff)
                     self._shout.sync()
+                    # The sync call paces us to real time, so the latency
+                    # includes the time spent waiting on the server.
+                    self.metrics.observe(len(buff), time.time() - start)
+                    self.manager.clock.advance(self.duration(data, size))
                 except (pylibshout.ShoutException):
                     logger.exception("Failed sending stream data.")
                     self.reboot_libshout()
@@ -149,6 +208,34 @@ class Icecast(object):
                 time.sleep(self.connecting_timeout)
                 self.reboot_libshout()
 
+    def duration(self, data, size):
+        """Internal method
+
+        Returns the seconds of audio in the first `size` bytes of `data`,
+        counted by frame for MP3 and estimated from the bitrate for Ogg.
+        """
+        if self.config.get('format', 1) == 0:
+            byte_rate = getattr(self.source, "byte_rate", None)
+            return float(size) / byte_rate if byte_rate else 0.0
+        return self.counter.feed(data, size)
+
+    def recover(self):
+        """Called by the :class:`~hanyuu.streamer.watchdog.Watchdog` when we
+        stalled. libshout isn't thread-safe, so the sending thread is asked
+        to drop the connection and reconnect before its next send. A send
+        stuck on the server can't be interrupted."""
+        self.reconnect.set()
+
+    def drop_connection(self):
+        """Internal method
+
+        Closes the current libshout object, called from the sending thread.
+        """
+        try:
+            self._shout.close()
+        except (pylibshout.ShoutException):
+            logger.exception("Exception in pylibshout close call.")
+
     def start(self):
         """Starts the thread that reads from source and feeds it to icecast."""
         if not self.connected():
@@ -163,14 +250,18 @@ class Icecast(object):
         self.manager.emit("icecast_start", self)
 
     def switch_source(self, new_source):
-        """Tries to change the source without disconnect from icecast."""
-        self._should_run.set()  # Gracefully try to get rid of the thread
-        try:
-            self._thread.join(5.0)
-        except (RuntimeError):
-            logger.exception("Got called from my own thread.")
-        self.source = new_source  # Swap out our source
-        self.start()  # Start a new thread (so roundabout)
+        """Changes the source without disconnecting from icecast. The
+        sending thread keeps running and picks up `new_source` at the next
+        frame boundary, see :mod:`hanyuu.streamer.switch`."""
+        self.source.switch(new_source)
+
+    def switched(self, old, new):
+        """Internal method
+
+        Called by our :class:`~hanyuu.streamer.switch.SourceSwitch` once
+        `new` took over.
+        """
+        self.manager.emit("icecast_switch", (self, new))
 
     def check_metadata(self):
         saved = getattr(self, "_saved_meta", None)
@@ -207,6 +298,7 @@ class Icecast(object):
 
         Tries to recreate the libshout object.
         """
+        self.reconnects.inc()
         try:
             self._shout = self.setup_libshout()
         except (IcecastError):
@@ -0,0 +1,256 @@
+"""
+Bindings to libmp3lame, to encode in our own process.
+
+The :class:`~hanyuu.streamer.encoder.Encoder` normally runs the LAME binary
+and pipes PCM through it. With the library the PCM is encoded straight from
+the buffer it was read into, without the copies through the pipes, the
+feeder thread and the child process to look after. ctypes releases the GIL
+for the duration of each call into the library, so encoding doesn't hold
+up the other pipes.
+
+Only the LAME options we use for streaming are understood by
+:func:`configure`, anything else raises a :class:`LameError` so the caller
+can fall back to the binary.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import ctypes.util
+import ctypes
+import logging
+
+
+logger = logging.getLogger("streamer.lame")
+
+# enum vbr_mode
+VBR_OFF = 0
+VBR_ABR = 3
+VBR_MTRH = 4
+
+# enum MPEG_mode
+MODES = {
+    's': 0,  # STEREO
+    'j': 1,  # JOINT_STEREO
+    'd': 2,  # DUAL_CHANNEL
+    'm': 3,  # MONO
+}
+
+
+class LameError(Exception):
+    """Exception raised when libmp3lame is unavailable, or fails."""
+    pass
+
+
+_library = None
+
+
+def library():
+    """Returns the loaded libmp3lame, raises :class:`LameError` if it can't
+    be found."""
+    global _library
+    if _library is not None:
+        return _library
+
+    name = ctypes.util.find_library("mp3lame")
+    if name is None:
+        raise LameError("libmp3lame not found")
+    try:
+        lib = ctypes.CDLL(name)
+    except OSError as err:
+        raise LameError("Failed loading libmp3lame: {}".format(err))
+
+    lib.lame_init.restype = ctypes.c_void_p
+    lib.lame_init.argtypes = []
+    for function in ("lame_init_params", "lame_close"):
+        getattr(lib, function).argtypes = [ctypes.c_void_p]
+    for function in ("lame_set_in_samplerate", "lame_set_out_samplerate",
+                     "lame_set_num_channels", "lame_set_brate",
+                     "lame_set_mode", "lame_set_quality", "lame_set_VBR",
+                     "lame_set_VBR_q", "lame_set_VBR_mean_bitrate_kbps",
+                     "lame_set_VBR_min_bitrate_kbps",
+                     "lame_set_VBR_max_bitrate_kbps",
+                     "lame_set_bWriteVbrTag", "lame_set_disable_reservoir",
+                     "lame_set_lowpassfreq"):
+        getattr(lib, function).argtypes = [ctypes.c_void_p, ctypes.c_int]
+    # Added in LAME 3.98, `-V` takes fractions such as 2.5.
+    if hasattr(lib, "lame_set_VBR_quality"):
+        lib.lame_set_VBR_quality.argtypes = [ctypes.c_void_p, ctypes.c_float]
+
+    buffer = ctypes.c_char_p
+    lib.lame_encode_buffer_interleaved.argtypes = [
+        ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, buffer, ctypes.c_int]
+    lib.lame_encode_buffer_int.argtypes = [
+        ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int,
+        buffer, ctypes.c_int]
+    lib.lame_encode_flush.argtypes = [ctypes.c_void_p, buffer, ctypes.c_int]
+    # Added in LAME 3.100, we split the channels ourself without it.
+    if hasattr(lib, "lame_encode_buffer_interleaved_int"):
+        lib.lame_encode_buffer_interleaved_int.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, buffer,
+            ctypes.c_int]
+
+    _library = lib
+    return lib
+
+
+def available():
+    """Returns True if libmp3lame can be loaded."""
+    try:
+        library()
+    except LameError:
+        return False
+    return True
+
+
+def configure(settings, mode='j'):
+    """
+    Translates LAME command line `settings`, such as the `lame_settings` of
+    the :class:`~hanyuu.streamer.encoder.Encoder`, into a list of
+    (function, value) calls to make on the encoder.
+
+    :raises LameError: For options we don't understand.
+    """
+    calls = [("lame_set_mode", MODES[mode]),
+             ("lame_set_bWriteVbrTag", 0)]
+    vbr = VBR_OFF
+    bitrate = None
+    arguments = iter(settings)
+    for flag in arguments:
+        try:
+            if flag == '--cbr':
+                vbr = VBR_OFF
+            elif flag == '-b':
+                bitrate = int(next(arguments))
+            elif flag == '-B':
+                calls.append(("lame_set_VBR_max_bitrate_kbps",
+                              int(next(arguments))))
+            elif flag == '--abr':
+                vbr = VBR_ABR
+                calls.append(("lame_set_VBR_mean_bitrate_kbps",
+                              int(next(arguments))))
+            elif flag == '-V':
+                vbr = VBR_MTRH
+                calls.append(("lame_set_VBR_quality",
+                              float(next(arguments))))
+            elif flag == '-q':
+                calls.append(("lame_set_quality", int(next(arguments))))
+            elif flag == '--resample':
+                calls.append(("lame_set_out_samplerate",
+                              int(float(next(arguments)) * 1000)))
+            elif flag == '--lowpass':
+                calls.append(("lame_set_lowpassfreq",
+                              int(float(next(arguments)) * 1000)))
+            elif flag == '--nores':
+                calls.append(("lame_set_disable_reservoir", 1))
+            elif flag == '-t':
+                pass
+            else:
+                raise LameError("Unsupported LAME option: {}".format(flag))
+        except (StopIteration, ValueError):
+            raise LameError("Invalid value for LAME option: {}".format(flag))
+
+    calls.append(("lame_set_VBR", vbr))
+    if bitrate is not None:
+        if vbr == VBR_OFF:
+            calls.append(("lame_set_brate", bitrate))
+        else:
+            calls.append(("lame_set_VBR_min_bitrate_kbps", bitrate))
+    return calls
+
+
+def widen(data, size):
+    """Returns the 24-bit little endian samples in the first `size` bytes of
+    `data` as 32-bit samples in a bytearray, the sample in the upper bits."""
+    count = size // 3
+    wide = bytearray(count * 4)
+    wide[1::4] = data[0:count * 3:3]
+    wide[2::4] = data[1:count * 3:3]
+    wide[3::4] = data[2:count * 3:3]
+    return wide
+
+
+class Lame(object):
+    """
+    An encoder from the library, encoding interleaved stereo PCM of
+    `sample_rate` and `bits_per_sample` (16, 24 or 32) with `settings`.
+    """
+    def __init__(self, settings, sample_rate, bits_per_sample, mode='j'):
+        super(Lame, self).__init__()
+        if bits_per_sample not in (16, 24, 32):
+            raise LameError("Unsupported bits per sample: {:d}".format(
+                bits_per_sample))
+        self.lib = library()
+        self.bits_per_sample = bits_per_sample
+        calls = configure(settings, mode)
+
+        self.handle = self.lib.lame_init()
+        if not self.handle:
+            raise LameError("lame_init failed")
+        calls = [("lame_set_in_samplerate", int(sample_rate)),
+                 ("lame_set_num_channels", 2)] + calls
+        for function, value in calls:
+            setter = getattr(self.lib, function, None)
+            if setter is None:
+                self.close()
+                raise LameError("{} is missing from libmp3lame".format(
+                    function))
+            if setter(self.handle, value) < 0:
+                self.close()
+                raise LameError("{} failed for {}".format(function, value))
+        if self.lib.lame_init_params(self.handle) < 0:
+            self.close()
+            raise LameError("lame_init_params failed")
+
+        self.output = ctypes.create_string_buffer(0)
+
+    def encode(self, data, size):
+        """Encodes the first `size` bytes of the PCM in `data`, a bytearray
+        or writable buffer, and returns the MP3 data that came out."""
+        if self.bits_per_sample == 24:
+            data = widen(data, size)
+            size = len(data)
+        width = 2 if self.bits_per_sample == 16 else 4
+        samples = size // (width * 2)
+        if samples == 0:
+            return b''
+
+        # The worst case given by lame.h.
+        needed = samples * 5 // 4 + 7200
+        if len(self.output) < needed:
+            self.output = ctypes.create_string_buffer(needed)
+
+        pcm = (ctypes.c_char * (samples * width * 2)).from_buffer(data)
+        if width == 2:
+            length = self.lib.lame_encode_buffer_interleaved(
+                self.handle, pcm, samples, self.output, len(self.output))
+        elif hasattr(self.lib, "lame_encode_buffer_interleaved_int"):
+            length = self.lib.lame_encode_buffer_interleaved_int(
+                self.handle, pcm, samples, self.output, len(self.output))
+        else:
+            left, right = bytearray(samples * 4), bytearray(samples * 4)
+            for byte in range(4):
+                left[byte::4] = data[byte:samples * 8:8]
+                right[byte::4] = data[byte + 4:samples * 8:8]
+            length = self.lib.lame_encode_buffer_int(
+                self.handle,
+                (ctypes.c_char * len(left)).from_buffer(left),
+                (ctypes.c_char * len(right)).from_buffer(right),
+                samples, self.output, len(self.output))
+        del pcm
+        if length < 0:
+            raise LameError("Encoding failed with {:d}".format(length))
+        return ctypes.string_at(self.output, length)
+
+    def flush(self):
+        """Returns the MP3 data still held by the encoder."""
+        if len(self.output) < 7200:
+            self.output = ctypes.create_string_buffer(7200)
+        length = self.lib.lame_encode_flush(self.handle, self.output,
+                                            len(self.output))
+        return ctypes.string_at(self.output, max(length, 0))
+
+    def close(self):
+        if self.handle:
+            self.lib.lame_close(self.handle)
+            self.handle = None
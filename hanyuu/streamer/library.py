@@ -0,0 +1,395 @@
+"""
+A persistent index of a music directory.
+
+Walking a large music directory and reading the tags of every file is slow,
+the :class:`Library` keeps the results in a SQLite database so that startup
+only has to look at what changed since the last run. Song selection reads
+from the index and never touches the files.
+
+The index is refreshed by an incremental scan that compares file modification
+times, or when :mod:`pyinotify` is installed by watching the directory.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import namedtuple
+import threading
+import logging
+import sqlite3
+import random
+import sys
+import os
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+logger = logging.getLogger("streamer.library")
+
+Song = namedtuple("Song", ("filename", "metadata"))
+
+#: The file extensions that are indexed, anything else is ignored.
+EXTENSIONS = ('.flac', '.mp3', '.ogg')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    duration REAL,
+    artist TEXT,
+    title TEXT,
+    metadata TEXT NOT NULL
+)
+"""
+
+
+def format_metadata(artist, title):
+    """Returns the metadata string shown to listeners."""
+    if artist:
+        return "{:s} - {:s}".format(artist, title or "")
+    return "{:s}".format(title or "")
+
+
+def read_tags(filename):
+    """
+    Reads the tags of `filename`.
+
+    :returns: A tuple of (duration, artist, title, metadata), the first three
+              can be None if the file has no such information.
+    """
+    import mutagen
+
+    try:
+        meta = mutagen.File(filename, easy=True)
+    except Exception:
+        logger.exception("Failed reading tags of %s", filename)
+        meta = None
+
+    if meta is None:
+        return None, None, None, "No metadata available, because I errored."
+
+    duration = getattr(meta.info, "length", None)
+    artist = ", ".join(meta.get('artist') or []) or None
+    title = ", ".join(meta.get('title') or []) or None
+    return duration, artist, title, format_metadata(artist, title)
+
+
+def walk(directory):
+    """
+    Yields the paths of the files in `directory` and its subdirectories,
+    like :func:`os.walk` without following links.
+
+    Listing a unicode directory returns the names that can't be decoded
+    with the file system encoding as byte strings, which can't be joined
+    to it. Those are logged and skipped, where :func:`os.walk` would fail.
+    """
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        logger.exception("Failed listing %s", directory)
+        return
+
+    for name in names:
+        try:
+            path = os.path.join(directory, name)
+        except UnicodeDecodeError:
+            logger.warning("Skipping %r in %s, the name can't be decoded.",
+                           name, directory)
+            continue
+        if os.path.islink(path) and os.path.isdir(path):
+            continue
+        elif os.path.isdir(path):
+            for found in walk(path):
+                yield found
+        else:
+            yield path
+
+
+class Library(object):
+    """
+    An index of the supported audio files in `directory`, stored in the
+    SQLite database `database`.
+
+    The index is not refreshed automatically, call :meth:`scan` to do an
+    incremental refresh or :meth:`watch` to keep it up to date.
+    """
+    #: Seconds between scans done by :meth:`watch` without inotify.
+    scan_interval = 600.0
+
+    def __init__(self, database, directory):
+        super(Library, self).__init__()
+        self.database = database
+        # Walk with unicode so all our paths end up as unicode in SQLite.
+        if isinstance(directory, bytes):
+            directory = directory.decode(sys.getfilesystemencoding())
+        self.directory = directory
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(SCHEMA)
+
+        self.stopped = threading.Event()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM songs").fetchone()[0]
+
+    def scan(self):
+        """
+        Brings the index up to date with the directory. Only files that were
+        added or changed since the last scan have their tags read.
+
+        :returns: A tuple of (added or changed, removed) file counts.
+        """
+        with self.lock:
+            known = dict(self.connection.execute(
+                "SELECT path, mtime FROM songs"))
+
+        changed = []
+        for path in walk(self.directory):
+            if not path.lower().endswith(EXTENSIONS):
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if known.pop(path, None) != mtime:
+                changed.append(path)
+
+        # The tags are read first, then stored in a single transaction.
+        entries = []
+        for path in changed:
+            entry = self.entry(path)
+            if entry is None:
+                known[path] = None
+            else:
+                entries.append(entry)
+        self.store(entries)
+        if known:
+            self.remove(*known)
+
+        logger.info("Library scan done: %d changed, %d removed.",
+                    len(changed), len(known))
+        return len(changed), len(known)
+
+    def update(self, path):
+        """Adds or refreshes the index entry of `path`."""
+        entry = self.entry(path)
+        if entry is None:
+            return self.remove(path)
+        self.store([entry])
+
+    def update_directory(self, directory):
+        """Adds or refreshes the index entries of the files in `directory`
+        and its subdirectories."""
+        entries = [self.entry(path) for path in walk(directory)
+                   if path.lower().endswith(EXTENSIONS)]
+        self.store([entry for entry in entries if entry is not None])
+
+    def entry(self, path):
+        """Internal method
+
+        Returns the row of the index for `path`, or None if it's gone.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        duration, artist, title, metadata = read_tags(path)
+        extension = os.path.splitext(path)[1].lower().lstrip('.')
+        return (path, stat.st_mtime, stat.st_size, extension, duration,
+                artist, title, metadata)
+
+    def store(self, entries):
+        """Internal method
+
+        Writes the rows `entries` to the index in a single transaction.
+        """
+        if not entries:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO songs (path, mtime, size, format, "
+                "duration, artist, title, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entries)
+
+    def remove(self, *paths):
+        """Removes the index entries of `paths`."""
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM songs WHERE path = ?",
+                                        [(path,) for path in paths])
+
+    def remove_directory(self, directory):
+        """Removes the index entries of the files in `directory` and its
+        subdirectories."""
+        prefix = os.path.join(directory, "")
+        # Every path starting with the prefix sorts below the prefix with
+        # its separator incremented.
+        end = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM songs WHERE path >= ? AND path < ?",
+                (prefix, end))
+
+    def song(self, id):
+        """Returns the :class:`Song` with index id `id`, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT path, metadata FROM songs WHERE id = ?",
+                (id,)).fetchone()
+        return Song(*row) if row else None
+
+    def info(self, path):
+        """Returns a dict of everything indexed about `path`, or None."""
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT * FROM songs WHERE path = ?", (path,))
+            row = cursor.fetchone()
+            names = [column[0] for column in cursor.description]
+        return dict(zip(names, row)) if row else None
+
+    def shuffle(self):
+        """
+        Returns a function that returns a random :class:`Song` from the index
+        on each call, without repeats, and `Song(None, None)` when all songs
+        have been returned.
+
+        Only the ids are loaded up front, each call is a single lookup.
+        """
+        with self.lock:
+            ids = [row[0] for row in
+                   self.connection.execute("SELECT id FROM songs")]
+        random.shuffle(ids)
+
+        def pop_file():
+            while ids:
+                song = self.song(ids.pop())
+                # It can have been removed since we loaded the ids.
+                if song is not None:
+                    return song
+            return Song(None, None)
+        return pop_file
+
+    def measure_loudness(self, cache):
+        """
+        Measures the loudness of every indexed song missing from `cache`, a
+        :class:`~hanyuu.streamer.loudness.LoudnessCache`. This decodes each
+        of those songs completely, so expect it to take a while.
+
+        :returns: The amount of songs measured.
+        """
+        from .loudness import measure_file
+
+        with self.lock:
+            paths = [row[0] for row in
+                     self.connection.execute("SELECT path FROM songs")]
+
+        measured = 0
+        for path in paths:
+            if self.stopped.is_set():
+                break
+            if cache.get(path) is not None:
+                continue
+            try:
+                loudness, peak = measure_file(path)
+            except Exception:
+                logger.exception("Failed measuring loudness of %s", path)
+                continue
+            cache.put(path, loudness, peak)
+            measured += 1
+        return measured
+
+    def pre_encode(self, frame_cache):
+        """
+        Encodes every indexed song missing from `frame_cache`, a
+        :class:`~hanyuu.streamer.streamcopy.FrameCache`. Like
+        :meth:`measure_loudness` this takes a while.
+
+        :returns: The amount of songs encoded.
+        """
+        with self.lock:
+            paths = [row[0] for row in
+                     self.connection.execute("SELECT path FROM songs")]
+
+        encoded = 0
+        for path in paths:
+            if self.stopped.is_set():
+                break
+            if frame_cache.get(path) is not None:
+                continue
+            try:
+                if frame_cache.encode(path):
+                    encoded += 1
+            except Exception:
+                logger.exception("Failed pre-encoding %s", path)
+        return encoded
+
+    def watch(self):
+        """Keeps the index up to date in a background thread, using inotify
+        if available and periodic scans otherwise."""
+        target = self.run_inotify if pyinotify else self.run_scan
+        thread = threading.Thread(target=target, name="Library Watcher")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run_scan(self):
+        while not self.stopped.wait(self.scan_interval):
+            try:
+                self.scan()
+            except Exception:
+                logger.exception("Library scan failed.")
+
+    def run_inotify(self):
+        library = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_IN_CLOSE_WRITE(self, event):
+                if event.pathname.lower().endswith(EXTENSIONS):
+                    library.update(event.pathname)
+
+            def process_IN_MOVED_TO(self, event):
+                if not event.dir:
+                    return self.process_IN_CLOSE_WRITE(event)
+                # A directory moved in from outside isn't watched yet,
+                # one moved around inside is moved along by pyinotify.
+                if manager.get_wd(event.pathname) is None:
+                    manager.add_watch(event.pathname, mask, rec=True,
+                                      auto_add=True)
+                library.update_directory(event.pathname)
+
+            def process_IN_DELETE(self, event):
+                if event.dir:
+                    library.remove_directory(event.pathname)
+                else:
+                    library.remove(event.pathname)
+
+            process_IN_MOVED_FROM = process_IN_DELETE
+
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM)
+        manager = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(manager, Handler())
+        manager.add_watch(self.directory, mask, rec=True, auto_add=True)
+
+        # Catch anything that changed before the watch was in place.
+        self.scan()
+        while not self.stopped.is_set():
+            if notifier.check_events(1000):
+                notifier.read_events()
+                notifier.process_events()
+        notifier.stop()
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            self.connection.close()
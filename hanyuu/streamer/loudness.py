@@ -0,0 +1,311 @@
+"""
+Loudness normalization of the songs played.
+
+The integrated loudness of a song is measured once, while it is preloaded or
+by :meth:`~hanyuu.streamer.library.Library.measure_loudness`, and kept in a
+:class:`LoudnessCache` on disk keyed by the identity of the file. At play
+time the :class:`~hanyuu.streamer.files.FileSource` looks the song up and
+has a :class:`Normalizer` apply the gain needed to reach the target level,
+followed by a :class:`Limiter` so the gain can't cause clipping. Songs that
+were never measured are played as is.
+
+Loudness is measured as described in EBU R128 (ITU-R BS.1770): K-weighted,
+in gated 400ms blocks. The K-weighting filter needs scipy, without it the
+audio is measured unweighted which is close enough for most music.
+
+Like :mod:`hanyuu.streamer.dsp` this requires numpy.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+import logging
+import sqlite3
+import math
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import scipy.signal
+except ImportError:
+    scipy = None
+
+from .pcm import SAMPLE_RATE, CHANNELS, BLOCK_ALIGN
+from . import dsp
+
+
+logger = logging.getLogger("streamer.loudness")
+
+#: The level songs are normalized to in LUFS, the ReplayGain 2 reference.
+TARGET_LUFS = -18.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS loudness (
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    loudness REAL NOT NULL,
+    peak REAL NOT NULL,
+    PRIMARY KEY (path, size, mtime)
+)
+"""
+
+
+def k_weighting(rate=SAMPLE_RATE):
+    """Returns the (b, a) coefficients of the two K-weighting filter stages
+    for sample rate `rate`."""
+    # Stage 1, a high shelf modelling the acoustic effect of the head.
+    gain, q, frequency = 4.0, 1 / math.sqrt(2), 1500.0
+    a = 10 ** (gain / 40)
+    w0 = 2 * math.pi * frequency / rate
+    alpha = math.sin(w0) / (2 * q)
+    cos = math.cos(w0)
+    shelf = ([a * ((a + 1) + (a - 1) * cos + 2 * math.sqrt(a) * alpha),
+              -2 * a * ((a - 1) + (a + 1) * cos),
+              a * ((a + 1) + (a - 1) * cos - 2 * math.sqrt(a) * alpha)],
+             [(a + 1) - (a - 1) * cos + 2 * math.sqrt(a) * alpha,
+              2 * ((a - 1) - (a + 1) * cos),
+              (a + 1) - (a - 1) * cos - 2 * math.sqrt(a) * alpha])
+
+    # Stage 2, a high pass.
+    q, frequency = 0.5, 38.0
+    w0 = 2 * math.pi * frequency / rate
+    alpha = math.sin(w0) / (2 * q)
+    cos = math.cos(w0)
+    highpass = ([(1 + cos) / 2, -(1 + cos), (1 + cos) / 2],
+                [1 + alpha, -2 * cos, 1 - alpha])
+    return shelf, highpass
+
+
+class Meter(object):
+    """
+    Measures the integrated loudness and sample peak of PCM fed to it in
+    chunks, in a single pass.
+    """
+    #: The length of a gating block is 4 of these, blocks overlap by 75%.
+    step_seconds = 0.1
+    absolute_gate = -70.0
+    relative_gate = -10.0
+
+    def __init__(self):
+        super(Meter, self).__init__()
+        self.step_frames = int(SAMPLE_RATE * self.step_seconds)
+        self.filters = None
+        if scipy is not None:
+            self.filters = [
+                (b, a, numpy.zeros((2, CHANNELS)))
+                for b, a in k_weighting()]
+        # Summed channel power of the frames not making up a step yet.
+        self.pending = numpy.zeros(0)
+        self.steps = []
+        self.peak = 0
+
+    def feed(self, data):
+        samples = dsp.to_samples(data)
+        if not len(samples):
+            return
+        self.peak = max(self.peak, int(numpy.abs(samples).max()))
+
+        samples = samples / float(dsp.FULL_SCALE)
+        if self.filters is not None:
+            for index, (b, a, state) in enumerate(self.filters):
+                samples, state = scipy.signal.lfilter(b, a, samples, axis=0,
+                                                      zi=state)
+                self.filters[index] = (b, a, state)
+
+        power = (samples ** 2).sum(axis=1)
+        power = numpy.concatenate((self.pending, power))
+        full = len(power) - len(power) % self.step_frames
+        if full:
+            self.steps.append(
+                power[:full].reshape(-1, self.step_frames).mean(axis=1))
+        self.pending = power[full:]
+
+    def result(self):
+        """Returns a tuple of (integrated loudness in LUFS, sample peak in
+        dBFS), the loudness is None for silence."""
+        peak = dsp.to_db(self.peak) if self.peak else -numpy.inf
+        if not self.steps:
+            return None, float(peak)
+
+        steps = numpy.concatenate(self.steps)
+        if len(steps) >= 4:
+            # Overlapping blocks of four steps.
+            blocks = (steps[:-3] + steps[1:-2] + steps[2:-1] + steps[3:]) / 4
+        else:
+            blocks = steps[-1:]
+        loudness = -0.691 + 10 * numpy.log10(numpy.maximum(blocks, 1e-20))
+
+        blocks = blocks[loudness > self.absolute_gate]
+        if not len(blocks):
+            return None, float(peak)
+        gate = (-0.691 + 10 * numpy.log10(blocks.mean()) +
+                self.relative_gate)
+        loudness = -0.691 + 10 * numpy.log10(numpy.maximum(blocks, 1e-20))
+        blocks = blocks[loudness > gate]
+        return float(-0.691 + 10 * numpy.log10(blocks.mean())), float(peak)
+
+
+def measure_file(filename):
+    """Decodes `filename` completely and returns the result of a
+    :class:`Meter` over it."""
+    from .files import AudioFile
+
+    meter = Meter()
+    audiofile = AudioFile(filename)
+    try:
+        while True:
+            data = audiofile.decode(65536)
+            if not data:
+                break
+            meter.feed(data)
+    finally:
+        audiofile.close()
+    return meter.result()
+
+
+class LoudnessCache(object):
+    """
+    Measured loudness of files, stored in the SQLite database `database`.
+
+    Entries are keyed by path, size and modification time, a changed file
+    is measured again.
+    """
+    def __init__(self, database):
+        super(LoudnessCache, self).__init__()
+        self.database = database
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(SCHEMA)
+
+    def identity(self, filename):
+        """Internal method
+
+        Returns the (path, size, mtime) key of `filename`, or None.
+        """
+        if isinstance(filename, bytes):
+            filename = filename.decode("utf8")
+        try:
+            stat = os.stat(filename)
+        except (OSError, IOError):
+            return None
+        return os.path.realpath(filename), stat.st_size, stat.st_mtime
+
+    def get(self, filename):
+        """Returns the (loudness, peak) of `filename`, or None if it wasn't
+        measured."""
+        key = self.identity(filename)
+        if key is None:
+            return None
+        with self.lock:
+            return self.connection.execute(
+                "SELECT loudness, peak FROM loudness "
+                "WHERE path = ? AND size = ? AND mtime = ?", key).fetchone()
+
+    def put(self, filename, loudness, peak):
+        key = self.identity(filename)
+        if key is None or loudness is None:
+            return
+        with self.lock, self.connection:
+            # Forget measurements of older versions of the file.
+            self.connection.execute("DELETE FROM loudness WHERE path = ?",
+                                    key[:1])
+            self.connection.execute(
+                "INSERT INTO loudness (path, size, mtime, loudness, peak) "
+                "VALUES (?, ?, ?, ?, ?)", key + (loudness, peak))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class Limiter(object):
+    """
+    A peak limiter working on blocks of frames.
+
+    The gain needed to keep each block under `ceiling_db` is applied right
+    away, and released towards unity over `release_seconds`. The gain is
+    interpolated between blocks to avoid steps.
+    """
+    block_frames = 64
+
+    def __init__(self, ceiling_db=-1.0, release_seconds=0.2):
+        super(Limiter, self).__init__()
+        self.ceiling = dsp.FULL_SCALE * 10 ** (ceiling_db / 20.0)
+        blocks = release_seconds * SAMPLE_RATE / self.block_frames
+        #: Gain recovered per block.
+        self.release = 10 ** (-20.0 / 20.0 / max(blocks, 1.0))
+        #: The gain applied at the end of the previous call.
+        self.gain = 1.0
+
+    def process(self, samples):
+        """Returns `samples`, a float array of (frames, channels), with its
+        peaks limited."""
+        frames = len(samples)
+        peaks = numpy.abs(samples).max(axis=1)
+        starts = numpy.arange(0, frames, self.block_frames)
+        peaks = numpy.maximum.reduceat(peaks, starts)
+        wanted = numpy.minimum(1.0, self.ceiling / numpy.maximum(peaks, 1.0))
+
+        if wanted.min() >= 1.0 and self.gain >= 1.0:
+            # Nothing to limit, the common case.
+            return samples
+
+        gains = numpy.empty(len(wanted))
+        gain = self.gain
+        for index, target in enumerate(wanted):
+            gain = min(target, gain / self.release)
+            gains[index] = gain
+        curve = numpy.interp(numpy.arange(frames),
+                             starts + self.block_frames // 2,
+                             gains)
+        # Never let the interpolation overshoot a block that needs it.
+        curve = numpy.minimum(curve, numpy.repeat(gains, self.block_frames)
+                              [:frames])
+        self.gain = min(gain, 1.0)
+        return samples * curve[:, numpy.newaxis]
+
+
+class Normalizer(object):
+    """
+    Applies loudness normalization to PCM in place.
+
+    :param cache: The :class:`LoudnessCache` to look songs up in.
+    :param target: The loudness to normalize to in LUFS.
+    :param max_gain: The maximum gain in dB applied to quiet songs.
+    :param ceiling_db: The ceiling of the :class:`Limiter`.
+    """
+    def __init__(self, cache, target=TARGET_LUFS, max_gain=12.0,
+                 ceiling_db=-1.0):
+        super(Normalizer, self).__init__()
+        self.cache = cache
+        self.target = target
+        self.max_gain = max_gain
+        self.limiter = Limiter(ceiling_db)
+
+    def gain(self, filename):
+        """Returns the gain in dB to apply to `filename`, or None if its
+        loudness is unknown."""
+        entry = self.cache.get(filename)
+        if entry is None:
+            return None
+        loudness, peak = entry
+        return min(self.target - loudness, self.max_gain)
+
+    def apply(self, view, gain):
+        """Applies `gain` dB to the PCM in the writable memoryview `view`,
+        a partial frame at the end is left alone."""
+        view = view[:len(view) - len(view) % BLOCK_ALIGN]
+        if not len(view):
+            return
+        samples = dsp.to_samples(view.tobytes()).astype(numpy.float64)
+        if gain:
+            samples *= 10 ** (gain / 20.0)
+        samples = self.limiter.process(samples)
+        view[:] = dsp.from_samples(samples)
@@ -1,17 +1,110 @@
 from __future__ import absolute_import
 from collections import defaultdict
 import threading
+import time
 
 import chan
 
+from . import metrics
+from . import garbage
+from . import pool
+from . import registry
+from .buffered import BufferedSource
+from .clock import PlayoutClock
+from .watchdog import Watchdog
+
 
 class Manager(object):
+    """
+    The pipes are given as classes, or as names which are looked up in the
+    :mod:`~hanyuu.streamer.registry`. The module of a pipe given by name is
+    only imported here.
+
+    =======
+    Options
+    =======
+
+    Next to the options of the pipes, the manager itself accepts the
+    following options:
+
+        - metrics_file:
+            A filename to periodically write the metrics of the pipeline to.
+            (defaults to None, disabled)
+        - metrics_port:
+            A port on localhost to serve the metrics of the pipeline on.
+            (defaults to None, disabled)
+        - metrics_interval:
+            The amount of seconds between writes of `metrics_file`.
+            (defaults to 10.0)
+        - metrics_registry:
+            A :class:`~hanyuu.streamer.metrics.Registry` to report to
+            instead of a new one, see
+            :meth:`~hanyuu.streamer.metrics.Registry.labelled`.
+            (defaults to None)
+        - decouple:
+            If true, a :class:`~hanyuu.streamer.buffered.BufferedSource` is
+            placed after each pipe that supports it, so every stage runs
+            ahead of the next one. See the buffered module for its options.
+            (defaults to False)
+        - watchdog_deadline:
+            If set, a :class:`~hanyuu.streamer.watchdog.Watchdog` recovers
+            stages that made no progress for this amount of seconds.
+            (defaults to None, disabled)
+        - watchdog_min_ratio:
+            The fraction of real time a stage has to keep up with, see the
+            watchdog.
+            (defaults to 0.5)
+        - watchdog_cooldown:
+            The amount of seconds a stage is left alone after the watchdog
+            recovered it.
+            (defaults to 30.0)
+
+    The metrics are kept in :attr:`metrics` regardless of the above options,
+    see :mod:`hanyuu.streamer.metrics` for the format. Where the stream is
+    on air is kept in :attr:`clock`, see :mod:`hanyuu.streamer.clock`.
+    """
     def __init__(self, source, pipes, options=None):
         super(Manager, self).__init__()
         self.events = defaultdict(list)
 
         options = options or {}
 
+        #: The :class:`pool.BufferPool` the pipes take their buffers from.
+        self.buffers = pool.BufferPool()
+
+        #: The :class:`metrics.Registry` the pipes report their state to.
+        self.metrics = options.get("metrics_registry") or metrics.Registry()
+        self.exporter = metrics.Exporter(
+            self.metrics,
+            filename=options.get("metrics_file"),
+            port=options.get("metrics_port"),
+            interval=float(options.get("metrics_interval", 10.0)),
+        )
+        self.emit_metrics = self.metrics.histogram(
+            "streamer_emit_seconds",
+            "Time spent delivering an event to all registered channels.")
+        self.metrics.gauge(
+            "streamer_buffer_pool_allocated",
+            "Buffers created by the buffer pool.",
+            function=lambda: self.buffers.allocated)
+        self.metrics.gauge(
+            "streamer_garbage_pending",
+            "Garbage waiting to be collected, in the whole process.",
+            function=lambda: len(garbage.Collector().items))
+        self.metrics.gauge(
+            "streamer_garbage_held_bytes",
+            "Bytes held by garbage waiting to be collected.",
+            function=lambda: sum(info.held_bytes for info in
+                                 garbage.Collector().info()))
+        self.metrics.gauge(
+            "streamer_garbage_oldest_seconds",
+            "Age of the oldest garbage waiting to be collected.",
+            function=lambda: max([info.age for info in
+                                  garbage.Collector().info()] or [0.0]))
+
+        #: The :class:`clock.PlayoutClock` of the audio sent out.
+        self.clock = PlayoutClock(self)
+
         # Keep the options directory around for later?
         self.options = options
         # The source is always on the manager, and isn't passed to any pipes
@@ -20,21 +113,57 @@ class Manager(object):
         # Bookkeeping on start/close calls!
         self.started = threading.Event()
 
+        self.watchdog = None
+        if options.get("watchdog_deadline"):
+            self.watchdog = Watchdog(
+                self,
+                deadline=float(options["watchdog_deadline"]),
+                min_ratio=float(options.get("watchdog_min_ratio", 0.5)),
+                cooldown=float(options.get("watchdog_cooldown", 30.0)),
+            )
+
         self.pipe_instances = []
 
-        previous_pipe = None
-        for pipe in pipes:
-            # Get the default options for this pipe, if any.
-            pipe_options = getattr(pipe, "options", {})
-            # Update them with the passed options we have.
-            pipe_options.update(options)
+        decouple = options.get("decouple", False)
 
-            instance = pipe(self, previous_pipe, pipe_options)
+        pipes = list(pipes)
+        previous_pipe = None
+        for index, pipe in enumerate(pipes):
+            pipe = registry.resolve(pipe)
+            instance = self.create_pipe(pipe, previous_pipe, options)
 
             self.pipe_instances.append(instance)
 
             previous_pipe = instance
 
+            # Decouple this pipe from the next one, unless it's the last one
+            # in which case there is nothing to decouple from.
+            is_last = index == len(pipes) - 1
+            if decouple and getattr(pipe, "decouple", False) and not is_last:
+                instance = self.create_pipe(BufferedSource, previous_pipe,
+                                            options)
+                self.pipe_instances.append(instance)
+                previous_pipe = instance
+
+    def create_pipe(self, pipe, previous_pipe, options):
+        """
+        Creates an instance of `pipe` with `previous_pipe` as its source.
+
+        :parameter pipe: The pipe class to instantiate, or its name in the
+                         :mod:`~hanyuu.streamer.registry`.
+        :parameter previous_pipe: The pipe instance before it, or None.
+        :parameter options: The options passed to the manager.
+        :returns: The pipe instance.
+        """
+        pipe = registry.resolve(pipe)
+        # Get the default options for this pipe, if any. These are copied
+        # so the options of one manager don't end up in another.
+        pipe_options = dict(getattr(pipe, "options", {}))
+        # Update them with the passed options we have.
+        pipe_options.update(options)
+
+        return pipe(self, previous_pipe, pipe_options)
+
     def start(self):
         """
         Starts the manager and pipes registered.
@@ -45,6 +174,9 @@ class Manager(object):
         if not self.started.is_set():
             for instance in self.pipe_instances:
                 instance.start()
+            self.exporter.start()
+            if self.watchdog is not None:
+                self.watchdog.start()
             self.started.set()
 
     def close(self):
@@ -56,9 +188,14 @@ class Manager(object):
         """
         self.started.clear()
 
+        if self.watchdog is not None:
+            self.watchdog.close()
+
         for instance in self.pipe_instances:
             instance.close()
 
+        self.exporter.close()
+
     def register(self, event):
         """
         Register yourself for an event, you will receive a channel that
@@ -73,18 +210,26 @@ class Manager(object):
 
         return c
 
-    def emit(self, event, obj):
+    def emit(self, event, obj, timeout=None):
         """
         Emits an event to all channels registered.
 
         :parameter event: The event to emit for.
         :parameter obj: The object to send on the channel with the emit.
+        :parameter timeout: If given, channels that are still full after
+                            this many seconds miss the event, instead of
+                            us waiting on them.
         """
+        start = time.time()
         channels = self.events.get(event, [])
-        for c in channels:
+        for c in list(channels):
             try:
-                c.put(obj)
+                c.put(obj, timeout)
             except chan.ChanClosed:
                 channels.remove(c)
                 continue
+            except chan.Timeout:
+                # The channel misses this one.
+                continue
         self.events[event] = channels
+        self.emit_metrics.observe(time.time() - start)
@@ -0,0 +1,361 @@
+"""
+A small metrics module for the audio pipeline.
+
+Every :class:`~hanyuu.streamer.manager.Manager` owns a :class:`Registry` that
+the pipes use to report what they are doing. The registry can be rendered in
+the Prometheus text exposition format and exported by an :class:`Exporter`,
+either to a file that is rewritten periodically or on a local HTTP port.
+
+The collectors are intentionally simple so they can be left on all the time,
+an observation is a couple of attribute updates and a :func:`bisect.bisect`
+call. Updates are not locked, each collector is expected to be written to by
+a single thread (the thread running the stage it belongs to).
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import BaseHTTPServer
+import threading
+import logging
+import bisect
+import time
+import os
+
+
+logger = logging.getLogger("streamer.metrics")
+
+#: Default buckets for read call latency histograms, in seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    """A value that only ever goes up."""
+    kind = "counter"
+
+    def __init__(self):
+        super(Counter, self).__init__()
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge(object):
+    """A value that can go up and down.
+
+    If `function` is given the value is calculated by calling it at
+    render time instead of being set by the owner.
+    """
+    kind = "gauge"
+
+    def __init__(self, function=None):
+        super(Gauge, self).__init__()
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self, name, labels):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                logger.exception("Gauge function for %s failed.", name)
+                return
+        yield name, labels, value
+
+
+class Histogram(object):
+    """A cumulative histogram with fixed upper bounds."""
+    kind = "histogram"
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__()
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield (name + "_bucket",
+                   labels + (("le", format_value(bound)),), cumulative)
+        yield name + "_bucket", labels + (("le", "+Inf"),), self.count
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, self.count
+
+
+class Rate(object):
+    """Calculates the per second rate of a :class:`Counter` between
+    consecutive renders. Used for the bytes per second gauges."""
+    kind = "gauge"
+
+    def __init__(self, counter):
+        super(Rate, self).__init__()
+        self.counter = counter
+        self.last_value = counter.value
+        self.last_time = time.time()
+        self.value = 0.0
+
+    def samples(self, name, labels):
+        now, value = time.time(), self.counter.value
+        elapsed = now - self.last_time
+        if elapsed > 0:
+            self.value = (value - self.last_value) / elapsed
+            self.last_value, self.last_time = value, now
+        yield name, labels, self.value
+
+
+class StageMetrics(object):
+    """The standard set of collectors of a single pipeline stage.
+
+    :param registry: The :class:`Registry` to register the collectors on.
+    :param stage: The name of the stage, used as `stage` label.
+    """
+    def __init__(self, registry, stage):
+        super(StageMetrics, self).__init__()
+        #: The name of the stage.
+        self.stage = stage
+        labels = {"stage": stage}
+        self.bytes = registry.counter(
+            "streamer_stage_bytes_total",
+            "Bytes returned by read calls of the stage.", labels)
+        self.reads = registry.counter(
+            "streamer_stage_reads_total",
+            "Read calls done on the stage.", labels)
+        self.empty = registry.counter(
+            "streamer_stage_empty_reads_total",
+            "Read calls on the stage that returned no data.", labels)
+        self.latency = registry.histogram(
+            "streamer_stage_read_seconds",
+            "Latency of read calls on the stage.", labels)
+        registry.register("streamer_stage_bytes_per_second",
+                          "Bytes per second returned by the stage since "
+                          "the previous scrape.", labels, Rate(self.bytes))
+        #: The time the stage was first asked for data since it last
+        #: returned any, None while it returns data.
+        self.asked = None
+
+    def begin(self):
+        """Marks the start of a read call, returns the time it started at.
+        Pass the duration since then on to :meth:`observe`."""
+        now = time.time()
+        if self.asked is None:
+            self.asked = now
+        return now
+
+    def observe(self, size, duration):
+        """Records a single read call that returned `size` bytes and took
+        `duration` seconds."""
+        self.reads.value += 1
+        self.bytes.value += size
+        if not size:
+            self.empty.value += 1
+        else:
+            self.asked = None
+        self.latency.observe(duration)
+
+    def waiting(self, now=None):
+        """Returns the amount of seconds the stage has been asked for data
+        without returning any, 0.0 if it isn't."""
+        asked = self.asked
+        if asked is None:
+            return 0.0
+        return (time.time() if now is None else now) - asked
+
+
+class Registry(object):
+    """A collection of named collectors.
+
+    Collectors are identified by their name and labels, asking for the
+    same combination twice returns the same collector.
+    """
+    def __init__(self):
+        super(Registry, self).__init__()
+        self.lock = threading.Lock()
+        # name -> (kind, help text)
+        self.descriptions = {}
+        # name -> {labels: collector}
+        self.collectors = {}
+        #: Labels added to every collector registered through this registry.
+        self.labels = {}
+
+    def labelled(self, labels):
+        """Returns a registry sharing its collectors with this one, that
+        adds `labels` to every collector registered through it.
+
+        This lets several managers in one process report to one registry
+        without their collectors colliding.
+        """
+        registry = Registry.__new__(Registry)
+        registry.__dict__.update(self.__dict__)
+        registry.labels = dict(self.labels, **labels)
+        return registry
+
+    def register(self, name, help, labels, collector):
+        """Registers `collector` under `name` with `labels`. Returns the
+        collector already registered if there is one."""
+        labels = dict(self.labels, **(labels or {}))
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            self.descriptions.setdefault(name, (collector.kind, help))
+            collectors = self.collectors.setdefault(name, {})
+            return collectors.setdefault(labels, collector)
+
+    def unregister(self, labels):
+        """Removes every collector that has all of `labels`, such as those
+        of a registry returned by :meth:`labelled` that is done with."""
+        labels = set(labels.items())
+        with self.lock:
+            for name, collectors in list(self.collectors.items()):
+                for key in list(collectors):
+                    if labels <= set(key):
+                        del collectors[key]
+                if not collectors:
+                    del self.collectors[name]
+                    del self.descriptions[name]
+
+    def counter(self, name, help="", labels=None):
+        return self.register(name, help, labels, Counter())
+
+    def gauge(self, name, help="", labels=None, function=None):
+        return self.register(name, help, labels, Gauge(function))
+
+    def histogram(self, name, help="", labels=None, buckets=LATENCY_BUCKETS):
+        return self.register(name, help, labels, Histogram(buckets))
+
+    def stage(self, stage):
+        """Returns a :class:`StageMetrics` for the stage named `stage`."""
+        return StageMetrics(self, stage)
+
+    def render(self):
+        """Returns the current state of all collectors in the Prometheus
+        text exposition format."""
+        with self.lock:
+            items = [(name, self.descriptions[name],
+                      sorted(collectors.items()))
+                     for name, collectors in sorted(self.collectors.items())]
+
+        lines = []
+        for name, (kind, help), collectors in items:
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, collector in collectors:
+                for sample, sample_labels, value in collector.samples(
+                        name, labels):
+                    lines.append("{}{} {}".format(sample,
+                                                  format_labels(sample_labels),
+                                                  format_value(value)))
+        lines.append("")
+        return "\n".join(lines)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, value)
+                          for key, value in labels) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Exporter(object):
+    """
+    Exports a :class:`Registry` so it can be scraped.
+
+    :param registry: The :class:`Registry` to export.
+    :param filename: If given, a file that gets atomically rewritten every
+                     `interval` seconds with the rendered metrics.
+    :param port: If given, a port on `host` to serve the rendered metrics on
+                 over plain HTTP.
+    :param interval: The amount of seconds between file writes.
+    """
+    def __init__(self, registry, filename=None, port=None,
+                 host="localhost", interval=10.0):
+        super(Exporter, self).__init__()
+        self.registry = registry
+        self.filename = filename
+        self.port = port
+        self.host = host
+        self.interval = interval
+
+        self.stopped = threading.Event()
+        self.server = None
+
+    def start(self):
+        self.stopped.clear()
+        if self.filename:
+            thread = threading.Thread(target=self.run_file,
+                                      name="Metrics Writer")
+            thread.daemon = True
+            thread.start()
+        if self.port:
+            self.server = MetricsServer((self.host, int(self.port)),
+                                        MetricsHandler)
+            self.server.registry = self.registry
+            thread = threading.Thread(target=self.server.serve_forever,
+                                      name="Metrics Server")
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def run_file(self):
+        while not self.stopped.is_set():
+            try:
+                self.write()
+            except (IOError, OSError):
+                logger.exception("Failed writing metrics file.")
+            self.stopped.wait(self.interval)
+
+    def write(self):
+        temporary = self.filename + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(self.registry.render().encode("utf8"))
+        os.rename(temporary, self.filename)
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.registry.render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
@@ -0,0 +1,315 @@
+"""
+A local HTTP endpoint serving the encoded stream as it's sent out.
+
+The :class:`Monitor` tap serves whatever passes through it to any HTTP
+client connecting to its port, without the buffering of an Icecast server
+in between. This is meant for listening in on what is on air, as a direct
+feed for relays, and for testing without an Icecast server:
+
+    Manager(queue, [FileSource, Encoder, Monitor, Icecast], options)
+
+A client connecting first gets a short burst of the latest audio, so
+players start right away, and then the stream live. Sockets of clients are
+never blocked on, a client that falls behind by more than
+`monitor_client_buffer` bytes is disconnected.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import deque
+import threading
+import logging
+import select
+import socket
+import errno
+import time
+
+from .tap import Tap
+from . import mp3
+
+
+logger = logging.getLogger("streamer.monitor")
+
+RESPONSE = (b"HTTP/1.0 200 OK\r\n"
+            b"Content-Type: audio/mpeg\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: close\r\n"
+            b"\r\n")
+
+
+class Client(object):
+    """A connected client and the data not yet sent to it."""
+    def __init__(self, sock, address):
+        super(Client, self).__init__()
+        self.sock = sock
+        self.address = address
+        self.pending = bytearray()
+        #: The amount of pending bytes at which the client is dropped.
+        self.limit = 0
+
+    def send(self):
+        """Sends as much of the pending data as the socket takes without
+        blocking. Raises :exc:`socket.error` if the client is gone."""
+        if not self.pending:
+            return
+        try:
+            sent = self.sock.send(self.pending)
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        del self.pending[:sent]
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class Request(object):
+    """A connection of which the request isn't read yet."""
+    def __init__(self, sock, address, deadline):
+        super(Request, self).__init__()
+        self.sock = sock
+        self.address = address
+        self.deadline = deadline
+        self.data = b''
+
+
+class Monitor(Tap):
+    """
+    ======
+    Source
+    ======
+
+    The source should return an MPEG audio stream, such as the
+    :class:`~hanyuu.streamer.encoder.Encoder`, the burst starts on a frame.
+
+    =======
+    Options
+    =======
+
+    Next to the options of :class:`~hanyuu.streamer.tap.Tap`:
+
+        - monitor_host:
+            The address to listen on.
+            (defaults to "127.0.0.1")
+        - monitor_port:
+            The port to listen on.
+            (defaults to 8001)
+        - monitor_burst_seconds:
+            The amount of seconds of audio sent to a client right away.
+            (defaults to 2.0)
+        - monitor_client_buffer:
+            The amount of bytes a client can fall behind, after the burst,
+            before it's disconnected.
+            (defaults to 262144)
+        - monitor_max_clients:
+            The amount of clients served at the same time.
+            (defaults to 32)
+    """
+    options = {
+        "tap_queue_size": 512,
+        "monitor_host": "127.0.0.1",
+        "monitor_port": 8001,
+        "monitor_burst_seconds": 2.0,
+        "monitor_client_buffer": 262144,
+        "monitor_max_clients": 32,
+    }
+    frames = True
+    #: The amount of seconds a client gets to send its whole request.
+    request_timeout = 5.0
+    #: The largest request we read.
+    max_request_size = 8192
+
+    def __init__(self, manager, pipe, options):
+        super(Monitor, self).__init__(manager, pipe, options)
+        self.address = (options["monitor_host"], int(options["monitor_port"]))
+        self.burst_seconds = float(options["monitor_burst_seconds"])
+        self.client_buffer = int(options["monitor_client_buffer"])
+        self.max_clients = int(options["monitor_max_clients"])
+
+        #: The latest frames as (duration, frame), the burst for new clients.
+        self.burst = deque()
+        self.burst_duration = 0.0
+        self.clients = []
+        self.lock = threading.Lock()
+        self.server = None
+
+        registry = manager.metrics
+        registry.gauge(
+            "streamer_monitor_clients",
+            "Clients connected to the monitor endpoint.",
+            function=lambda: len(self.clients))
+        self.dropped_clients = registry.counter(
+            "streamer_monitor_dropped_clients_total",
+            "Monitor clients disconnected for falling behind.")
+
+    def write_frame(self, header, frame, timestamp):
+        duration = mp3.duration(header)
+        with self.lock:
+            self.burst.append((duration, frame))
+            self.burst_duration += duration
+            while self.burst_duration > self.burst_seconds:
+                old, _ = self.burst.popleft()
+                self.burst_duration -= old
+
+            for client in list(self.clients):
+                client.pending += frame
+                if len(client.pending) > client.limit:
+                    logger.info("Monitor client %s fell behind, dropping.",
+                                client.address)
+                    self.dropped_clients.inc()
+                    self.remove(client)
+                    continue
+                try:
+                    client.send()
+                except socket.error:
+                    self.remove(client)
+
+    def remove(self, client):
+        """Internal method
+
+        Disconnects `client`, the caller should hold :attr:`lock`.
+        """
+        self.clients.remove(client)
+        client.close()
+
+    def serve(self):
+        """Internal method
+
+        Runs in its own thread, accepts clients and reads their requests.
+        No socket is ever blocked on, a slow client can't hold up others.
+        """
+        server = self.server
+        # socket -> Request
+        requests = {}
+        while self.running.is_set():
+            try:
+                readable, _, _ = select.select([server] + list(requests),
+                                               [], [], 1.0)
+            except (select.error, socket.error):
+                if self.running.is_set():
+                    logger.exception("Monitor failed waiting on clients.")
+                break
+
+            for sock in readable:
+                if sock is server:
+                    self.incoming(server, requests)
+                    continue
+                request = requests[sock]
+                try:
+                    done = self.receive(request)
+                except socket.error:
+                    logger.warning("Monitor client %s failed to connect.",
+                                   request.address)
+                    done = True
+                    sock.close()
+                if done:
+                    del requests[sock]
+
+            now = time.time()
+            for sock, request in list(requests.items()):
+                if now > request.deadline:
+                    logger.info("Monitor client %s sent no request.",
+                                request.address)
+                    del requests[sock]
+                    sock.close()
+
+        for sock in requests:
+            sock.close()
+
+    def incoming(self, server, requests):
+        """Internal method
+
+        Accepts a new connection on `server` and adds it to `requests`.
+        """
+        try:
+            sock, address = server.accept()
+        except socket.error as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                logger.exception("Monitor failed accepting a client.")
+            return
+        if len(requests) >= self.max_clients:
+            # Waiting requests don't get to crowd out everyone else.
+            sock.close()
+            return
+        sock.setblocking(0)
+        requests[sock] = Request(sock, address,
+                                 time.time() + self.request_timeout)
+
+    def receive(self, request):
+        """Internal method
+
+        Reads what `request` sent, returns True once it's done with: the
+        request is complete and the client accepted, or it disconnected.
+        """
+        try:
+            data = request.sock.recv(1024)
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        if not data:
+            request.sock.close()
+            return True
+        request.data += data
+        if (b"\r\n\r\n" not in request.data and
+                len(request.data) < self.max_request_size):
+            return False
+        self.accept(request.sock, request.address)
+        return True
+
+    def accept(self, sock, address):
+        """Internal method
+
+        Adds a client of which the request was read to the clients.
+        """
+        with self.lock:
+            if len(self.clients) >= self.max_clients:
+                try:
+                    sock.send(b"HTTP/1.0 503 Service Unavailable\r\n\r\n")
+                except socket.error:
+                    pass
+                sock.close()
+                return
+            client = Client(sock, address)
+            client.pending += RESPONSE
+            for duration, frame in self.burst:
+                client.pending += frame
+            # The burst itself doesn't count as falling behind.
+            client.limit = len(client.pending) + self.client_buffer
+            self.clients.append(client)
+        logger.info("Monitor client connected from %s", address)
+
+    def flush(self):
+        with self.lock:
+            for client in list(self.clients):
+                self.remove(client)
+
+    def start(self):
+        if self.running.is_set():
+            return
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(self.address)
+        self.server.listen(5)
+        self.server.setblocking(0)
+        super(Monitor, self).start()
+
+        self.server_thread = threading.Thread(target=self.serve,
+                                              name="Monitor Server")
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def close(self):
+        super(Monitor, self).close()
+        if self.server is not None:
+            try:
+                self.server.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.server.close()
+            self.server = None
@@ -0,0 +1,222 @@
+"""
+Parsing of MPEG audio frame headers.
+
+The pipes after the :class:`~hanyuu.streamer.encoder.Encoder` read the MP3
+stream in arbitrary chunks, the :class:`FrameParser` turns those back into
+whole frames so they can be cut, indexed and timed on frame boundaries.
+Only the frame headers are looked at, the audio data is never decoded.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import namedtuple
+
+
+# Indexed by [version][layer] -> bitrates in kbit/s, version 1 is MPEG-1 and
+# version 2 covers both MPEG-2 and MPEG-2.5.
+BITRATES = {
+    1: {
+        1: (0, 32, 64, 96, 128, 160, 192, 224,
+            256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112,
+            128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96,
+            112, 128, 160, 192, 224, 256, 320),
+    },
+    2: {
+        1: (0, 32, 48, 56, 64, 80, 96, 112,
+            128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56,
+            64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56,
+            64, 80, 96, 112, 128, 144, 160),
+    },
+}
+
+# Indexed by the version bits of the header.
+SAMPLE_RATES = {
+    0: (11025, 12000, 8000),   # MPEG-2.5
+    2: (22050, 24000, 16000),  # MPEG-2
+    3: (44100, 48000, 32000),  # MPEG-1
+}
+
+#: A parsed frame header.
+#:
+#: `size` is the size of the whole frame in bytes, `samples` the amount of
+#: samples per channel it decodes to.
+Header = namedtuple("Header", ("version", "layer", "bitrate", "sample_rate",
+                               "channels", "size", "samples"))
+
+
+def parse_header(data, offset=0):
+    """Returns the :class:`Header` of the frame at `offset` in `data`, or
+    None if there is no valid frame header there."""
+    if len(data) < offset + 4:
+        return None
+    b1, b2, b3 = (ord(data[offset + 1:offset + 2]),
+                  ord(data[offset + 2:offset + 3]),
+                  ord(data[offset + 3:offset + 4]))
+    if data[offset:offset + 1] != b'\xff' or b1 & 0xe0 != 0xe0:
+        return None
+
+    version_bits = (b1 >> 3) & 0x03
+    layer = 4 - ((b1 >> 1) & 0x03)
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 0x03
+    if (version_bits == 1 or layer == 4 or bitrate_index in (0, 15) or
+            rate_index == 3):
+        # Reserved values, or free format which we don't produce.
+        return None
+
+    version = 1 if version_bits == 3 else 2
+    bitrate = BITRATES[version][layer][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version_bits][rate_index]
+    padding = (b2 >> 1) & 0x01
+    channels = 1 if (b3 >> 6) == 3 else 2
+
+    if layer == 1:
+        samples = 384
+        size = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if layer == 2 or version == 1 else 576
+        size = samples // 8 * bitrate // sample_rate + padding
+    return Header(version, layer, bitrate, sample_rate, channels, size,
+                  samples)
+
+
+class FrameParser(object):
+    """
+    Splits a stream of MPEG audio fed in arbitrary chunks into frames.
+
+    Data that isn't part of a frame, such as an ID3 tag or garbage after a
+    restart of the encoder, is skipped until the next pair of valid frames.
+    """
+    def __init__(self):
+        super(FrameParser, self).__init__()
+        self.data = b''
+        #: The amount of bytes skipped while looking for frames.
+        self.skipped = 0
+
+    def feed(self, data):
+        """Adds `data` to the stream and returns a list of (header, frame)
+        tuples for the frames completed by it."""
+        data = self.data + data
+        frames = []
+        offset = 0
+        while True:
+            header = parse_header(data, offset)
+            if header is None or not self.synced(data, offset, header):
+                if len(data) - offset < 4:
+                    break
+                # Lost sync, look for the next frame.
+                position = data.find(b'\xff', offset + 1)
+                if position == -1:
+                    position = len(data)
+                self.skipped += position - offset
+                offset = position
+                continue
+            if len(data) < offset + header.size:
+                break
+            frames.append((header, data[offset:offset + header.size]))
+            offset += header.size
+        self.data = data[offset:]
+        return frames
+
+    def synced(self, data, offset, header):
+        """Internal method
+
+        Returns False if the frame after the one at `offset` is known to not
+        be valid. A lone sync word inside audio data is easily mistaken for
+        a header, a real frame is followed by another.
+        """
+        following = offset + header.size
+        if len(data) < following + 4:
+            # We can't tell yet, and the stream is nearly always in sync.
+            return True
+        return parse_header(data, following) is not None
+
+
+def duration(header):
+    """Returns the amount of seconds of audio in a frame."""
+    return float(header.samples) / header.sample_rate
+
+
+def main_data_begin(frame):
+    """Returns how many bytes back into previous frames the audio data of
+    the layer III `frame` starts, the use of the bit reservoir. A frame
+    returning 0 can be decoded without any of the frames before it."""
+    header = parse_header(frame)
+    if header is None or header.layer != 3:
+        return 0
+    # The side information follows the header, and the CRC if there is one.
+    offset = 4 if ord(frame[1:2]) & 0x01 else 6
+    if len(frame) < offset + 2:
+        return 0
+    value = (ord(frame[offset:offset + 1]) << 8) | ord(frame[offset + 1:
+                                                              offset + 2])
+    if header.version == 1:
+        return value >> 7
+    return value >> 8
+
+
+def uses_reservoir(data):
+    """Returns True if any of the whole frames in `data` uses the bit
+    reservoir, see :func:`main_data_begin`. The first frame of a stream
+    never does, there is nothing before it."""
+    return any(main_data_begin(frame)
+               for header, frame in FrameParser().feed(data))
+
+
+class FrameCounter(object):
+    """
+    Counts the audio in a stream of MPEG audio fed in arbitrary chunks.
+    Unlike the :class:`FrameParser` the frames are never copied, only their
+    headers are looked at.
+    """
+    def __init__(self):
+        super(FrameCounter, self).__init__()
+        # Bytes of the current frame still to come in the next chunk.
+        self.skip = 0
+        # The start of a header cut off at the end of the previous chunk.
+        self.partial = b''
+
+    def feed(self, data, size=None):
+        """Returns the seconds of audio in the frames starting in the first
+        `size` bytes of `data`, a string or bytearray."""
+        size = len(data) if size is None else size
+        seconds = 0.0
+        offset = min(self.skip, size)
+        self.skip -= offset
+
+        if self.partial and offset < size:
+            needed = 4 - len(self.partial)
+            if size - offset < needed:
+                self.partial += bytes(data[offset:size])
+                return seconds
+            header = parse_header(self.partial + bytes(data[offset:
+                                                            offset + needed]))
+            if header is not None:
+                seconds += duration(header)
+                end = offset + header.size - len(self.partial)
+                self.skip = max(end - size, 0)
+                offset = min(end, size)
+            self.partial = b''
+
+        while offset < size:
+            if size - offset < 4:
+                self.partial = bytes(data[offset:size])
+                break
+            header = parse_header(data, offset)
+            if header is None:
+                # Lost sync, look for the next frame.
+                position = data.find(b'\xff', offset + 1, size)
+                offset = size if position == -1 else position
+                continue
+            seconds += duration(header)
+            end = offset + header.size
+            if end > size:
+                self.skip = end - size
+                break
+            offset = end
+        return seconds
@@ -0,0 +1,175 @@
+"""
+Lossless compression of preload buffers.
+
+A preload buffer holds the whole song as 24-bit PCM, several times the size
+of the file it came from. With the `preload_compress` option of the
+:class:`~hanyuu.streamer.preloader.PreloadedFileSource` the buffer is kept
+as a :class:`PackedBuffer` instead, compressed in blocks of
+:data:`BLOCK_SIZE` bytes while the song is decoded.
+
+Each block is shuffled into byte planes before it goes through zlib: the
+low, middle and high bytes of the samples are stored one after the other.
+The low byte of audio decoded from 16-bit sources is always zero and the
+high bytes of neighbouring samples are alike, which zlib picks up on where
+it can't in the interleaved samples.
+
+A :class:`PackedReader` decompresses a single block at a time and serves
+reads from it until the reads move past it, the time spent decompressing is
+reported to the `observe` function it's given.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import logging
+import zlib
+import time
+
+from .pcm import BLOCK_ALIGN
+
+
+logger = logging.getLogger("streamer.packed")
+
+#: The amount of bytes of PCM in a block, about a third of a second.
+BLOCK_SIZE = 16384 * BLOCK_ALIGN
+#: The width in bytes of a sample, the amount of byte planes.
+SAMPLE_WIDTH = 3
+
+
+def shuffle(data):
+    """Returns `data` with the bytes of each sample split over byte
+    planes."""
+    return b''.join(data[plane::SAMPLE_WIDTH]
+                    for plane in range(SAMPLE_WIDTH))
+
+
+def unshuffle(data, size):
+    """Returns the `size` bytes shuffled into `data` by :func:`shuffle`, as
+    a bytearray."""
+    output = bytearray(size)
+    start = 0
+    for plane in range(SAMPLE_WIDTH):
+        length = (size - plane + SAMPLE_WIDTH - 1) // SAMPLE_WIDTH
+        output[plane::SAMPLE_WIDTH] = data[start:start + length]
+        start += length
+    return output
+
+
+def held_bytes(buffer):
+    """Returns the amount of memory taken by `buffer`, a preload buffer that
+    may or may not be a :class:`PackedBuffer`."""
+    if isinstance(buffer, PackedBuffer):
+        return buffer.held_bytes
+    return len(buffer)
+
+
+class PackedBuffer(object):
+    """
+    PCM compressed in blocks, made by a :class:`Packer`. The length of the
+    buffer is the amount of bytes of PCM in it, :attr:`held_bytes` the
+    amount of memory it takes.
+    """
+    def __init__(self, blocks, size, block_size=BLOCK_SIZE):
+        super(PackedBuffer, self).__init__()
+        self.blocks = blocks
+        self.size = size
+        self.block_size = block_size
+        #: The amount of bytes of compressed data.
+        self.held_bytes = sum(len(block) for block in blocks)
+
+    def __len__(self):
+        return self.size
+
+    def ratio(self):
+        """Returns the size of the PCM relative to the compressed data."""
+        return float(self.size) / max(self.held_bytes, 1)
+
+    def block(self, index):
+        """Returns the PCM of block `index` as a bytearray."""
+        start = index * self.block_size
+        size = min(self.block_size, self.size - start)
+        return unshuffle(zlib.decompress(self.blocks[index]), size)
+
+    def reader(self, observe=None):
+        """Returns a new :class:`PackedReader` of this buffer."""
+        return PackedReader(self, observe)
+
+
+class Packer(object):
+    """
+    Compresses PCM fed to it in chunks of any size into a
+    :class:`PackedBuffer`, only a block of uncompressed audio is held at a
+    time.
+
+    :param level: The zlib compression level.
+    """
+    def __init__(self, level=1, block_size=BLOCK_SIZE):
+        super(Packer, self).__init__()
+        self.level = level
+        self.block_size = block_size
+        self.blocks = []
+        self.pending = bytearray()
+        self.size = 0
+
+    def feed(self, data):
+        self.pending += data
+        self.size += len(data)
+        while len(self.pending) >= self.block_size:
+            self.pack(bytes(self.pending[:self.block_size]))
+            del self.pending[:self.block_size]
+
+    def pack(self, data):
+        """Internal method
+
+        Compresses a block of PCM.
+        """
+        self.blocks.append(zlib.compress(shuffle(data), self.level))
+
+    def finish(self):
+        """Returns the :class:`PackedBuffer` of everything fed."""
+        if self.pending:
+            self.pack(bytes(self.pending))
+            self.pending = bytearray()
+        return PackedBuffer(self.blocks, self.size, self.block_size)
+
+
+class PackedReader(object):
+    """
+    Reads from a :class:`PackedBuffer`, keeping the last block read
+    decompressed. Several readers can read from the same buffer.
+
+    :param observe: Called with the seconds spent on each block
+                    decompressed.
+    """
+    def __init__(self, buffer, observe=None):
+        super(PackedReader, self).__init__()
+        self.buffer = buffer
+        self.observe = observe
+        self.index = None
+        self.data = None
+
+    def readinto(self, offset, view):
+        """Copies the PCM at `offset` into `view` and returns the amount of
+        bytes copied, less than asked only at the end of the buffer."""
+        block_size = self.buffer.block_size
+        size = min(len(view), max(len(self.buffer) - offset, 0))
+        copied = 0
+        while copied < size:
+            index, start = divmod(offset + copied, block_size)
+            if index != self.index:
+                began = time.time()
+                self.data = self.buffer.block(index)
+                self.index = index
+                if self.observe is not None:
+                    self.observe(time.time() - began)
+            part = memoryview(self.data)[start:start + size - copied]
+            view[copied:copied + len(part)] = part
+            copied += len(part)
+        return copied
+
+    def read(self, offset, size):
+        """Returns the PCM at `offset`, `size` bytes or less at the end of
+        the buffer."""
+        data = bytearray(max(min(size, len(self.buffer) - offset), 0))
+        length = self.readinto(offset, memoryview(data))
+        return bytes(data[:length])
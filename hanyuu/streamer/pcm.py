@@ -0,0 +1,20 @@
+"""
+The PCM format the pipeline works in, every
+:class:`~hanyuu.streamer.files.AudioFile` is converted to it.
+
+This module has no dependencies, pipes that only need the format import it
+from here instead of from :mod:`hanyuu.streamer.files`, which needs
+audiotools.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+BITS_PER_SAMPLE = 24
+#: The size in bytes of a single PCM frame (one sample for each channel).
+BLOCK_ALIGN = CHANNELS * BITS_PER_SAMPLE // 8
+#: The amount of bytes of PCM in a second of audio.
+BYTE_RATE = SAMPLE_RATE * BLOCK_ALIGN
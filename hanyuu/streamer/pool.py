@@ -0,0 +1,87 @@
+"""
+Buffer reuse through the pipeline.
+
+Next to `read(size)` a pipe can implement `readinto(buffer, timeout)`, which
+reads into a preallocated :const:`bytearray` and returns the amount of bytes
+read. Consumers should call :func:`readinto` instead of the method directly,
+it falls back to `read` for pipes that don't implement it.
+
+The buffers themselves come from a :class:`BufferPool`, every
+:class:`~hanyuu.streamer.manager.Manager` has one as its `buffers`
+attribute. In steady state streaming the same few buffers are passed around
+and almost nothing is allocated per chunk.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+import weakref
+
+
+# What `read` returned past the size asked for, by source. Kept for the next
+# call of :func:`readinto` on the same source.
+leftovers = weakref.WeakKeyDictionary()
+leftovers_lock = threading.Lock()
+
+
+def readinto(source, buffer, timeout=10.0):
+    """
+    Reads from `source` into `buffer`.
+
+    Uses the `readinto` method of `source` if its class has one, otherwise
+    `read` is called and the result copied into `buffer`; a source
+    returning more than fits gets the rest returned by the next call. The
+    method is looked up on the class so that pipes delegating attributes to
+    their source don't get skipped over.
+
+    :returns: The amount of bytes read into `buffer`, 0 signifies no data.
+    """
+    if getattr(type(source), "readinto", None) is not None:
+        return source.readinto(buffer, timeout)
+
+    with leftovers_lock:
+        data = leftovers.pop(source, None)
+    if data is None:
+        data = source.read(len(buffer), timeout)
+    size = min(len(data), len(buffer))
+    buffer[:size] = memoryview(data)[:size]
+    if size < len(data):
+        # Growing the buffer would drop it from its pool.
+        with leftovers_lock:
+            leftovers[source] = data[size:]
+    return size
+
+
+class BufferPool(object):
+    """
+    A pool of preallocated :const:`bytearray` buffers of `size` bytes.
+
+    :param size: The size of each buffer.
+    :param count: The amount of buffers to preallocate, the pool grows past
+                  this when more are acquired at the same time.
+    """
+    def __init__(self, size=4096, count=8):
+        super(BufferPool, self).__init__()
+        self.size = size
+        self.lock = threading.Lock()
+        self.free = [bytearray(size) for _ in range(count)]
+        #: The amount of buffers created by this pool.
+        self.allocated = count
+
+    def acquire(self):
+        """Returns a buffer from the pool, creating one if the pool is
+        empty."""
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+            self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buffer):
+        """Returns `buffer` to the pool. Buffers not created by the pool are
+        ignored."""
+        if len(buffer) != self.size:
+            return
+        with self.lock:
+            self.free.append(buffer)
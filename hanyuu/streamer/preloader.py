@@ -3,26 +3,99 @@ from __future__ import unicode_literals
 
 import threading
 import logging
+import time
 from collections import deque, namedtuple
 
 import chan
 
 from .files import AudioFile
+from .cache import BufferStore, key as cache_key
+from .packed import Packer, PackedBuffer, held_bytes
+from . import dsp
 
 
 logger = logging.getLogger("streamer.preloader")
 Options = namedtuple("Options", ("preload_amount",
                                  "preload_full_amount",
                                  "preload_percentage",
-                                 "preload_push_percentage"))
+                                 "preload_push_percentage",
+                                 "preload_cache",
+                                 "preload_store",
+                                 "preload_analyze",
+                                 "preload_compress",
+                                 "silence_threshold_db",
+                                 "loudness_cache"))
 
 
 class PreloadedFileSource(object):
+    """
+    =======
+    Options
+    =======
+
+        - preload_amount:
+            The amount of songs from the queue to keep ready.
+        - preload_full_amount:
+            The amount of those songs to preload right away.
+        - preload_percentage:
+            How far into a song we start preloading the next one.
+        - preload_push_percentage:
+            How far into a song we push the next one to the file source.
+        - preload_profile:
+            A decode profile written by
+            :mod:`hanyuu.streamer.benchmark.decode`. When given, songs that
+            are estimated to take longer than `preload_slow_seconds` to
+            decode start preloading as soon as they are added.
+            (defaults to None)
+        - preload_slow_seconds:
+            See `preload_profile`. (defaults to 10.0)
+        - preload_pool:
+            An object with a `submit(function, *args)` method to run the
+            preloading on, such as the pools handed out by
+            :class:`~hanyuu.streamer.supervisor.WorkerPool`.
+            (defaults to None, a new thread for each song)
+        - preload_cache:
+            A :class:`~hanyuu.streamer.cache.StationCache` to look up
+            decoded songs in before decoding them.
+            (defaults to None)
+        - preload_store:
+            The :class:`~hanyuu.streamer.cache.BufferStore` of the preload
+            buffers in use, songs in the queue more than once share their
+            buffer. Pass the same store to several preloaders to share
+            between them.
+            (defaults to None, a store of our own)
+        - preload_analyze:
+            If true, songs are analyzed while preloading, leading and
+            trailing digital silence is trimmed and the file source can
+            crossfade them. Requires numpy, see :mod:`hanyuu.streamer.dsp`.
+            (defaults to False)
+        - silence_threshold_db:
+            The level in dBFS under which audio is considered silent.
+            (defaults to -60.0)
+        - preload_compress:
+            If true, preload buffers are kept compressed and decompressed
+            block by block as they are read, see
+            :mod:`hanyuu.streamer.packed`. This takes about half the memory
+            for a few milliseconds of work per second of audio.
+            (defaults to False)
+
+    When the `loudness_cache` option of the
+    :class:`~hanyuu.streamer.files.FileSource` is set, songs missing from it
+    are measured while they are preloaded.
+    """
     options = {
         "preload_amount": 5,
         "preload_full_amount": 2,
         "preload_percentage": 0.5,
         "preload_push_percentage": 0.8,
+        "preload_profile": None,
+        "preload_slow_seconds": 10.0,
+        "preload_pool": None,
+        "preload_cache": None,
+        "preload_store": None,
+        "preload_analyze": False,
+        "silence_threshold_db": -60.0,
+        "preload_compress": False,
     }
 
     def __init__(self, manager, pipe, options):
@@ -45,10 +118,47 @@ class PreloadedFileSource(object):
             self.preload_full_amount,
             self.preload_percentage,
             self.preload_push_percentage,
+            options.get("preload_cache"),
+            options.get("preload_store") or BufferStore(),
+            bool(options.get("preload_analyze")) and dsp.available(),
+            bool(options.get("preload_compress")),
+            float(options.get("silence_threshold_db", -60.0)),
+            self.open_loudness_cache(options.get("loudness_cache")),
         )
+        self.pool = options.get("preload_pool")
 
         self.preloaded = deque()
 
+        self.profile = None
+        if options.get("preload_profile"):
+            from .benchmark.decode import DecodeProfile
+            self.profile = DecodeProfile(options["preload_profile"])
+        self.slow_seconds = float(options.get("preload_slow_seconds", 10.0))
+
+        registry = manager.metrics
+        self.hits = registry.counter(
+            "streamer_preload_hits_total",
+            "Pushed songs that were fully preloaded.")
+        self.misses = registry.counter(
+            "streamer_preload_misses_total",
+            "Pushed songs that fell back to a non-preloaded file.")
+        registry.gauge(
+            "streamer_preload_songs",
+            "Songs currently held by the preloader.",
+            function=lambda: len(self.preloaded))
+        registry.gauge(
+            "streamer_preload_finished_songs",
+            "Songs held by the preloader that finished preloading.",
+            function=lambda: sum(1 for audiofile in list(self.preloaded)
+                                 if audiofile.finished.is_set()))
+        registry.gauge(
+            "streamer_preload_buffer_bytes",
+            "Bytes of PCM held in preload buffers, shared buffers once.",
+            function=lambda: sum(held_bytes(buffer) for buffer in dict(
+                (id(audiofile.buffer), audiofile.buffer)
+                for audiofile in list(self.preloaded)
+                if audiofile.buffer is not None).values()))
+
     def book_keeper(self, init):
         new_song = self.manager.register("preload_new_song")
         preload_next = self.manager.register("preload_next")
@@ -92,6 +202,11 @@ class PreloadedFileSource(object):
 
                 if len(self.preloaded) <= self.preload_full_amount:
                     self.manager.emit("preload_next", True)
+                elif self.is_slow(audiofile):
+                    # Decoding this one takes long, get ahead of schedule.
+                    logger.debug("Slow song, preloading early: %s",
+                                 song.metadata)
+                    self.start_preload(audiofile)
 
                 # If this is the first song, we need to push it so that
                 # there is something ready right away.
@@ -100,6 +215,10 @@ class PreloadedFileSource(object):
                     first_song = False
 
             elif action is preload_next:
+                # Skip the songs that were preloaded early for being slow.
+                while (last_preload_index < len(self.preloaded) and
+                       self.preloaded[last_preload_index].preload_started):
+                    last_preload_index += 1
                 try:
                     audiofile = self.preloaded[last_preload_index]
                 except IndexError:
@@ -107,8 +226,7 @@ class PreloadedFileSource(object):
                     logging.debug("Empty queue, failed to start preload.")
                     continue
 
-                logger.debug("Starting preload on: %s", audiofile.metadata)
-                start_thread(audiofile.preload)
+                self.start_preload(audiofile)
 
                 last_preload_index += 1
 
@@ -122,6 +240,9 @@ class PreloadedFileSource(object):
                     # for one that doesn't preload at all.
                     logger.debug("Song hasn't preloaded yet, giving out non-preload.")
                     audiofile = audiofile.non_preload()
+                    self.misses.inc()
+                else:
+                    self.hits.inc()
 
                 logger.debug("Pushing audiofile: %s", audiofile.metadata)
                 # And push it away!
@@ -157,6 +278,44 @@ class PreloadedFileSource(object):
         for c in channels:
             c.close()
 
+    def open_loudness_cache(self, filename):
+        """Returns the :class:`~hanyuu.streamer.loudness.LoudnessCache` in
+        `filename`, or None if disabled or unavailable."""
+        if not filename:
+            return None
+        from . import loudness
+        if loudness.numpy is None:
+            return None
+        return loudness.LoudnessCache(filename)
+
+    def start_preload(self, audiofile):
+        """Internal method
+
+        Starts the preload of `audiofile` in the pool, or in its own thread
+        without one.
+        """
+        logger.debug("Starting preload on: %s", audiofile.metadata)
+        audiofile.preload_started = True
+        if self.pool is not None:
+            self.pool.submit(audiofile.preload)
+        else:
+            start_thread(audiofile.preload)
+
+    def is_slow(self, audiofile):
+        """Returns True if the decode profile estimates `audiofile` takes
+        longer than `preload_slow_seconds` to preload."""
+        if self.profile is None:
+            return False
+        try:
+            sample_rate = audiofile.file.sample_rate()
+            seconds = float(audiofile.file.total_frames()) / sample_rate
+            estimate = self.profile.estimate(
+                audiofile.file.NAME, seconds, sample_rate,
+                audiofile.file.bits_per_sample())
+        except (AttributeError, ZeroDivisionError):
+            return False
+        return estimate > self.slow_seconds
+
     def start(self):
         # Check if we aren't already running
         if self.running.is_set():
@@ -205,6 +364,11 @@ class PreloadedAudioFile(AudioFile):
 
         self._metadata = None
         self.buffer = None
+        #: The :class:`~hanyuu.streamer.packed.PackedReader` of the buffer,
+        #: if it's compressed.
+        self.reader = None
+        #: The :class:`~hanyuu.streamer.dsp.Analysis` of the buffer, if any.
+        self.analysis = None
 
         self.current_index = 0
         self.total_index = 0
@@ -212,7 +376,28 @@ class PreloadedAudioFile(AudioFile):
         self.preloaded_next = self.preloaded_push = False
         self.first = True
 
+        #: True once the preload of this file was started.
+        self.preload_started = False
         self.finished = threading.Event()
+        #: True if the whole file was decoded into the buffer.
+        self.decoded = False
+        #: The :class:`~hanyuu.streamer.cache.SharedBuffer` we use, if any.
+        self.shared = None
+        self.shared_lock = threading.Lock()
+
+        self.metrics = manager.metrics.stage("preloaded_audiofile")
+        self.shared_metrics = manager.metrics.counter(
+            "streamer_preload_shared_total",
+            "Preloads that used the buffer of another queue entry.")
+        self.decompress_metrics = manager.metrics.histogram(
+            "streamer_preload_decompress_seconds",
+            "Time spent decompressing a block of a compressed preload "
+            "buffer.",
+            buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025))
+        self.preload_metrics = manager.metrics.histogram(
+            "streamer_preload_seconds",
+            "Time spent decoding a song into its preload buffer.",
+            buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
 
     @property
     def metadata(self):
@@ -222,7 +407,65 @@ class PreloadedAudioFile(AudioFile):
         # This is a database access (at least, most likely)
         self._metadata = self.song.metadata
 
+        key = cache_key(self.filename)
+        shared = None
+        if key is not None:
+            with self.shared_lock:
+                if not self.finished.is_set():
+                    shared, decode = self.options.preload_store.acquire(key)
+                    self.shared = shared
+        if shared is None:
+            self.fill(key)
+            return
+
+        if not decode:
+            ready = self.options.preload_store.wait(shared, self.finished)
+            if ready:
+                logger.debug("Sharing preload buffer: %s", self._metadata)
+                self.shared_metrics.inc()
+                self.set_buffer(shared.data, shared.analysis)
+                self.finished.set()
+                return
+            if ready is None:
+                # Cancelled while another user decodes, leave it to them.
+                return
+        try:
+            self.fill(key)
+            if self.decoded:
+                self.options.preload_store.publish(shared, self.buffer,
+                                                   self.analysis)
+        finally:
+            self.options.preload_store.abandon(shared)
+
+    def fill(self, key):
+        """Internal method
+
+        Fills the preload buffer from the decode cache, or by decoding the
+        file.
+        """
+        began = time.time()
+        cache = self.options.preload_cache
+        if key is not None and cache is not None:
+            entry = cache.get(key)
+            if entry is not None:
+                logger.debug("Decode cache hit: %s", self._metadata)
+                self.set_buffer(*entry)
+                self.decoded = True
+                self.finished.set()
+                return
+
+        analyzer = None
+        if self.options.preload_analyze:
+            analyzer = dsp.Analyzer(self.options.silence_threshold_db)
+        meter = None
+        loudness_cache = self.options.loudness_cache
+        if (loudness_cache is not None and
+                loudness_cache.get(self.filename) is None):
+            from .loudness import Meter
+            meter = Meter()
+
         frame_buffer = []
+        packer = Packer() if self.options.preload_compress else None
 
         while not self.finished.is_set():
             try:
@@ -238,12 +481,50 @@ class PreloadedAudioFile(AudioFile):
 
             if not data:
                 break
-            frame_buffer.append(data.to_bytes(False, True))
-
-        self.buffer = b''.join(frame_buffer)
-        self.total_index = len(self.buffer)
+            data = data.to_bytes(False, True)
+            if analyzer is not None:
+                analyzer.feed(data)
+            if meter is not None:
+                meter.feed(data)
+            if packer is not None:
+                packer.feed(data)
+            else:
+                frame_buffer.append(data)
+
+        analysis = analyzer.result() if analyzer is not None else None
+        if packer is not None:
+            self.set_buffer(packer.finish(), analysis)
+        else:
+            self.set_buffer(b''.join(frame_buffer), analysis)
+
+        # Only complete decodes are cached, not ones cut short by a push.
+        self.decoded = not self.finished.is_set()
+        if key is not None and cache is not None and self.decoded:
+            cache.put(key, (self.buffer, self.analysis),
+                      held_bytes(self.buffer))
+        if meter is not None and self.decoded:
+            loudness_cache.put(self.filename, *meter.result())
 
         self.finished.set()
+        self.preload_metrics.observe(time.time() - began)
+
+    def set_buffer(self, buffer, analysis=None):
+        """Sets the preload buffer, only the part between the trim points of
+        `analysis` is played."""
+        self.buffer = buffer
+        self.analysis = analysis
+        if isinstance(buffer, PackedBuffer):
+            self.reader = buffer.reader(self.decompress_metrics.observe)
+        if analysis is not None:
+            self.current_index, self.total_index = (analysis.start,
+                                                    analysis.end)
+        else:
+            self.current_index, self.total_index = 0, len(buffer)
+
+    def remaining(self):
+        if self.buffer is None:
+            return None
+        return max(self.total_index - self.current_index, 0)
 
     def non_preload(self, discard=True):
         """
@@ -256,30 +537,72 @@ class PreloadedAudioFile(AudioFile):
         """
         if discard:
             self.finished.set()
+            self.release()
         return NormalAudioFile(self.song, self.manager, self.options)
 
+    def release(self):
+        """Stops using the shared preload buffer, if we have one."""
+        with self.shared_lock:
+            shared, self.shared = self.shared, None
+            # Nothing is acquired after this.
+            self.finished.set()
+        if shared is not None:
+            self.options.preload_store.release(shared)
+
+    def close(self):
+        self.release()
+        super(PreloadedAudioFile, self).close()
+
     upper_progress = progress_function
 
-    def read(self, size=4096, timeout=10.0):
-        # If it's the first time we are being read from, we will want to
+    def announce(self):
+        # If it's the first time we are being played, we will want to
         # send a metadata event.
         if self.first:
             self.manager.emit("metadata", self.metadata)
         self.first = False
 
+    def decode(self, size=4096):
         if self.buffer is None:
             # If for some reason someone is reading from here, without us
             # actually being preloaded, we will want to just return EOF
             self.upper_progress(100, 100)
             return b''
 
-        # Make sure we aren't going to end up on an edge
-        size = size * 2
+        began = time.time()
+        start = self.current_index
+        end = min(start + size, self.total_index)
+        if self.reader is not None:
+            data = self.reader.read(start, end - start)
+        else:
+            data = self.buffer[start:end]
+        self.current_index += len(data)
+        self.upper_progress(self.current_index, self.total_index)
+        self.metrics.observe(len(data), time.time() - began)
+        return data
+
+    def decode_into(self, buffer):
+        """Copies the next part of the preload buffer into `buffer` without
+        creating any intermediate objects."""
+        if self.buffer is None:
+            self.upper_progress(100, 100)
+            return 0
 
+        began = time.time()
         start = self.current_index
+        end = min(start + len(buffer), self.total_index)
+        if self.reader is not None:
+            size = self.reader.readinto(
+                start, memoryview(buffer)[:max(end - start, 0)])
+        else:
+            data = memoryview(self.buffer)[start:max(end, start)]
+            size = len(data)
+            buffer[:size] = data
+
         self.current_index += size
         self.upper_progress(self.current_index, self.total_index)
-        return self.buffer[start:start + size]
+        self.metrics.observe(size, time.time() - began)
+        return size
 
 
 class NormalAudioFile(AudioFile):
@@ -292,14 +615,20 @@ class NormalAudioFile(AudioFile):
 
         self.preloaded_next = self.preloaded_push = False
 
+        self.metrics = manager.metrics.stage("normal_audiofile")
+
     progress = progress_function
 
-    def read(self, size=4096, timeout=0.0):
+    def announce(self):
         if self.first:
             self.manager.emit("metadata", self.metadata)
         self.first = False
 
-        return super(NormalAudioFile, self).read(size, timeout)
+    def decode(self, size=4096):
+        start = time.time()
+        data = super(NormalAudioFile, self).decode(size)
+        self.metrics.observe(len(data), time.time() - start)
+        return data
 
 
 def start_thread(func, *args, **kwargs):
@@ -0,0 +1,466 @@
+"""
+Runs the decoding side of a pipeline in a separate process.
+
+Decoding and the conversion to PCM are CPU heavy and share the GIL with the
+encoder feeder and the icecast sender when run in the same process. The
+:class:`ProcessSource` pipe starts a child process running the decoding
+pipes, the PCM they produce is passed back through a :class:`Ring` in
+shared memory. A crashing child is restarted without touching the pipes
+after it, the :class:`~hanyuu.streamer.underrun.UnderrunGuard` keeps the
+stream going in the meantime.
+
+A typical pipeline looks like this, the preloader and file source are
+created in the child:
+
+    Manager(queue, [ProcessSource, UnderrunGuard, Encoder, Icecast], options)
+
+The manager source stays in the parent, the child accesses it through a
+:class:`QueueProxy`.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import multiprocessing
+import threading
+import logging
+import ctypes
+import Queue
+import time
+
+import chan
+
+from . import garbage
+from . import pool
+from .pcm import SAMPLE_RATE, CHANNELS, BITS_PER_SAMPLE
+from .pcm import BYTE_RATE, BLOCK_ALIGN
+
+
+logger = logging.getLogger("streamer.process")
+
+
+def address(buffer):
+    """Returns the memory address of the writable `buffer`."""
+    return ctypes.addressof((ctypes.c_char * len(buffer)).from_buffer(buffer))
+
+
+class Ring(object):
+    """
+    A single producer, single consumer ring buffer in shared memory.
+
+    The producer only ever writes :attr:`head` and the consumer only ever
+    writes :attr:`tail`, both count the total amount of bytes passed through
+    the ring. Data is copied before the counter covering it is updated, so
+    no locking is needed between the two processes.
+
+    :param capacity: The size of the ring in bytes.
+    :param align: Data is only made visible to the consumer in multiples of
+                  this, a producer dying halfway through a frame never
+                  publishes a partial frame.
+    """
+    #: Seconds to sleep between checks on the other side of the ring.
+    poll_interval = 0.005
+
+    def __init__(self, capacity, align=1):
+        super(Ring, self).__init__()
+        self.capacity = capacity
+        self.align = align
+        self.data = multiprocessing.RawArray(ctypes.c_char, capacity)
+        self.head = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+        self.tail = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+        #: Bytes written by the producer, including unpublished ones. Only
+        #: meaningful in the producer.
+        self.position = 0
+
+    def used(self):
+        """Returns the amount of bytes available to the consumer."""
+        return self.head.value - self.tail.value
+
+    def attach(self):
+        """Prepares the calling process to be the producer, any partial
+        frame left behind by a previous producer is dropped."""
+        self.position = self.head.value
+
+    def copy(self, offset, source, size, into_ring):
+        """Internal method
+
+        Copies `size` bytes between the ring at `offset` and the memory
+        address `source`, wrapping around the end of the ring.
+        """
+        base = ctypes.addressof(self.data)
+        while size > 0:
+            start = offset % self.capacity
+            length = min(size, self.capacity - start)
+            if into_ring:
+                ctypes.memmove(base + start, source, length)
+            else:
+                ctypes.memmove(source, base + start, length)
+            offset += length
+            source += length
+            size -= length
+
+    def write(self, buffer, size, running):
+        """Copies the first `size` bytes of `buffer` into the ring, waiting
+        for the consumer to make room while `running` is set.
+
+        :returns: False if `running` was cleared before everything was
+                  written.
+        """
+        source = address(buffer)
+        while size > 0:
+            free = self.capacity - (self.position - self.tail.value)
+            if free <= 0:
+                if not running.is_set():
+                    return False
+                time.sleep(self.poll_interval)
+                continue
+            length = min(size, free)
+            self.copy(self.position, source, length, True)
+            self.position += length
+            self.head.value = self.position - self.position % self.align
+            source += length
+            size -= length
+        return True
+
+    def readinto(self, buffer, timeout=10.0):
+        """Copies at most `len(buffer)` bytes out of the ring into `buffer`,
+        waiting at most `timeout` seconds for data to arrive.
+
+        :returns: The amount of bytes copied.
+        """
+        deadline = time.time() + timeout
+        while self.used() == 0:
+            if time.time() >= deadline:
+                return 0
+            time.sleep(self.poll_interval)
+
+        size = min(self.used(), len(buffer))
+        self.copy(self.tail.value, address(buffer), size, False)
+        self.tail.value += size
+        return size
+
+
+class Control(object):
+    """
+    A :func:`multiprocessing.Pipe` end that can be sent on from multiple
+    threads.
+
+    Messages are tuples of which the first item is the message kind:
+
+        - ("emit", event, obj): An event from the child.
+        - ("call", name, args): A call on the manager source by the child.
+        - ("reply", result): The result of a "call".
+        - ("close",): Tells the child to exit.
+    """
+    def __init__(self, connection):
+        super(Control, self).__init__()
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def send(self, *message):
+        with self.lock:
+            self.connection.send(message)
+
+    def recv(self):
+        return self.connection.recv()
+
+    def poll(self, timeout):
+        return self.connection.poll(timeout)
+
+    def close(self):
+        self.connection.close()
+
+
+class QueueProxy(object):
+    """
+    Stands in for the manager source in the child process. Method calls,
+    and calls on the proxy itself, are done on the source in the parent and
+    block until it replies.
+    """
+    def __init__(self, control, replies):
+        super(QueueProxy, self).__init__()
+        self.control = control
+        self.replies = replies
+        self.lock = threading.Lock()
+
+    def call(self, name, *args):
+        with self.lock:
+            self.control.send("call", name, args)
+            return self.replies.get()
+
+    def __call__(self, *args):
+        return self.call("__call__", *args)
+
+    def __getattr__(self, key):
+        if key.startswith("_"):
+            raise AttributeError(key)
+        return lambda *args: self.call(key, *args)
+
+
+class RingWriter(object):
+    """
+    The last pipe of the child process, copies the PCM of its source into
+    the :class:`Ring` shared with the parent.
+    """
+    def __init__(self, manager, pipe, options):
+        super(RingWriter, self).__init__()
+        self.manager = manager
+        self.source = pipe
+        self.ring = options["process_ring"]
+        self.running = threading.Event()
+
+    def run(self):
+        buffer = self.manager.buffers.acquire()
+        while self.running.is_set():
+            size = pool.readinto(self.source, buffer)
+            if size == 0:
+                time.sleep(0.05)
+                continue
+            if not self.ring.write(buffer, size, self.running):
+                break
+        self.manager.buffers.release(buffer)
+
+    def start(self):
+        self.ring.attach()
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name="Ring Writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.running.clear()
+
+
+def child_main(ring, connection, pipes, options):
+    """The entry point of the child process."""
+    from .manager import Manager
+
+    # The collector of the parent doesn't survive the fork, start over.
+    garbage.reset()
+
+    control = Control(connection)
+    replies = Queue.Queue()
+
+    options = dict(options, process_ring=ring)
+    manager = Manager(QueueProxy(control, replies),
+                      list(pipes) + [RingWriter], options)
+
+    # Forward the requested events to the parent.
+    channels = [manager.register(event)
+                for event in options["process_events"]]
+    events = dict(zip(channels, options["process_events"]))
+
+    def forward():
+        while True:
+            try:
+                channel, obj = chan.chanselect(channels, [])
+            except chan.ChanClosed:
+                return
+            control.send("emit", events[channel], obj)
+
+    thread = threading.Thread(target=forward, name="Event Forwarder")
+    thread.daemon = True
+    thread.start()
+
+    manager.start()
+    try:
+        while True:
+            message = control.recv()
+            if message[0] == "reply":
+                replies.put(message[1])
+            elif message[0] == "close":
+                break
+    except (EOFError, IOError):
+        # The parent went away, there is nobody left to decode for.
+        pass
+    finally:
+        manager.close()
+        for channel in channels:
+            channel.close()
+
+
+class ProcessSource(object):
+    """
+    ======
+    Source
+    ======
+
+    This pipe has no source, it should be the first pipe of the pipeline.
+    The pipes given in `process_pipes` are run in a child process with the
+    manager source, the output of the last one is returned by this pipe.
+
+    =======
+    Options
+    =======
+
+    The options are passed on to the pipes in the child process, except for
+    the metrics exporter options. The following options are used by this
+    pipe itself:
+
+        - process_pipes:
+            The pipes to run in the child process, they should produce PCM
+            in the format of :mod:`hanyuu.streamer.files`.
+            (defaults to the preloader and file source)
+        - process_ring_ms:
+            The size of the shared memory ring in milliseconds of audio.
+            (defaults to 2000)
+        - process_events:
+            The events emitted in the child that are emitted again on the
+            manager in the parent, the objects sent have to be picklable.
+            (defaults to ("metadata",))
+        - process_restart_delay:
+            The amount of seconds to wait before restarting a dead child.
+            (defaults to 1.0)
+
+    ========
+    Events
+    ========
+
+        - process_restart:
+            Called when the child process died and was restarted.
+
+            :param source: :class:`ProcessSource` instance.
+    """
+    options = {
+        "process_pipes": None,
+        "process_ring_ms": 2000,
+        "process_events": ("metadata",),
+        "process_restart_delay": 1.0,
+        "eof_on_empty": False,
+    }
+    #: The amount of bytes of PCM we return for each second of audio.
+    byte_rate = BYTE_RATE
+    #: The size in bytes of a single PCM frame we return.
+    block_align = BLOCK_ALIGN
+    #: The format of the PCM we return, that of the file source.
+    sample_rate = SAMPLE_RATE
+    bits_per_sample = BITS_PER_SAMPLE
+    channels = CHANNELS
+
+    def __init__(self, manager, pipe, options):
+        super(ProcessSource, self).__init__()
+        self.manager = manager
+
+        pipes = options["process_pipes"]
+        if pipes is None:
+            from .preloader import PreloadedFileSource
+            from .files import FileSource
+            pipes = [PreloadedFileSource, FileSource]
+        self.pipes = pipes
+        self.restart_delay = float(options["process_restart_delay"])
+
+        capacity = int(self.byte_rate * float(options["process_ring_ms"])
+                       / 1000)
+        capacity = max(capacity - capacity % self.block_align,
+                       self.block_align * 1024)
+        self.ring = Ring(capacity, self.block_align)
+
+        # The child gets its own metrics, which aren't exported. The threads
+        # of a shared preload pool don't survive the fork either, nor do the
+        # locks of a shared buffer store.
+        self.child_options = dict(
+            (key, value) for key, value in options.items()
+            if key not in ("metrics_file", "metrics_port",
+                           "metrics_registry", "preload_pool",
+                           "preload_store"))
+
+        self.process = None
+        self.control = None
+        self.running = threading.Event()
+
+        registry = manager.metrics
+        self.metrics = registry.stage("process_source")
+        self.restarts = registry.counter(
+            "streamer_process_restarts_total",
+            "Times the decoding child process was restarted.")
+        registry.gauge(
+            "streamer_process_ring_fill_seconds",
+            "Seconds of audio in the shared memory ring.",
+            function=lambda: float(self.ring.used()) / self.byte_rate)
+
+    def spawn(self):
+        """Internal method
+
+        Starts a new child process and control connection.
+        """
+        parent, child = multiprocessing.Pipe()
+        self.control = Control(parent)
+        self.process = multiprocessing.Process(
+            target=child_main, name="Decoder Process",
+            args=(self.ring, child, self.pipes, self.child_options))
+        self.process.daemon = True
+        self.process.start()
+        # Only the child should hold its end open, so we notice it dying.
+        child.close()
+
+    def run(self):
+        while self.running.is_set():
+            try:
+                if self.control.poll(0.5):
+                    self.handle(self.control.recv())
+                    continue
+            except (EOFError, IOError):
+                # The child closed its end, give it a moment to exit.
+                self.process.join(self.restart_delay)
+
+            if self.process.is_alive() or not self.running.is_set():
+                continue
+
+            logger.error("Decoder process died with exit code %s, "
+                         "restarting.", self.process.exitcode)
+            self.control.close()
+            time.sleep(self.restart_delay)
+            self.spawn()
+            self.restarts.inc()
+            self.manager.emit("process_restart", self)
+
+    def handle(self, message):
+        """Internal method
+
+        Handles a message sent by the child.
+        """
+        kind = message[0]
+        if kind == "emit":
+            self.manager.emit(message[1], message[2])
+        elif kind == "call":
+            name, args = message[1], message[2]
+            try:
+                result = getattr(self.manager.source, name)(*args)
+            except Exception:
+                logger.exception("Source call %s failed.", name)
+                result = None
+            self.control.send("reply", result)
+
+    def read(self, size=4096, timeout=10.0):
+        buffer = bytearray(size)
+        size = self.readinto(buffer, timeout)
+        return bytes(buffer[:size])
+
+    def readinto(self, buffer, timeout=10.0):
+        start = self.metrics.begin()
+        size = self.ring.readinto(buffer, timeout)
+        self.metrics.observe(size, time.time() - start)
+        return size
+
+    def start(self):
+        if self.running.is_set():
+            return
+        self.running.set()
+        self.spawn()
+        self.thread = threading.Thread(target=self.run,
+                                       name="Decoder Process Control")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.running.clear()
+        if self.process is None:
+            return
+        try:
+            self.control.send("close")
+        except (IOError, ValueError):
+            pass
+        self.process.join(5.0)
+        if self.process.is_alive():
+            logger.warning("Decoder process didn't exit, terminating it.")
+            self.process.terminate()
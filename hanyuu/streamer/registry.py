@@ -0,0 +1,261 @@
+"""
+A registry of pipes by name, so a pipeline can be put together from
+configuration without importing every pipe up front.
+
+The :class:`~hanyuu.streamer.manager.Manager` takes names in place of pipe
+classes:
+
+    Manager(queue, ["preloader", "file_source", "underrun_guard",
+                    "encoder", "icecast"], options)
+
+A name is looked up in the pipes added with :func:`register`, then in
+:data:`PIPES`, then in the entry points of the :data:`ENTRY_POINT_GROUP`
+group, which is how other packages add their own pipes:
+
+    entry_points={
+        "hanyuu.streamer.pipes": ["mixer = mypackage.mixer:Mixer"],
+    }
+
+A "module:Class" path is accepted as a name as well. The module of a pipe,
+and with it dependencies such as audiotools or pylibshout, is only
+imported once a manager is created with it.
+
+The import time of each pipe is reported by :func:`import_report`, or from
+the command line, failing when a pipe takes longer than the budget in
+milliseconds:
+
+    python -m hanyuu.streamer.registry --budget 100
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import namedtuple
+import importlib
+import threading
+import logging
+import sys
+
+
+logger = logging.getLogger("streamer.registry")
+
+#: The entry point group searched for pipes we don't know.
+ENTRY_POINT_GROUP = "hanyuu.streamer.pipes"
+
+#: The pipes of this package, name -> "module:Class".
+PIPES = {
+    "preloader": "hanyuu.streamer.preloader:PreloadedFileSource",
+    "file_source": "hanyuu.streamer.files:FileSource",
+    "process_source": "hanyuu.streamer.process:ProcessSource",
+    "stream_copy": "hanyuu.streamer.streamcopy:StreamCopy",
+    "buffered": "hanyuu.streamer.buffered:BufferedSource",
+    "underrun_guard": "hanyuu.streamer.underrun:UnderrunGuard",
+    "encoder": "hanyuu.streamer.encoder:Encoder",
+    "icecast": "hanyuu.streamer.icecast:Icecast",
+    "archive": "hanyuu.streamer.archive:Archive",
+    "hls": "hanyuu.streamer.hls:HLS",
+    "monitor": "hanyuu.streamer.monitor:Monitor",
+    "branch": "hanyuu.streamer.branch:Branch",
+}
+
+#: Modules that are slow to import, or start machinery we'd rather not
+#: have in tools that don't stream, listed by the import report.
+HEAVY_MODULES = ("audiotools", "pylibshout", "numpy", "subprocess",
+                 "multiprocessing", "pkg_resources")
+
+_registered = {}
+_resolved = {}
+_lock = threading.Lock()
+
+
+class RegistryError(Exception):
+    """Exception raised when a pipe can't be found or imported."""
+    pass
+
+
+def register(name, pipe):
+    """Makes `pipe`, a class or a "module:Class" path, available as
+    `name`. Overrides the pipes of :data:`PIPES` and entry points."""
+    with _lock:
+        _registered[name] = pipe
+        _resolved.pop(name, None)
+
+
+def names():
+    """Returns the names of the known pipes, including the entry points."""
+    found = set(PIPES) | set(_registered)
+    found.update(entry_point.name for entry_point in entry_points())
+    return sorted(found)
+
+
+def entry_points(name=None):
+    """Returns the entry points of :data:`ENTRY_POINT_GROUP`, only those
+    called `name` if given. pkg_resources is slow to import, this is only
+    done when a name isn't one of ours."""
+    try:
+        import pkg_resources
+    except ImportError:
+        return []
+    return list(pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, name))
+
+
+def target(name):
+    """Returns what `name` refers to without importing it: a class, a
+    "module:Class" path or an entry point. Returns None if there is no pipe
+    called `name`."""
+    with _lock:
+        pipe = _registered.get(name, PIPES.get(name))
+    if pipe is None and ":" in name:
+        pipe = name
+    if pipe is None:
+        found = entry_points(name)
+        pipe = found[0] if found else None
+    return pipe
+
+
+def load(path):
+    """Imports and returns the object at a "module:Class" `path`."""
+    module_name, _, attribute = path.partition(":")
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as err:
+        raise RegistryError("Failed importing {}: {}".format(module_name,
+                                                             err))
+    try:
+        return getattr(module, attribute)
+    except AttributeError:
+        raise RegistryError("{} has no attribute {}".format(module_name,
+                                                            attribute))
+
+
+def resolve(pipe):
+    """Returns the pipe class for `pipe`, a name or "module:Class" path.
+    Anything else, such as a class, is returned as is.
+
+    :raises RegistryError: If there is no such pipe, or its module fails to
+                           import.
+    """
+    if not isinstance(pipe, basestring):
+        return pipe
+    with _lock:
+        cls = _resolved.get(pipe)
+    if cls is not None:
+        return cls
+
+    found = target(pipe)
+    if found is None:
+        raise RegistryError("Unknown pipe: {}".format(pipe))
+    elif isinstance(found, basestring):
+        cls = load(found)
+    elif hasattr(found, "module_name"):
+        try:
+            cls = found.load()
+        except ImportError as err:
+            raise RegistryError("Failed loading pipe {}: {}".format(pipe,
+                                                                   err))
+    else:
+        cls = found
+
+    with _lock:
+        _resolved[pipe] = cls
+    return cls
+
+
+#: The import time of a single module, as returned by :func:`import_report`.
+#: `heavy` are the :data:`HEAVY_MODULES` it pulled in, `error` the import
+#: error or None.
+ImportTime = namedtuple("ImportTime", ["name", "module", "seconds", "heavy",
+                                       "error"])
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.time()
+try:
+    import {module}
+except Exception as err:
+    sys.stdout.write("error {{!r}}\\n".format(err))
+else:
+    sys.stdout.write("{{}}\\n".format(time.time() - start))
+sys.stdout.write(" ".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def import_time(module, python=None):
+    """Imports `module` in a fresh interpreter, `python` or our own, and
+    returns (seconds, heavy modules, error)."""
+    import subprocess
+
+    script = IMPORT_SCRIPT.format(module=module,
+                                  heavy=tuple(str(name) for name in
+                                              HEAVY_MODULES))
+    process = subprocess.Popen([python or sys.executable, "-c", script],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output, errors = process.communicate()
+    lines = output.decode("utf8").split("\n")
+    if process.returncode != 0 or not lines[0]:
+        error = errors.decode("utf8").strip()
+        return None, [], error or "exited with {}".format(process.returncode)
+    heavy = lines[1].split() if len(lines) > 1 else []
+    if lines[0].startswith("error "):
+        return None, heavy, lines[0][len("error "):]
+    return float(lines[0]), heavy, None
+
+
+def import_report(pipes=None, python=None):
+    """
+    Returns an :class:`ImportTime` for each of `pipes`, by default all known
+    pipes, measured in a fresh interpreter each. The first entry is the
+    manager, which every pipeline pays for.
+    """
+    report = []
+    modules = [("manager", "hanyuu.streamer.manager")]
+    for name in pipes or names():
+        found = target(name)
+        if isinstance(found, basestring):
+            module = found.partition(":")[0]
+        else:
+            module = getattr(found, "module_name",
+                             getattr(found, "__module__", None))
+        modules.append((name, module))
+
+    for name, module in modules:
+        if module is None:
+            report.append(ImportTime(name, None, None, [], "unknown pipe"))
+            continue
+        seconds, heavy, error = import_time(module, python)
+        report.append(ImportTime(name, module, seconds, heavy, error))
+    return report
+
+
+def main(arguments=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Report the import time of the streamer pipes.")
+    parser.add_argument("pipes", nargs="*",
+                        help="The pipes to report on, all by default.")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="Fail if a pipe takes longer than this amount "
+                             "of milliseconds to import.")
+    arguments = parser.parse_args(arguments)
+
+    over = False
+    for entry in import_report(arguments.pipes):
+        if entry.error is not None:
+            print("{:<16} {:>9} {}".format(entry.name, "failed",
+                                           entry.error.splitlines()[-1]))
+            over = True
+            continue
+        milliseconds = entry.seconds * 1000
+        flag = ""
+        if arguments.budget is not None and milliseconds > arguments.budget:
+            flag = " over budget"
+            over = True
+        print("{:<16} {:>7.1f}ms {}{}".format(entry.name, milliseconds,
+                                              " ".join(entry.heavy), flag))
+    return 1 if over else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
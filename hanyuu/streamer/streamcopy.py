@@ -0,0 +1,483 @@
+"""
+Playing songs from MP3 frames that were encoded ahead of time.
+
+Most songs are played many times, and each play decodes and encodes them
+again to the same output. The :class:`StreamCopy` pipe takes the place of
+both the :class:`~hanyuu.streamer.files.FileSource` and the
+:class:`~hanyuu.streamer.encoder.Encoder`:
+
+    Manager(queue, [StreamCopy, Icecast], options)
+
+For each song it looks in a :class:`FrameCache` for the song encoded with
+the `lame_settings` of the station, and copies those frames straight into
+the stream. Songs that aren't cached yet are encoded live, and the result is
+kept in the cache for the next play. Songs can be encoded ahead of time in
+the background with a :class:`PreEncoder`, or
+:meth:`~hanyuu.streamer.library.Library.pre_encode`.
+
+Everything is encoded without the bit reservoir (`--nores`) and without an
+info tag (`-t`), every frame can be decoded on its own and songs join at
+any frame boundary. This costs a little quality at the same bitrate. Each
+song starts and ends with the encoder delay and padding, a few tens of
+milliseconds of silence, and the file source features that work on PCM,
+such as crossfading and loudness normalization, aren't available.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import subprocess
+import threading
+import hashlib
+import logging
+import decimal
+import select
+import Queue
+import time
+import os
+
+from .files import AudioFile, AudioError, SAMPLE_RATE, BITS_PER_SAMPLE
+from .encoder import Encoder, LAME_BIN
+from . import cache
+from . import mp3
+
+
+logger = logging.getLogger("streamer.streamcopy")
+
+
+def lame_arguments(binary, settings):
+    """Returns the LAME command line encoding our PCM from stdin to frames
+    that can be spliced, on stdout."""
+    return [
+        binary, '--quiet',
+        '--flush',
+        '-r',
+        '-s', str(decimal.Decimal(SAMPLE_RATE) / 1000),
+        '--bitwidth', str(BITS_PER_SAMPLE),
+        '--signed', '--little-endian',
+        '-m', 'j',
+        '--nores', '-t'] + list(settings) + ['-', '-']
+
+
+class FrameCache(object):
+    """
+    A directory of songs encoded with `settings`, a list of LAME encoding
+    options like the `lame_settings` of the
+    :class:`~hanyuu.streamer.encoder.Encoder`.
+    """
+    #: The amount of bytes at the start of a cached file checked for the
+    #: use of the bit reservoir.
+    check_size = 65536
+
+    def __init__(self, directory, settings, binary=None):
+        super(FrameCache, self).__init__()
+        self.directory = directory
+        self.settings = list(settings)
+        self.binary = binary or LAME_BIN
+
+    def path(self, filename):
+        """Returns the path the frames of `filename` are kept at, or None if
+        the file can't be looked at."""
+        identity = cache.key(filename)
+        if identity is None:
+            return None
+        digest = hashlib.sha1(
+            repr((identity, self.settings)).encode("utf8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + ".mp3")
+
+    def get(self, filename):
+        """Returns the path of the cached frames of `filename`, or None if
+        it isn't cached."""
+        path = self.path(filename)
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            head = f.read(self.check_size)
+        if mp3.uses_reservoir(head):
+            # Not encoded by us, it would decode wrong after another song.
+            logger.warning("Removing cached frames using the bit reservoir:"
+                           " %s", path)
+            self.remove(path)
+            return None
+        return path
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def job(self, audiofile):
+        """Returns an :class:`EncodeJob` encoding `audiofile` into the
+        cache."""
+        return EncodeJob(audiofile, lame_arguments(self.binary, self.settings),
+                         self.path(audiofile.filename))
+
+    def encode(self, filename):
+        """Encodes `filename` into the cache, waiting until it's done.
+
+        :returns: True if the file was encoded.
+        """
+        job = self.job(AudioFile(filename))
+        job.start()
+        try:
+            while not job.finished:
+                job.read(65536)
+        finally:
+            job.close()
+        return job.complete
+
+
+class EncodeJob(object):
+    """
+    Encodes a single `audiofile` with a LAME process run with `arguments`.
+    The frames are returned by :meth:`read`, and written to `path` when the
+    whole file was encoded.
+    """
+    def __init__(self, audiofile, arguments, path=None):
+        super(EncodeJob, self).__init__()
+        self.audiofile = audiofile
+        self.arguments = arguments
+        self.path = path
+        self.output = None
+        #: True once the encoder output ended.
+        self.finished = False
+        #: True if the whole file was encoded, and written to `path`.
+        self.complete = False
+        self.fed = False
+        if path is not None:
+            # Unique, the same file can be encoded twice at the same time.
+            self.temporary = "{}.{:d}.tmp".format(path, id(self))
+
+    def start(self):
+        self.process = subprocess.Popen(args=self.arguments,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        if self.path is not None:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.output = open(self.temporary, "wb")
+
+        self.thread = threading.Thread(target=self.feed,
+                                       name="Stream Copy Encoder Feeder")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def feed(self):
+        """Internal method
+
+        Runs in its own thread, writes the decoded file to the encoder.
+        """
+        try:
+            while True:
+                try:
+                    data = self.audiofile.decode(65536)
+                except (ValueError):
+                    continue
+                if not data:
+                    self.fed = True
+                    break
+                self.process.stdin.write(data)
+        except (AttributeError, IOError):
+            logger.exception("Failed encoding %s", self.audiofile.filename)
+        finally:
+            try:
+                self.process.stdin.close()
+            except IOError:
+                pass
+
+    def read(self, size=4096, timeout=10.0):
+        """Returns the next frames, an empty string is returned on timeout
+        and once :attr:`finished` is set."""
+        if self.finished:
+            return b''
+        reader, writer, error = select.select([self.process.stdout],
+                                              [], [], timeout)
+        if not reader:
+            return b''
+        data = os.read(self.process.stdout.fileno(), size)
+        if not data:
+            self.finish()
+        elif self.output is not None:
+            self.output.write(data)
+        return data
+
+    def finish(self):
+        """Internal method
+
+        Called at the end of the output, moves the frames into the cache if
+        everything went right.
+        """
+        self.finished = True
+        self.thread.join()
+        returncode = self.process.wait()
+        if self.output is None:
+            return
+        self.output.close()
+        self.output = None
+        if self.fed and returncode == 0:
+            os.rename(self.temporary, self.path)
+            self.complete = True
+        else:
+            os.remove(self.temporary)
+
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+            self.process.wait()
+            if self.output is not None:
+                self.output.close()
+                self.output = None
+                os.remove(self.temporary)
+        self.audiofile.close()
+
+
+class CachedTrack(object):
+    """Reads the cached frames at `path`, with the interface of an
+    :class:`EncodeJob`."""
+    def __init__(self, path):
+        super(CachedTrack, self).__init__()
+        self.file = open(path, "rb")
+        self.finished = False
+
+    def read(self, size=4096, timeout=10.0):
+        data = self.file.read(size)
+        if not data:
+            self.finished = True
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class PreEncoder(object):
+    """
+    Encodes files submitted to it into a :class:`FrameCache` in `workers`
+    background threads.
+    """
+    def __init__(self, frame_cache, workers=1):
+        super(PreEncoder, self).__init__()
+        self.frame_cache = frame_cache
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+
+    def submit(self, filename):
+        """Queues `filename` for encoding, unless it's cached or queued
+        already."""
+        with self.lock:
+            if filename in self.pending:
+                return
+            self.pending.add(filename)
+        self.queue.put(filename)
+
+    def run(self):
+        while self.running.is_set():
+            try:
+                filename = self.queue.get(timeout=1.0)
+            except Queue.Empty:
+                continue
+            try:
+                if self.frame_cache.get(filename) is None:
+                    self.frame_cache.encode(filename)
+            except Exception:
+                logger.exception("Failed pre-encoding %s", filename)
+            finally:
+                with self.lock:
+                    self.pending.discard(filename)
+
+    def start(self):
+        self.running.set()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.run, name="Pre-encoder")
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        self.running.clear()
+
+
+class StreamCopy(object):
+    """
+    ======
+    Source
+    ======
+
+    There should be no pipe before us, `manager.source` is called for the
+    next song to play. It can return a filename, or an object with
+    `filename` and `metadata` attributes such as a
+    :class:`~hanyuu.streamer.library.Song`, the metadata is sent with the
+    'metadata' event when the song starts. The start of each song in our
+    output is marked on the playout clock of the manager, see
+    :mod:`hanyuu.streamer.clock`.
+
+    The :class:`~hanyuu.streamer.preloader.PreloadedFileSource` can't be
+    used in front of this pipe, it decides when to hand out the next song
+    from how far the current one was decoded.
+
+    =======
+    Options
+    =======
+
+        - streamcopy_directory:
+            The directory of the :class:`FrameCache`.
+            (defaults to "frames")
+        - lame_settings, lame_binary:
+            As for the :class:`~hanyuu.streamer.encoder.Encoder`, the cache
+            only holds songs encoded with the same settings.
+        - eof_on_empty:
+            If true we close ourself when there is no new file to be had,
+            otherwise reads wait while we keep asking for a new file.
+            (defaults to True)
+
+    ======
+    Events
+    ======
+
+        - metadata:
+            Emitted when a song with metadata starts.
+
+            :param metadata: The metadata of the song.
+    """
+    options = {
+        "streamcopy_directory": "frames",
+        "lame_settings": ['--cbr', '-b', '192', '--resample', '44.1'],
+        "lame_binary": None,
+        "eof_on_empty": True,
+    }
+    #: The amount of seconds to wait before asking an empty source again.
+    retry_timeout = 0.5
+    #: The output of this pipe can be decoupled with a buffer.
+    decouple = True
+    byte_rate = Encoder.byte_rate
+
+    def __init__(self, manager, pipe, options):
+        super(StreamCopy, self).__init__()
+        self.manager = manager
+
+        self.settings = options["lame_settings"]
+        self.frame_cache = FrameCache(options["streamcopy_directory"],
+                                      self.settings, options["lame_binary"])
+        self.eof_on_empty = options.get("eof_on_empty", True)
+        self.eof = threading.Event()
+
+        #: The :class:`CachedTrack` or :class:`EncodeJob` playing.
+        self.track = None
+        #: True if the source had no song the last time we asked.
+        self.exhausted = False
+        #: Counts the audio we returned, for the playout clock.
+        self.counter = mp3.FrameCounter()
+        #: The amount of seconds of audio we returned so far.
+        self.position = 0.0
+        self.lock = threading.Lock()
+
+        registry = manager.metrics
+        self.metrics = registry.stage("streamcopy")
+        self.tracks = {
+            mode: registry.counter(
+                "streamer_streamcopy_tracks_total",
+                "Songs played by the stream copy pipe.", {"mode": mode})
+            for mode in ("copy", "live")
+        }
+        self.failures = registry.counter(
+            "streamer_file_failures_total",
+            "Files that could not be opened by the file source.")
+
+    def next_track(self, timeout):
+        """Internal method
+
+        Returns the next song ready to be read, copied from the cache if
+        it's there and encoded live otherwise. Returns None if the source
+        has no song for us.
+        """
+        while True:
+            song = self.manager.source()
+            filename = getattr(song, "filename", song)
+            self.exhausted = filename is None
+            if filename is None:
+                if self.eof_on_empty:
+                    self.eof.set()
+                else:
+                    time.sleep(min(timeout, self.retry_timeout))
+                return None
+
+            path = self.frame_cache.get(filename)
+            if path is not None:
+                track = CachedTrack(path)
+                mode = "copy"
+                break
+            try:
+                track = self.frame_cache.job(AudioFile(filename))
+            except (AudioError):
+                logger.exception("Unsupported file.")
+            except (IOError):
+                logger.exception("Failed opening file.")
+            else:
+                track.start()
+                mode = "live"
+                break
+            self.failures.inc()
+
+        logger.debug("Playing %s (%s)", filename, mode)
+        self.tracks[mode].inc()
+        metadata = getattr(song, "metadata", None)
+        if metadata is not None:
+            self.manager.emit("metadata", metadata)
+        self.manager.clock.mark(
+            self.position, filename, metadata,
+            getattr(getattr(track, "audiofile", None), "duration", None))
+        return track
+
+    def read(self, size=4096, timeout=10.0):
+        start = self.metrics.begin()
+        data = b''
+        # An empty read is the end of the stream to the sink, so we wait
+        # for data until we're closed.
+        while not data and not self.eof.is_set():
+            if self.track is None:
+                # Not under the lock, the source and the 'metadata' event
+                # can keep us waiting and :meth:`close` shouldn't.
+                track = self.next_track(timeout)
+                if track is None:
+                    continue
+                with self.lock:
+                    if self.eof.is_set():
+                        track.close()
+                        break
+                    self.track = track
+            with self.lock:
+                if self.track is None:
+                    # Closed while we were waiting.
+                    break
+                data = self.track.read(size, timeout)
+                if self.track.finished:
+                    self.track.close()
+                    self.track = None
+                # Otherwise the live encoder is running behind when there
+                # is no data, we ask it again.
+        with self.lock:
+            self.position += self.counter.feed(data)
+        self.metrics.observe(len(data), time.time() - start)
+        return data
+
+    def starved(self):
+        """Used by the :class:`~hanyuu.streamer.watchdog.Watchdog`, returns
+        True if we have no song to play because the source has none."""
+        return self.track is None and self.exhausted
+
+    def start(self):
+        self.eof.clear()
+
+    def close(self):
+        self.eof.set()
+        with self.lock:
+            if self.track is not None:
+                self.track.close()
+                self.track = None
@@ -0,0 +1,289 @@
+"""
+Hosts the pipelines of several stations in one process.
+
+Each station is a :class:`~hanyuu.streamer.manager.Manager` as usual, the
+:class:`Supervisor` creates them with a few shared resources:
+
+    - A :class:`WorkerPool` that runs the preloading of all stations, with
+      a limit on the amount of preloads running for a single station.
+    - A :class:`~hanyuu.streamer.cache.DecodeCache` so a file decoded for
+      one station isn't decoded again for another, with a limit on the
+      amount of bytes cached for a single station.
+    - A :class:`~hanyuu.streamer.cache.BufferStore` so stations preloading
+      the same file at the same time share the buffer.
+    - A single metrics registry and exporter, the collectors of each
+      station are labelled with the station name.
+
+The :class:`~hanyuu.streamer.garbage.Collector` is a singleton, so all
+stations in the process already share it.
+
+Stations can still run their decoding in a child process by using the
+:class:`~hanyuu.streamer.process.ProcessSource`, the preloads of those are
+not run on the shared pool and only share a copy of the cache.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import defaultdict, deque
+import threading
+import logging
+
+from . import metrics
+from .cache import DecodeCache, BufferStore
+from .manager import Manager
+
+
+logger = logging.getLogger("streamer.supervisor")
+
+
+class WorkerPool(object):
+    """
+    A pool of threads running jobs for several stations.
+
+    Jobs are queued per station and the stations are served round-robin,
+    a station with a lot of work queued can't starve the others.
+
+    :param workers: The amount of threads to run.
+    """
+    def __init__(self, workers=4):
+        super(WorkerPool, self).__init__()
+        self.workers = workers
+        self.condition = threading.Condition()
+        # station -> deque of (function, args)
+        self.jobs = defaultdict(deque)
+        # station -> amount of jobs running
+        self.running = defaultdict(int)
+        # station -> maximum amount of jobs running
+        self.limits = {}
+        # The stations in the order they are served.
+        self.order = deque()
+
+        self.threads = []
+        self.stopped = threading.Event()
+
+    def station(self, name, limit=None):
+        """Returns a :class:`StationPool` for the station named `name`, at
+        most `limit` jobs of the station run at the same time."""
+        with self.condition:
+            self.limits[name] = limit
+            if name not in self.order:
+                self.order.append(name)
+        return StationPool(self, name)
+
+    def submit(self, name, function, *args):
+        """Queues `function` to be called with `args` for the station named
+        `name`."""
+        with self.condition:
+            self.jobs[name].append((function, args))
+            self.condition.notify()
+
+    def pending(self, name=None):
+        """Returns the amount of jobs queued for `name`, or for all stations
+        if `name` is None."""
+        with self.condition:
+            if name is not None:
+                return len(self.jobs[name])
+            return sum(len(jobs) for jobs in self.jobs.values())
+
+    def next_job(self):
+        """Internal method
+
+        Returns the next (station, function, args) to run or None, the
+        caller should hold :attr:`condition`.
+        """
+        for _ in range(len(self.order)):
+            name = self.order[0]
+            self.order.rotate(-1)
+            jobs = self.jobs[name]
+            limit = self.limits.get(name)
+            if jobs and (limit is None or self.running[name] < limit):
+                function, args = jobs.popleft()
+                return name, function, args
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                while job is None and not self.stopped.is_set():
+                    self.condition.wait(1.0)
+                    job = self.next_job()
+                if self.stopped.is_set():
+                    return
+                name, function, args = job
+                self.running[name] += 1
+
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("Job for station %s failed.", name)
+            finally:
+                with self.condition:
+                    self.running[name] -= 1
+                    # A slot of the station opened up.
+                    self.condition.notify_all()
+
+    def start(self):
+        self.stopped.clear()
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(
+                target=self.run,
+                name="Worker Pool {:d}".format(len(self.threads)))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def close(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        self.threads = []
+
+
+class StationPool(object):
+    """The view of a single station on a :class:`WorkerPool`, this is what
+    the preloader gets as its `preload_pool` option."""
+    def __init__(self, pool, name):
+        super(StationPool, self).__init__()
+        self.pool = pool
+        self.name = name
+
+    def submit(self, function, *args):
+        self.pool.submit(self.name, function, *args)
+
+
+class Supervisor(object):
+    """
+    =======
+    Options
+    =======
+
+        - supervisor_workers:
+            The amount of preload threads shared by all stations.
+            (defaults to 4)
+        - supervisor_cache_mb:
+            The size of the shared decode cache in megabytes, 0 disables
+            the cache.
+            (defaults to 512)
+        - metrics_file, metrics_port, metrics_interval:
+            See :class:`~hanyuu.streamer.manager.Manager`, these export the
+            metrics of all stations.
+    """
+    options = {
+        "supervisor_workers": 4,
+        "supervisor_cache_mb": 512,
+    }
+
+    def __init__(self, options=None):
+        super(Supervisor, self).__init__()
+        options = dict(self.options, **(options or {}))
+
+        #: name -> :class:`~hanyuu.streamer.manager.Manager`
+        self.stations = {}
+
+        self.pool = WorkerPool(int(options["supervisor_workers"]))
+        cache_bytes = int(float(options["supervisor_cache_mb"]) * 1024 * 1024)
+        self.cache = DecodeCache(cache_bytes) if cache_bytes else None
+        self.store = BufferStore()
+
+        self.metrics = metrics.Registry()
+        self.exporter = metrics.Exporter(
+            self.metrics,
+            filename=options.get("metrics_file"),
+            port=options.get("metrics_port"),
+            interval=float(options.get("metrics_interval", 10.0)),
+        )
+        self.metrics.gauge(
+            "streamer_supervisor_stations",
+            "Stations hosted by the supervisor.",
+            function=lambda: len(self.stations))
+        self.metrics.gauge(
+            "streamer_supervisor_pool_pending",
+            "Jobs queued on the shared worker pool.",
+            function=self.pool.pending)
+        self.metrics.gauge(
+            "streamer_preload_store_bytes",
+            "Bytes of preload buffers in use, shared ones counted once.",
+            function=self.store.size)
+        if self.cache is not None:
+            self.metrics.gauge(
+                "streamer_decode_cache_bytes",
+                "Bytes of audio held in the shared decode cache.",
+                function=lambda: self.cache.size)
+            self.metrics.gauge(
+                "streamer_decode_cache_hits",
+                "Lookups in the shared decode cache that were hits.",
+                function=lambda: self.cache.hits)
+            self.metrics.gauge(
+                "streamer_decode_cache_misses",
+                "Lookups in the shared decode cache that were misses.",
+                function=lambda: self.cache.misses)
+
+        self.started = threading.Event()
+
+    def add_station(self, name, source, pipes, options=None,
+                    max_preloads=None, max_cache_mb=None):
+        """
+        Creates the manager of a station.
+
+        :param name: A unique name of the station.
+        :param source, pipes, options: Passed to the
+            :class:`~hanyuu.streamer.manager.Manager`. The metrics exporter
+            options are ignored.
+        :param max_preloads: The maximum amount of songs of this station
+                             that are preloaded at the same time.
+        :param max_cache_mb: The maximum amount of megabytes of the decode
+                             cache used for this station.
+        :returns: The :class:`~hanyuu.streamer.manager.Manager`, it is
+                  started when the supervisor is.
+        """
+        if name in self.stations:
+            raise ValueError("Station {} already exists.".format(name))
+
+        options = dict(options or {})
+        for key in ("metrics_file", "metrics_port"):
+            options.pop(key, None)
+        options["metrics_registry"] = self.metrics.labelled(
+            {"station": name})
+        options["preload_pool"] = self.pool.station(name, max_preloads)
+        options["preload_store"] = self.store
+        if self.cache is not None:
+            max_bytes = None
+            if max_cache_mb is not None:
+                max_bytes = int(float(max_cache_mb) * 1024 * 1024)
+            options["preload_cache"] = self.cache.station(name, max_bytes)
+
+        manager = Manager(source, pipes, options)
+        self.stations[name] = manager
+        if self.started.is_set():
+            manager.start()
+        return manager
+
+    def remove_station(self, name):
+        """Closes and forgets the station named `name`."""
+        manager = self.stations.pop(name)
+        manager.close()
+        # Gauges of the station hold on to its manager otherwise.
+        self.metrics.unregister({"station": name})
+        if self.cache is not None:
+            self.cache.clear(name)
+
+    def start(self):
+        if self.started.is_set():
+            return
+        self.pool.start()
+        for name, manager in self.stations.items():
+            manager.start()
+        self.exporter.start()
+        self.started.set()
+
+    def close(self):
+        self.started.clear()
+        for name, manager in self.stations.items():
+            try:
+                manager.close()
+            except Exception:
+                logger.exception("Failed closing station %s.", name)
+        self.pool.close()
+        self.exporter.close()
@@ -0,0 +1,253 @@
+"""
+Replacing the source of a running stage, such as going from a live DJ back
+to the automation.
+
+A stage reading through a :class:`SourceSwitch` never stops for a switch.
+:meth:`SourceSwitch.switch` only sets the new source aside; the thread of
+the stage picks it up between two of its reads, once the audio read so far
+ends on a boundary:
+
+    - PCM: the end of a frame of `block_align` bytes, so the samples of the
+      new source line up with those of the old one.
+    - MPEG audio: the end of an MP3 frame, the rest of a frame cut off by
+      the last read is read from the old source first. The new source is
+      read from its first frame header on.
+
+A switch between PCM sources can fade the old source out over the new one
+for `fade_seconds`, instead of cutting over. This needs numpy, see
+:mod:`hanyuu.streamer.dsp`, and both sources in the format of
+:mod:`hanyuu.streamer.pcm`; without those the switch cuts over.
+
+The switch doesn't close the old source, that is up to whoever made it.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+import logging
+
+from .pcm import SAMPLE_RATE, BITS_PER_SAMPLE, BLOCK_ALIGN
+from . import pool
+from . import mp3
+
+
+logger = logging.getLogger("streamer.switch")
+
+
+class SourceSwitch(object):
+    """
+    The source of a stage, replaceable while the stage reads from it.
+    Attributes we don't have are looked up on the current source.
+
+    :param source: The source to start with.
+    :param frames: True if the sources return MPEG audio, False for PCM.
+    :param on_switch: Called with the old and new source right after a
+                      switch, from the thread reading.
+    """
+    #: The amount of seconds a read from the source fading out may take,
+    #: the fade goes on with silence for it when it has nothing.
+    fade_timeout = 0.1
+
+    def __init__(self, source, frames=False, on_switch=None):
+        super(SourceSwitch, self).__init__()
+        self.source = source
+        self.frames = frames
+        self.on_switch = on_switch
+        self.lock = threading.Lock()
+        #: The (source, fade_seconds) to switch to at the next boundary.
+        self.upcoming = None
+
+        # The bytes read from the current source.
+        self.offset = 0
+        # Follows the frames read from the current source, for MPEG audio.
+        self.counter = mp3.FrameCounter()
+        # Set while looking for the first frame of a new source.
+        self.syncing = False
+        # The source fading out, while fading.
+        self.fading = None
+        self.fade_position = 0
+        self.fade_length = 0
+
+    def switch(self, source, fade_seconds=0.0):
+        """Replaces the source from the next boundary in the audio on,
+        without waiting for it. A switch that didn't happen yet is
+        replaced by this one."""
+        with self.lock:
+            self.upcoming = (source, fade_seconds)
+
+    def pending(self):
+        """Returns True if a switch is waiting for a boundary."""
+        with self.lock:
+            return self.upcoming is not None
+
+    def read(self, size=4096, timeout=10.0):
+        buffer = bytearray(size)
+        size = self.readinto(buffer, timeout)
+        return bytes(buffer[:size])
+
+    def readinto(self, buffer, timeout=10.0):
+        with self.lock:
+            upcoming = self.upcoming
+        if upcoming is not None:
+            remainder = self.remainder()
+            if remainder:
+                size = self.read_part(self.source, buffer, remainder, timeout)
+                if size:
+                    self.account(buffer, size)
+                    return size
+                # The old source is done, the frame stays cut off.
+            with self.lock:
+                if self.upcoming is upcoming:
+                    self.upcoming = None
+            self.swap(*upcoming)
+
+        if self.fading is not None:
+            return self.mix(buffer, timeout)
+
+        size = pool.readinto(self.source, buffer, timeout)
+        while self.syncing and size:
+            size = self.sync(buffer, size)
+            if not size:
+                size = pool.readinto(self.source, buffer, timeout)
+        self.account(buffer, size)
+        return size
+
+    def remainder(self):
+        """Internal method
+
+        Returns the amount of bytes to read from the current source until
+        the next boundary.
+        """
+        if self.frames:
+            if self.counter.partial:
+                # Enough to see the size of the frame.
+                return 4 - len(self.counter.partial)
+            return self.counter.skip
+        block_align = getattr(self.source, "block_align", 1)
+        return -self.offset % block_align
+
+    def read_part(self, source, buffer, size, timeout):
+        """Internal method
+
+        Reads at most `size` bytes of `source` into `buffer`.
+        """
+        part = bytearray(min(size, len(buffer)))
+        size = pool.readinto(source, part, timeout)
+        buffer[:size] = part[:size]
+        return size
+
+    def account(self, buffer, size):
+        """Internal method
+
+        Counts `size` bytes read into `buffer` from the current source.
+        """
+        self.offset += size
+        if self.frames:
+            self.counter.feed(buffer, size)
+
+    def swap(self, source, fade_seconds):
+        """Internal method
+
+        Makes `source` the current source, called between reads.
+        """
+        old = self.source
+        fade_length = self.fade_frames(old, source, fade_seconds)
+        self.source = source
+        self.offset = 0
+        self.counter = mp3.FrameCounter()
+        self.syncing = self.frames
+        # A switch while fading cuts off the source fading out.
+        self.fading = old if fade_length else None
+        self.fade_position = 0
+        self.fade_length = fade_length
+
+        logger.info("Switched source from %r to %r%s.", old, source,
+                    " with a {:.1f} second fade".format(fade_seconds)
+                    if fade_length else "")
+        if self.on_switch is not None:
+            self.on_switch(old, source)
+
+    def fade_frames(self, old, new, fade_seconds):
+        """Internal method
+
+        Returns the amount of frames to fade over from `old` to `new`, 0 if
+        we can't fade between them.
+        """
+        if self.frames or not fade_seconds or fade_seconds <= 0:
+            return 0
+        # Not at the top, numpy shouldn't be imported by every pipe that
+        # can switch sources.
+        from . import dsp
+        if not dsp.available():
+            logger.warning("Switching without a fade, numpy isn't "
+                           "installed.")
+            return 0
+        for source in (old, new):
+            if (getattr(source, "sample_rate", None) != SAMPLE_RATE or
+                    getattr(source, "bits_per_sample", None) !=
+                    BITS_PER_SAMPLE):
+                logger.warning("Switching without a fade, %r isn't in the "
+                               "format we can mix.", source)
+                return 0
+        return int(fade_seconds * SAMPLE_RATE)
+
+    def mix(self, buffer, timeout):
+        """Internal method
+
+        Reads the next part of a fade into `buffer`.
+        """
+        misaligned = -self.offset % BLOCK_ALIGN
+        if misaligned:
+            # Get the new source back on a frame before mixing again.
+            size = self.read_part(self.source, buffer, misaligned, timeout)
+            self.account(buffer, size)
+            return size
+
+        from . import dsp
+        frames = min(len(buffer) // BLOCK_ALIGN,
+                     self.fade_length - self.fade_position)
+        head = bytearray(max(frames, 1) * BLOCK_ALIGN)
+        size = pool.readinto(self.source, head, timeout)
+        if not size:
+            return 0
+        frames = size // BLOCK_ALIGN
+        tail = bytearray(frames * BLOCK_ALIGN)
+        tail_size = pool.readinto(self.fading, tail,
+                                  min(timeout, self.fade_timeout))
+
+        mixed = dsp.mix(bytes(tail[:tail_size]),
+                        bytes(head[:frames * BLOCK_ALIGN]),
+                        self.fade_position, self.fade_length, frames)
+        buffer[:len(mixed)] = mixed
+        # The start of a frame cut off by the read goes out as is.
+        buffer[len(mixed):size] = head[len(mixed):size]
+        self.account(buffer, size)
+
+        self.fade_position += frames
+        if self.fade_position >= self.fade_length:
+            logger.debug("Fade from %r done.", self.fading)
+            self.fading = None
+        return size
+
+    def sync(self, buffer, size):
+        """Internal method
+
+        Drops the bytes before the first frame header in the first `size`
+        bytes of `buffer`, and returns the amount of bytes left.
+        """
+        offset = buffer.find(b'\xff', 0, size)
+        while offset != -1 and mp3.parse_header(buffer, offset) is None:
+            offset = buffer.find(b'\xff', offset + 1, size)
+        if offset == -1:
+            return 0
+        buffer[:size - offset] = buffer[offset:size]
+        self.syncing = False
+        return size - offset
+
+    def __getattr__(self, key):
+        # Avoids an infinite recursion before `source` is set.
+        if key == 'source':
+            raise AttributeError("No attribute named 'source'")
+        return getattr(self.source, key)
+
@@ -0,0 +1,145 @@
+"""
+Passthrough pipes that copy the stream to a secondary output.
+
+The pipeline is a single chain, a :class:`Tap` is placed in it like any
+other pipe and returns what it reads unchanged. A copy of everything read is
+handed to a writer thread, so the secondary output can't slow down the
+pipes after the tap. When the writer falls behind too far, data for it is
+dropped instead of blocking the stream.
+
+    Manager(queue, [..., Encoder, Archive, Icecast], options)
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+import logging
+import Queue
+import time
+
+from . import pool
+from .mp3 import FrameParser
+
+
+logger = logging.getLogger("streamer.tap")
+
+
+class Tap(object):
+    """
+    ======
+    Source
+    ======
+
+    The source can be any pipe, other attributes are passed through to it
+    so the consumer doesn't notice the tap.
+
+    =======
+    Options
+    =======
+
+        - tap_queue_size:
+            The amount of reads that can be queued for the writer thread
+            before data is dropped.
+            (defaults to 512)
+
+    Subclasses implement :meth:`write`, or :meth:`write_frame` when they
+    set :attr:`frames` to receive whole MPEG audio frames.
+    """
+    options = {
+        "tap_queue_size": 512,
+    }
+    #: If true, the stream is split into frames for :meth:`write_frame`.
+    frames = False
+
+    def __init__(self, manager, pipe, options):
+        super(Tap, self).__init__()
+        self.manager = manager
+        self.source = pipe
+
+        self.queue = Queue.Queue(int(options.get("tap_queue_size", 512)))
+        self.running = threading.Event()
+        self.parser = FrameParser() if self.frames else None
+
+        name = type(self).__name__.lower()
+        self.dropped = manager.metrics.counter(
+            "streamer_tap_dropped_total",
+            "Reads that were not written by a tap because it fell behind.",
+            {"tap": name})
+
+    def read(self, size=4096, timeout=10.0):
+        data = self.source.read(size, timeout)
+        if data:
+            self.put(data)
+        return data
+
+    def readinto(self, buffer, timeout=10.0):
+        size = pool.readinto(self.source, buffer, timeout)
+        if size:
+            self.put(bytes(buffer[:size]))
+        return size
+
+    def put(self, data):
+        """Internal method
+
+        Queues `data` for the writer thread.
+        """
+        try:
+            self.queue.put_nowait((time.time(), data))
+        except Queue.Full:
+            self.dropped.inc()
+
+    def run(self):
+        while self.running.is_set() or not self.queue.empty():
+            try:
+                timestamp, data = self.queue.get(timeout=1.0)
+            except Queue.Empty:
+                continue
+            self.handle(data, timestamp)
+        self.flush()
+
+    def handle(self, data, timestamp):
+        """Internal method
+
+        Passes `data` on to :meth:`write` or :meth:`write_frame`.
+        """
+        try:
+            if self.parser is None:
+                self.write(data, timestamp)
+                return
+            for header, frame in self.parser.feed(data):
+                self.write_frame(header, frame, timestamp)
+        except Exception:
+            logger.exception("Tap %s failed writing.", type(self).__name__)
+
+    def write(self, data, timestamp):
+        """Called from the writer thread with the data of each read, and the
+        time it was read at."""
+        pass
+
+    def write_frame(self, header, frame, timestamp):
+        """Called from the writer thread with each frame, see
+        :mod:`hanyuu.streamer.mp3`. `timestamp` is the time the read that
+        completed the frame was done at."""
+        pass
+
+    def flush(self):
+        """Called from the writer thread when the tap is closed."""
+        pass
+
+    def start(self):
+        if self.running.is_set():
+            return
+        self.running.set()
+        self.thread = threading.Thread(
+            target=self.run, name="Tap " + type(self).__name__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.running.clear()
+
+    def __getattr__(self, key):
+        if key == 'source':
+            raise AttributeError("No attribute named 'source'")
+        return getattr(self.source, key)
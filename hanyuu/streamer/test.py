@@ -1,6 +1,4 @@
-from collections import namedtuple
-
-Song = namedtuple("Song", ("filename", "metadata"))
+from hanyuu.streamer.library import Song
 
 def test_dir(directory=u'/media/F/Music', files=None):
     import os
@@ -38,6 +36,12 @@ def test_dir(directory=u'/media/F/Music', files=None):
             return pop_file()
     return pop_file
 
+def test_library(database, directory=u'/media/F/Music'):
+    from hanyuu.streamer.library import Library
+    library = Library(database, directory)
+    library.scan()
+    return library.shuffle()
+
 def test_config(password=None):
     return {'host': 'r-a-d.io',
             'port': 1337,
@@ -67,15 +71,19 @@ class TestQueue(object):
         self.queue.append(self.func())
         return self.queue.popleft()
 
-def tester(password, directory):
+def tester(password, directory, database=None, process=False):
     import hanyuu.streamer.manager as m
     from hanyuu.streamer.preloader import PreloadedFileSource
     from hanyuu.streamer.files import FileSource
     from hanyuu.streamer.encoder import Encoder
     from hanyuu.streamer.icecast import Icecast
+    from hanyuu.streamer.underrun import UnderrunGuard
 
     hackie = [None]
-    source = test_dir(directory)
+    if database:
+        source = test_library(database, directory)
+    else:
+        source = test_dir(directory)
 
     poppie = TestQueue(source)
     print poppie.queue
@@ -86,7 +94,13 @@ def tester(password, directory):
 
     config = {"icecast_config": test_config(password)}
 
-    manager = m.Manager(poppie, [PreloadedFileSource, FileSource, Encoder, Icecast], config)
+    if process:
+        from hanyuu.streamer.process import ProcessSource
+        pipes = [ProcessSource, UnderrunGuard, Encoder, Icecast]
+    else:
+        pipes = [PreloadedFileSource, FileSource,
+                 UnderrunGuard, Encoder, Icecast]
+    manager = m.Manager(poppie, pipes, config)
     hackie[0] = manager
 
 
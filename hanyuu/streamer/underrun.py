@@ -0,0 +1,204 @@
+"""
+A pipe that keeps audio flowing when its source can't deliver in time.
+
+Without it an empty read anywhere in the pipeline travels all the way down
+to the :class:`~hanyuu.streamer.icecast.Icecast` pipe, which treats it as EOF
+and drops the mount. The :class:`UnderrunGuard` fills in with generated
+silence, or a configured fallback loop, until real audio is available again.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import logging
+import time
+
+from .buffered import BufferedSource
+
+
+logger = logging.getLogger("streamer.underrun")
+
+
+class UnderrunGuard(BufferedSource):
+    """
+    ======
+    Source
+    ======
+
+    The source is expected to return PCM audio data and should have the
+    same attributes as required by
+    :class:`~hanyuu.streamer.buffered.BufferedSource`, and additionally:
+
+        :attr:`block_align`:
+            The size in bytes of a single PCM frame. The source is only
+            interrupted on frame boundaries. (defaults to 1)
+
+    The guard is meant to be placed directly after the
+    :class:`~hanyuu.streamer.files.FileSource`, which should be configured
+    with `eof_on_empty` set to False so it picks up new songs once the
+    source queue is filled again. The fill audio is reported to the playout
+    clock of the manager, see :mod:`hanyuu.streamer.clock`.
+
+    =======
+    Options
+    =======
+
+    The options of :class:`~hanyuu.streamer.buffered.BufferedSource` are
+    used for the read ahead buffer, in addition to the following:
+
+        - underrun_deadline_ms:
+            The amount of milliseconds a read waits for audio before the
+            guard starts filling in.
+            (defaults to 250)
+        - underrun_fallback:
+            A filename of an audio file to loop instead of silence.
+            (defaults to None, silence)
+
+    ========
+    Events
+    ========
+
+        - underrun_start:
+            Called when the guard starts filling in audio.
+
+            :param guard: :class:`UnderrunGuard` instance.
+        - underrun_end:
+            Called when real audio is available again.
+
+            :param guard: :class:`UnderrunGuard` instance.
+    """
+    options = {
+        "buffer_ms": 500,
+        "buffer_chunk_size": 4096,
+        "underrun_deadline_ms": 250,
+        "underrun_fallback": None,
+    }
+
+    def __init__(self, manager, pipe, options):
+        super(UnderrunGuard, self).__init__(manager, pipe, options)
+        self.block_align = getattr(pipe, "block_align", 1)
+        self.deadline = float(options["underrun_deadline_ms"]) / 1000
+        self.fallback_filename = options["underrun_fallback"]
+
+        #: The fallback audio, or None if we fill with silence.
+        self.fallback = None
+        self.fallback_index = 0
+
+        #: True while we are filling in for the source.
+        self.underrun = False
+        #: The amount of bytes of the source we returned so far.
+        self.passed = 0
+
+        registry = manager.metrics
+        self.underrun_count = registry.counter(
+            "streamer_underruns_total",
+            "Times the underrun guard had to fill in for its source.")
+        self.filled = registry.counter(
+            "streamer_underrun_filled_bytes_total",
+            "Bytes of fill audio generated by the underrun guard.")
+
+    def start(self):
+        if self.fallback_filename and self.fallback is None:
+            self.fallback = self.load_fallback(self.fallback_filename)
+        super(UnderrunGuard, self).start()
+
+    def load_fallback(self, filename):
+        """Decodes `filename` completely and returns the PCM data, or None
+        if the file could not be used."""
+        from .files import AudioFile, AudioError
+
+        try:
+            audiofile = AudioFile(filename)
+        except (AudioError, IOError):
+            logger.exception("Failed opening fallback file, using silence.")
+            return None
+
+        parts = []
+        try:
+            while True:
+                data = audiofile.read(self.chunk_size)
+                if not data:
+                    break
+                parts.append(data)
+        except (ValueError, IOError):
+            logger.exception("Failed decoding fallback file, using silence.")
+            return None
+        finally:
+            audiofile.close()
+
+        data = b''.join(parts)
+        data = data[:len(data) - len(data) % self.block_align]
+        return data or None
+
+    def read(self, size=4096, timeout=10.0):
+        start = self.metrics.begin()
+        size = max(size - size % self.block_align, self.block_align)
+
+        with self.condition:
+            data = self.take_aligned(size)
+            if not data and not self.underrun:
+                # Give the source until the deadline to deliver before we
+                # start filling in.
+                deadline = start + min(timeout, self.deadline)
+                while not data and self.running.is_set():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                    data = self.take_aligned(size)
+            self.condition.notify_all()
+
+        if data:
+            self.passed += len(data)
+            if self.underrun:
+                self.underrun = False
+                logger.info("Source recovered from underrun.")
+                self.manager.emit("underrun_end", self)
+        else:
+            if not self.underrun:
+                self.underrun = True
+                self.underrun_count.inc()
+                logger.warning("Source missed its deadline, filling in.")
+                self.manager.emit("underrun_start", self)
+            # While in an underrun we don't wait on the source anymore, the
+            # consumer paces us just like it would the source.
+            data = self.generate(size)
+            self.filled.inc(len(data))
+            # The tracks after this air later by the fill.
+            self.manager.clock.insert(float(self.passed) / self.byte_rate,
+                                      float(len(data)) / self.byte_rate)
+
+        self.metrics.observe(len(data), time.time() - start)
+        return data
+
+    def readinto(self, buffer, timeout=10.0):
+        data = self.read(len(buffer), timeout)
+        size = len(data)
+        buffer[:size] = data
+        return size
+
+    def take_aligned(self, size):
+        """Internal method
+
+        Like :meth:`take` but only returns whole PCM frames, a partial frame
+        stays queued until the rest of it arrives.
+        """
+        size = min(size, self.size)
+        size -= size % self.block_align
+        if size <= 0:
+            return b''
+        return self.take(size)
+
+    def generate(self, size):
+        """Returns `size` bytes of fill audio."""
+        if self.fallback is None:
+            return b'\x00' * size
+
+        parts = []
+        while size > 0:
+            start = self.fallback_index
+            part = self.fallback[start:start + size]
+            self.fallback_index = (start + len(part)) % len(self.fallback)
+            parts.append(part)
+            size -= len(part)
+        return b''.join(parts)
@@ -0,0 +1,280 @@
+"""
+A watchdog noticing stalled stages of the pipeline, and recovering them.
+
+Every stage with :class:`~hanyuu.streamer.metrics.StageMetrics` counts the
+bytes its reads return, the :class:`Watchdog` uses those counters as
+heartbeats. A stage is stalled when it moved no bytes for `deadline`
+seconds, or moved less than `min_ratio` of the audio it should have in
+that time, as given by the `byte_rate` of the stage or its source.
+
+The pipeline is pulled from the sink, so a stage that stops reading stalls
+the stages before it as much as a stage that stops returning data stalls
+the stages after it. Each stage keeps track of how long it has been asked
+for data without returning any, see
+:meth:`~hanyuu.streamer.metrics.StageMetrics.waiting`. Starting at a
+stalled sink, or a stalled stage kept waiting, the blame moves upstream for
+as long as the source of a stage is kept waiting too, or is too slow while
+busy reading. Only the stage it ends on is recovered. A stage with a
+`starved` method returning True has nothing to play, such as a
+:class:`~hanyuu.streamer.files.FileSource` with an empty queue; it and the
+stages after it aren't judged.
+
+On a stall the stacks of all threads are logged, showing where the stage
+is stuck, and the stage is asked to recover by calling its `recover`
+method if it has one:
+
+    - :class:`~hanyuu.streamer.encoder.Encoder`: restarts the encoder.
+    - :class:`~hanyuu.streamer.icecast.Icecast`: drops the connection, the
+      libshout object is rebuilt and reconnected.
+    - :class:`~hanyuu.streamer.files.FileSource`: skips the current track.
+
+After an incident a stage isn't judged again for `cooldown` seconds. The
+watchdog is started by the :class:`~hanyuu.streamer.manager.Manager` when
+its `watchdog_deadline` option is set.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import traceback
+import threading
+import logging
+import time
+import sys
+
+from .metrics import StageMetrics
+
+
+logger = logging.getLogger("streamer.watchdog")
+
+
+def thread_stacks():
+    """Returns the stacks of all running threads, formatted for a log."""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    parts = []
+    for ident, frame in sys._current_frames().items():
+        parts.append("Thread {} ({:d}):\n{}".format(
+            names.get(ident, "unknown"), ident,
+            "".join(traceback.format_stack(frame))))
+    return "\n".join(parts)
+
+
+def expected_rate(pipe):
+    """Returns the bytes per second `pipe` should move, or None if it isn't
+    known."""
+    for candidate in (pipe, pipe.__dict__.get("source")):
+        try:
+            rate = candidate.byte_rate
+        except AttributeError:
+            continue
+        if rate:
+            return rate
+    return None
+
+
+class Heartbeat(object):
+    """The progress of a single stage, as seen by the watchdog."""
+    def __init__(self, name, pipe, now):
+        super(Heartbeat, self).__init__()
+        self.name = name
+        self.pipe = pipe
+        self.bytes = pipe.metrics.bytes.value
+        #: The last time the stage moved any bytes.
+        self.progress = now
+        self.window_bytes = self.bytes
+        self.window_start = now
+        #: The time spent in reads over the window, and the fraction of the
+        #: last window it took.
+        self.window_busy = pipe.metrics.latency.sum
+        self.busy = 0.0
+        #: Why the stage stalled at the last check, None if it didn't.
+        self.reason = None
+        #: The stage isn't judged before this time.
+        self.quiet_until = now
+
+
+class Watchdog(object):
+    """
+    Watches the stages of `manager`.
+
+    :param deadline: The amount of seconds a stage can go without progress.
+    :param min_ratio: The fraction of real time a stage has to keep up with
+                      over `deadline` seconds.
+    :param interval: The amount of seconds between checks.
+    :param cooldown: The amount of seconds a stage is left alone after an
+                     incident.
+    """
+    def __init__(self, manager, deadline=10.0, min_ratio=0.5,
+                 interval=1.0, cooldown=30.0):
+        super(Watchdog, self).__init__()
+        self.manager = manager
+        self.deadline = deadline
+        self.min_ratio = min_ratio
+        self.interval = interval
+        self.cooldown = cooldown
+        self.heartbeats = []
+        self.running = threading.Event()
+
+        self.metrics = manager.metrics
+
+    def stages(self):
+        """Returns (name, pipe) of the pipes of the manager that have
+        stage metrics."""
+        stages = []
+        for pipe in self.manager.pipe_instances:
+            # Not through getattr, pipes pass unknown attributes on to
+            # their source.
+            metrics = pipe.__dict__.get("metrics")
+            if isinstance(metrics, StageMetrics):
+                stages.append((metrics.stage, pipe))
+        return stages
+
+    def check(self, now=None):
+        """Checks each stage once, recovering those that stalled."""
+        now = time.time() if now is None else now
+        reasons = self.judge(now)
+
+        last = len(self.heartbeats) - 1
+        blamed = set()
+        for index in range(last, -1, -1):
+            if reasons[index] is None or index in blamed:
+                continue
+            # A stage nobody asks for data is stalled by the stage after
+            # it, which is judged on its own. The sink asks nobody.
+            if index != last and not self.waiting(self.heartbeats[index],
+                                                  now):
+                continue
+            # The pipeline is pulled from the sink, a stage waiting on its
+            # source for too long stalls because of that source.
+            while index > 0 and self.upstream(index, now):
+                index -= 1
+            if index in blamed:
+                continue
+            blamed.add(index)
+
+            heartbeat = self.heartbeats[index]
+            if reasons[index] is None or now < heartbeat.quiet_until:
+                continue
+            self.incident(heartbeat, reasons[index])
+            heartbeat.progress = now
+            heartbeat.quiet_until = now + self.cooldown
+
+    def judge(self, now):
+        """Internal method
+
+        Returns the reason each stage is stalled for, in pipeline order,
+        None for stages that aren't.
+        """
+        reasons = []
+        # Set once a stage before the current one is starved.
+        starved = False
+        for heartbeat in self.heartbeats:
+            metrics = heartbeat.pipe.metrics
+            count = metrics.bytes.value
+            if count != heartbeat.bytes:
+                heartbeat.bytes = count
+                heartbeat.progress = now
+
+            if starved or self.starved(heartbeat.pipe):
+                # Nothing comes through to this stage, start over once
+                # something does.
+                starved = True
+                heartbeat.progress = now
+                heartbeat.window_bytes = count
+                heartbeat.window_busy = metrics.latency.sum
+                heartbeat.window_start = now
+                heartbeat.busy = 0.0
+                heartbeat.reason = None
+                reasons.append(None)
+                continue
+
+            reason = None
+            if now - heartbeat.progress > self.deadline:
+                reason = "no progress for {:.1f} seconds".format(
+                    now - heartbeat.progress)
+            elif now - heartbeat.window_start >= self.deadline:
+                rate = expected_rate(heartbeat.pipe)
+                elapsed = now - heartbeat.window_start
+                moved = count - heartbeat.window_bytes
+                heartbeat.busy = ((metrics.latency.sum -
+                                   heartbeat.window_busy) / elapsed)
+                if rate and moved < rate * elapsed * self.min_ratio:
+                    reason = ("moved {:.1f} seconds of audio in {:.1f} "
+                              "seconds".format(float(moved) / rate, elapsed))
+                heartbeat.window_bytes = count
+                heartbeat.window_busy = metrics.latency.sum
+                heartbeat.window_start = now
+            heartbeat.reason = reason
+            reasons.append(reason)
+        return reasons
+
+    def waiting(self, heartbeat, now):
+        """Internal method
+
+        Returns True if the stage of `heartbeat` was asked for data and
+        didn't return any for longer than the deadline.
+        """
+        return heartbeat.pipe.metrics.waiting(now) > self.deadline
+
+    def upstream(self, index, now):
+        """Internal method
+
+        Returns True if the stage before the one at `index` is the cause of
+        its stall: it is kept waiting on, or it is too slow while busy
+        reading for most of the time.
+        """
+        source = self.heartbeats[index - 1]
+        if self.waiting(source, now):
+            return True
+        return source.reason is not None and source.busy >= 0.5
+
+    def starved(self, pipe):
+        """Internal method
+
+        Returns True if `pipe` says it has nothing to play.
+        """
+        starved = getattr(type(pipe), "starved", None)
+        return bool(starved is not None and starved(pipe))
+
+    def incident(self, heartbeat, reason):
+        """Internal method
+
+        Logs the stall of `heartbeat` and asks the stage to recover.
+        """
+        self.metrics.counter(
+            "streamer_watchdog_stalls_total",
+            "Stalls of a stage noticed by the watchdog.",
+            {"stage": heartbeat.name}).inc()
+
+        recover = getattr(type(heartbeat.pipe), "recover", None)
+        logger.error("Stage %s stalled, %s. %s.\n%s", heartbeat.name, reason,
+                     "Recovering" if recover else "No recovery available",
+                     thread_stacks())
+        if recover is None:
+            return
+        try:
+            recover(heartbeat.pipe)
+        except Exception:
+            logger.exception("Recovery of stage %s failed.", heartbeat.name)
+
+    def run(self):
+        while self.running.is_set():
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Watchdog check failed.")
+
+    def start(self):
+        if self.running.is_set():
+            return
+        now = time.time()
+        self.heartbeats = [Heartbeat(name, pipe, now)
+                           for name, pipe in self.stages()]
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name="Watchdog")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.running.clear()
@@ -0,0 +1,86 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import unittest
+import time
+import gc
+
+try:
+    from hanyuu.streamer import files
+except ImportError:
+    files = None
+
+
+class Reader(object):
+    """Stands in for an audiotools reader."""
+    def __init__(self, *args, **kwargs):
+        super(Reader, self).__init__()
+        self.args = args
+        self.closed = False
+
+    def total_frames(self):
+        return 0
+
+    def sample_rate(self):
+        return 44100
+
+    def to_pcm(self):
+        return self
+
+    def close(self):
+        self.closed = True
+
+
+class FakeAudiotools(object):
+    """Stands in for the parts of audiotools an AudioFile uses. The
+    progress wrapper keeps the callback like the real one does."""
+    UnsupportedFile = DecodingError = Exception
+    ChannelMask = int
+
+    def __init__(self):
+        super(FakeAudiotools, self).__init__()
+        self.readers = []
+
+    def open(self, filename):
+        return Reader()
+
+    def PCMConverter(self, reader, **kwargs):
+        return reader
+
+    def PCMReaderProgress(self, reader, total_frames, progress):
+        reader = Reader(reader, total_frames, progress)
+        self.readers.append(reader)
+        return reader
+
+
+@unittest.skipIf(files is None, "audiotools isn't installed")
+class TestAudioFile(unittest.TestCase):
+    def setUp(self):
+        self.audiotools = files.audiotools
+        files.audiotools = FakeAudiotools()
+
+    def tearDown(self):
+        files.audiotools = self.audiotools
+
+    def test_finalizer_fires(self):
+        audiofile = files.AudioFile("test.flac")
+        reader = files.audiotools.readers[0]
+        del audiofile
+        gc.collect()
+
+        deadline = time.time() + 5.0
+        while not reader.closed and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(reader.closed)
+
+    def test_progress(self):
+        calls = []
+        audiofile = files.AudioFile("test.flac")
+        audiofile.progress = lambda current, total: calls.append(current)
+        files.audiotools.readers[0].args[2](1, 2)
+        self.assertEqual(calls, [1])
+        audiofile.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import shutil
+import struct
+import tempfile
+import unittest
+
+from hanyuu.streamer.manager import Manager
+from hanyuu.streamer import hls, mp3
+
+
+# An MPEG-1 layer III frame header, 128 kbps at 44100 Hz, and its frame.
+HEADER = b"\xff\xfb\x90\x64"
+FRAME = HEADER + b"\x00" * 413
+
+
+class FrameSource(object):
+    """A pipe returning the same frame for every read."""
+    def __init__(self, manager, pipe, options):
+        super(FrameSource, self).__init__()
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def read(self, size=4096, timeout=10.0):
+        return FRAME
+
+
+class TestTimestampTag(unittest.TestCase):
+    def test_layout(self):
+        tag = hls.timestamp_tag(10.0)
+        self.assertEqual(tag[:6], b"ID3\x04\x00\x00")
+        self.assertEqual(len(tag), 10 + 10 + len(hls.TIMESTAMP_OWNER) + 1 + 8)
+        self.assertIn(hls.TIMESTAMP_OWNER + b"\x00", tag)
+        self.assertEqual(struct.unpack(b">Q", tag[-8:])[0], 900000)
+
+    def test_wraps_at_33_bits(self):
+        seconds = float(1 << 33) / hls.TIMESTAMP_RATE + 1.0
+        tag = hls.timestamp_tag(seconds)
+        self.assertEqual(struct.unpack(b">Q", tag[-8:])[0],
+                         hls.TIMESTAMP_RATE)
+
+    def test_syncsafe(self):
+        self.assertEqual(hls.syncsafe(300), b"\x00\x00\x02\x2c")
+
+
+class TestHLS(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_manager_starts(self):
+        manager = Manager(None, [FrameSource, hls.HLS], {
+            "hls_directory": self.directory,
+            "hls_segment_seconds": 1.0,
+        })
+        manager.start()
+        tap = manager.pipe_instances[-1]
+        try:
+            for _ in range(100):
+                self.assertEqual(tap.read(), FRAME)
+        finally:
+            manager.close()
+        tap.thread.join(10.0)
+        self.assertFalse(tap.thread.is_alive())
+
+        self.assertTrue(tap.segments)
+        sequence = tap.segments[0][0]
+        name = "{}/{}".format(self.directory, tap.segment_name(sequence))
+        with open(name, "rb") as f:
+            data = f.read()
+        tag = hls.timestamp_tag(0.0)
+        self.assertEqual(data[:len(tag) - 8], tag[:-8])
+        self.assertEqual(data[len(tag):len(tag) + len(FRAME)], FRAME)
+        self.assertIsNotNone(mp3.parse_header(data, len(tag)))
+
+
+if __name__ == "__main__":
+    unittest.main()
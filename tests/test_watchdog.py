@@ -0,0 +1,75 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import logging
+import unittest
+
+from hanyuu.streamer import metrics
+from hanyuu.streamer import watchdog
+
+
+logging.getLogger("streamer.watchdog").addHandler(logging.NullHandler())
+
+
+class Manager(object):
+    def __init__(self):
+        self.metrics = metrics.Registry()
+        self.pipe_instances = []
+
+
+class Stage(object):
+    def __init__(self, manager, name):
+        self.metrics = manager.metrics.stage(name)
+        self.recovered = 0
+        self.is_starved = False
+
+    def recover(self):
+        self.recovered += 1
+
+    def starved(self):
+        return self.is_starved
+
+
+class TestWatchdog(unittest.TestCase):
+    def setUp(self):
+        manager = Manager()
+        self.stages = [Stage(manager, name)
+                       for name in ("file_source", "encoder", "icecast")]
+        manager.pipe_instances = self.stages
+        self.watchdog = watchdog.Watchdog(manager, deadline=10.0,
+                                          cooldown=30.0)
+        self.watchdog.heartbeats = [
+            watchdog.Heartbeat(name, pipe, 0.0)
+            for name, pipe in self.watchdog.stages()]
+
+    def run_checks(self, seconds):
+        for now in range(1, seconds):
+            self.watchdog.check(float(now))
+        return tuple(stage.recovered for stage in self.stages)
+
+    def test_sink_stops_reading(self):
+        self.assertEqual(self.run_checks(50), (0, 0, 2))
+
+    def test_sink_stuck_sending(self):
+        self.stages[2].metrics.asked = 0.0
+        self.assertEqual(self.run_checks(50), (0, 0, 2))
+
+    def test_source_stuck(self):
+        for stage in self.stages:
+            stage.metrics.asked = 0.0
+        self.assertEqual(self.run_checks(50), (2, 0, 0))
+
+    def test_middle_stuck(self):
+        for stage in self.stages[1:]:
+            stage.metrics.asked = 0.0
+        self.assertEqual(self.run_checks(50), (0, 2, 0))
+
+    def test_starved(self):
+        self.stages[0].is_starved = True
+        for stage in self.stages:
+            stage.metrics.asked = 0.0
+        self.assertEqual(self.run_checks(50), (0, 0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()